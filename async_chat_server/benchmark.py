@@ -0,0 +1,271 @@
+# benchmark.py
+"""Нагрузочный тест чат-сервера в одном процессе.
+
+Запускает ChatServer на свободном порту и тысячи синтетических asyncio-клиентов,
+которые авторизуются, заходят в комнаты, пишут в них и отправляют личные сообщения.
+Отчет: задержка доставки p50/p95/p99, сообщений в секунду, RSS на подключение.
+
+Сценарий задается аргументами или JSON-файлом (--scenario), например:
+    {"clients": 2000, "rooms": 20, "message_rate": 0.5, "dm_share": 0.1,
+     "slow_share": 0.05, "slow_delay": 0.05, "duration": 30, "codec": "bin1"}
+
+Примеры:
+    python benchmark.py --clients 500 --rooms 10 --duration 10
+    python benchmark.py --scenario big_rooms.json --output results.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import time
+from typing import Dict, List
+
+from protocol import CODECS, JSON_CODEC
+from ratelimit import RateLimits
+from server import ChatServer
+
+DEFAULT_SCENARIO = {
+    'clients': 200,        # число подключений
+    'rooms': 4,            # клиенты распределяются по комнатам равномерно
+    'message_rate': 1.0,   # сообщений в секунду от каждого клиента
+    'dm_share': 0.1,       # доля личных сообщений среди отправленных
+    'slow_share': 0.0,     # доля медленных клиентов
+    'slow_delay': 0.05,    # пауза медленного клиента между чтениями кадров, с
+    'duration': 10.0,      # длительность измерения, с
+    'codec': 'json',       # кодек кадров: json или bin1
+}
+MARKER = 'bench:'
+
+def rss_bytes() -> int:
+    """Текущий RSS процесса (Linux)"""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(q * len(sorted_values)))
+    return sorted_values[index]
+
+def latency_summary(samples: List[float]) -> Dict[str, float]:
+    values = sorted(samples)
+    return {name: round(percentile(values, q), 3)
+            for name, q in (('p50', 0.50), ('p95', 0.95), ('p99', 0.99))}
+
+def raise_fd_limit(needed: int):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(needed, hard), hard))
+
+class Stats:
+    def __init__(self):
+        self.sent = 0
+        self.sent_dm = 0
+        self.delivered = 0
+        self.room_latency: List[float] = []
+        self.dm_latency: List[float] = []
+        # Задержки медленных клиентов отдельно: они показывают их собственное отставание
+        self.slow_latency: List[float] = []
+        self.recording = False
+
+class SyntheticClient:
+    def __init__(self, index: int, room: str, codec, stats: Stats, slow_delay: float = 0.0):
+        self.username = f'bench{index}'
+        self.room = room
+        self.codec = codec
+        self.stats = stats
+        self.slow_delay = slow_delay
+        self.reader = None
+        self.writer = None
+        self.joined = asyncio.Event()
+
+    async def connect(self, host: str, port: int):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(JSON_CODEC.encode({
+            'type': 'auth', 'username': self.username, 'codecs': [self.codec.name],
+            'heartbeat': True,
+        }))
+        reply = await JSON_CODEC.read(self.reader)
+        if reply is None or reply['type'] != 'auth_success':
+            raise RuntimeError(f'auth failed for {self.username}: {reply}')
+        self.codec = CODECS[reply.get('codec', 'json')]
+        if self.room != 'general':
+            self.send({'type': 'join_room', 'room': self.room})
+        else:
+            self.joined.set()
+
+    def send(self, message: dict):
+        self.writer.write(self.codec.encode(message))
+
+    async def read_loop(self):
+        stats = self.stats
+        try:
+            while True:
+                message = await self.codec.read(self.reader)
+                if message is None:
+                    break
+                msg_type = message.get('type')
+                if msg_type == 'room_changed':
+                    self.joined.set()
+                    continue
+                text = message.get('message', '')
+                if message.get('is_self') or not text.startswith(MARKER):
+                    continue
+                if stats.recording:
+                    latency = (time.perf_counter_ns() - int(text[len(MARKER):])) / 1e6
+                    stats.delivered += 1
+                    if self.slow_delay:
+                        stats.slow_latency.append(latency)
+                    elif msg_type == 'private_message':
+                        stats.dm_latency.append(latency)
+                    else:
+                        stats.room_latency.append(latency)
+                if self.slow_delay:
+                    await asyncio.sleep(self.slow_delay)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+
+    async def send_loop(self, rate: float, dm_share: float, peers: List['SyntheticClient']):
+        """Отправка сообщений с пуассоновским потоком, пока задачу не отменят"""
+        stats = self.stats
+        # Случайная фаза, чтобы клиенты не отправляли синхронно
+        await asyncio.sleep(random.random() / rate)
+        while True:
+            text = f'{MARKER}{time.perf_counter_ns()}'
+            if random.random() < dm_share:
+                target = random.choice(peers)
+                self.send({'type': 'private_message', 'target': target.username, 'message': text})
+                stats.sent_dm += 1
+            else:
+                self.send({'type': 'message', 'message': text})
+            stats.sent += 1
+            await self.writer.drain()
+            await asyncio.sleep(random.expovariate(rate))
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+async def run_benchmark(scenario: dict) -> dict:
+    scenario = {**DEFAULT_SCENARIO, **scenario}
+    count = scenario['clients']
+    raise_fd_limit(count * 2 + 256)
+    logging.getLogger('ChatServer').setLevel(logging.WARNING)
+
+    # Лимиты сообщений не должны ограничивать измеряемую нагрузку
+    unlimited = (1e9, 1e9)
+    server = ChatServer('127.0.0.1', 0, history_path=':memory:', rate_limits=RateLimits(
+        per_type={'message': unlimited, 'private_message': unlimited}, room_limit=unlimited
+    ))
+    await server.start()
+
+    stats = Stats()
+    codec = CODECS[scenario['codec']]
+    rooms = ['general'] + [f'room{i}' for i in range(1, scenario['rooms'])]
+    slow_count = int(count * scenario['slow_share'])
+    clients = [SyntheticClient(i, rooms[i % len(rooms)], codec, stats,
+                               scenario['slow_delay'] if i < slow_count else 0.0)
+               for i in range(count)]
+
+    rss_before = rss_bytes()
+    connect_started = time.perf_counter()
+    for start in range(0, count, 100):
+        await asyncio.gather(*(c.connect('127.0.0.1', server.port) for c in clients[start:start + 100]))
+    readers = [asyncio.create_task(c.read_loop()) for c in clients]
+    await asyncio.gather(*(c.joined.wait() for c in clients))
+    connect_time = time.perf_counter() - connect_started
+    rss_after = rss_bytes()
+
+    senders = [asyncio.create_task(c.send_loop(scenario['message_rate'], scenario['dm_share'], clients))
+               for c in clients]
+    stats.recording = True
+    started = time.perf_counter()
+    await asyncio.sleep(scenario['duration'])
+    for task in senders:
+        task.cancel()
+    await asyncio.gather(*senders, return_exceptions=True)
+    send_elapsed = time.perf_counter() - started
+    # Даем доставить то, что уже в очередях
+    await asyncio.sleep(1.0)
+    elapsed = time.perf_counter() - started
+    stats.recording = False
+
+    dropped = sum(c.dropped for c in server.clients)
+    for c in clients:
+        c.close()
+    await asyncio.gather(*readers, return_exceptions=True)
+    # Ждем, пока сервер обработает отключения
+    for _ in range(100):
+        if not server.clients:
+            break
+        await asyncio.sleep(0.05)
+    server.server.close()
+    await server.history_store.close()
+    await server.upload_store.close()
+
+    return {
+        'scenario': scenario,
+        'connect_seconds': round(connect_time, 3),
+        'elapsed_seconds': round(elapsed, 3),
+        'messages_sent': stats.sent,
+        'private_messages_sent': stats.sent_dm,
+        'messages_per_second': round(stats.sent / send_elapsed, 1),
+        'deliveries': stats.delivered,
+        'deliveries_per_second': round(stats.delivered / elapsed, 1),
+        'frames_dropped': dropped,
+        # Клиенты работают в том же процессе, поэтому в оценку входят обе стороны подключения
+        'rss_per_connection_bytes': int((rss_after - rss_before) / count),
+        'room_latency_ms': latency_summary(stats.room_latency),
+        'dm_latency_ms': latency_summary(stats.dm_latency),
+        'slow_consumer_latency_ms': latency_summary(stats.slow_latency),
+    }
+
+def print_report(result: Dict):
+    s = result['scenario']
+    print(f"clients={s['clients']} rooms={s['rooms']} rate={s['message_rate']}/s "
+          f"codec={s['codec']} slow={s['slow_share']:.0%}")
+    print(f"  sent: {result['messages_sent']} ({result['messages_per_second']}/s), "
+          f"deliveries: {result['deliveries']} ({result['deliveries_per_second']}/s), "
+          f"dropped: {result['frames_dropped']}")
+    for name in ('room_latency_ms', 'dm_latency_ms', 'slow_consumer_latency_ms'):
+        lat = result[name]
+        print(f"  {name}: p50={lat['p50']} p95={lat['p95']} p99={lat['p99']}")
+    print(f"  rss/connection: {result['rss_per_connection_bytes'] / 1024:.1f} KiB, "
+          f"connect: {result['connect_seconds']} s")
+
+def main():
+    parser = argparse.ArgumentParser(description='Chat server load benchmark')
+    parser.add_argument('--scenario', help='JSON-файл сценария (объект или список объектов)')
+    parser.add_argument('--clients', type=int)
+    parser.add_argument('--rooms', type=int)
+    parser.add_argument('--message-rate', type=float)
+    parser.add_argument('--dm-share', type=float)
+    parser.add_argument('--slow-share', type=float)
+    parser.add_argument('--duration', type=float)
+    parser.add_argument('--codec', choices=sorted(CODECS))
+    parser.add_argument('--output', help='куда записать результаты в JSON')
+    args = parser.parse_args()
+
+    scenarios = [{}]
+    if args.scenario:
+        with open(args.scenario, encoding='utf-8') as f:
+            loaded = json.load(f)
+        scenarios = loaded if isinstance(loaded, list) else [loaded]
+    overrides = {key: value for key, value in vars(args).items()
+                 if key in DEFAULT_SCENARIO and value is not None}
+
+    results = []
+    for scenario in scenarios:
+        result = asyncio.run(run_benchmark({**scenario, **overrides}))
+        print_report(result)
+        results.append(result)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# capture.py
+"""Запись входящего трафика сервера для последующего воспроизведения (replay.py).
+
+Файл - поток gzip из записей: заголовок struct '<IdBI' (номер подключения,
+секунды от начала записи, вид записи, длина данных) и данные. Кадр сохраняется
+как компактный JSON разобранного сообщения, поэтому при воспроизведении его
+можно отправить в любом кодеке, который согласует сервер. Поля с сырыми байтами
+(data в upload_chunk кодека bin1) записываются как {"__bytes__": base64}"""
+import base64
+import gzip
+import json
+import struct
+import time
+from typing import Dict, Iterator, Tuple
+
+CAPTURE_OPEN = 0
+CAPTURE_FRAME = 1
+CAPTURE_CLOSE = 2
+
+RECORD_HEADER = struct.Struct('<IdBI')
+# Как часто сжатые данные сбрасываются на диск: при аварийной остановке
+# сервера теряется не больше этого отрезка записи
+CAPTURE_FLUSH_INTERVAL = 1.0
+# Метка поля с байтами в JSON записи
+BYTES_MARKER = '__bytes__'
+
+def _encode_bytes(value):
+    if isinstance(value, (bytes, bytearray)):
+        return {BYTES_MARKER: base64.b64encode(value).decode('ascii')}
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+def _decode_bytes(obj: dict):
+    if len(obj) == 1 and BYTES_MARKER in obj:
+        return base64.b64decode(obj[BYTES_MARKER])
+    return obj
+
+class CaptureWriter:
+    """Запись кадров всех подключений в один файл.
+    Вызывается из цикла событий; запись буферизуется, сжатие - самое быстрое"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = gzip.open(path, 'wb', compresslevel=1)
+        self.started = time.monotonic()
+        self.flushed = self.started
+        self.next_id = 0
+        self.frames = 0
+
+    def _write(self, conn: int, kind: int, data: bytes = b''):
+        now = time.monotonic()
+        self.file.write(RECORD_HEADER.pack(conn, now - self.started, kind, len(data)))
+        if data:
+            self.file.write(data)
+        if now - self.flushed >= CAPTURE_FLUSH_INTERVAL:
+            self.file.flush()
+            self.flushed = now
+
+    def open_connection(self) -> int:
+        self.next_id += 1
+        self._write(self.next_id, CAPTURE_OPEN)
+        return self.next_id
+
+    def record(self, conn: int, message: dict):
+        self._write(conn, CAPTURE_FRAME,
+                    json.dumps(message, ensure_ascii=False, separators=(',', ':'),
+                               default=_encode_bytes).encode())
+        self.frames += 1
+
+    def close_connection(self, conn: int):
+        self._write(conn, CAPTURE_CLOSE)
+
+    def close(self):
+        self.file.close()
+
+def read_capture(path: str) -> Iterator[Tuple[int, float, int, dict]]:
+    """Записи файла: (подключение, время, вид, сообщение или None).
+    Файл, оборванный при аварийной остановке сервера, читается до обрыва"""
+    with gzip.open(path, 'rb') as f:
+        while True:
+            try:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return
+                conn, at, kind, length = RECORD_HEADER.unpack(header)
+                data = f.read(length) if length else b''
+            except EOFError:
+                return
+            if len(data) < length:
+                return
+            yield conn, at, kind, json.loads(data, object_hook=_decode_bytes) if kind == CAPTURE_FRAME else None
+
+def load_connections(path: str) -> Dict[int, dict]:
+    """Подключения записи: номер -> {'opened', 'closed', 'frames': [(время, сообщение)]}"""
+    connections: Dict[int, dict] = {}
+    for conn, at, kind, message in read_capture(path):
+        if kind == CAPTURE_OPEN:
+            connections[conn] = {'opened': at, 'closed': None, 'frames': []}
+        elif conn in connections:
+            if kind == CAPTURE_FRAME:
+                connections[conn]['frames'].append((at, message))
+            else:
+                connections[conn]['closed'] = at
+    return connections
@@ -1,11 +1,35 @@
 # client_gui_fixed.py
 import asyncio
-import json
 import tkinter as tk
-from tkinter import ttk, scrolledtext, filedialog, messagebox
+from tkinter import ttk, scrolledtext, filedialog, messagebox, simpledialog
 import threading
 import base64
+import hashlib
 import os
+import queue
+import uuid
+from collections import deque
+from datetime import datetime
+
+from protocol import BINARY_CODEC, JSON_CODEC, CODECS
+
+# Размер куска при потоковой загрузке (сервер может попросить меньше в upload_ready)
+UPLOAD_CHUNK_SIZE = 32 * 1024
+# Комнат на одной странице каталога
+ROOM_PAGE_SIZE = 30
+# Результатов поиска на одной странице
+SEARCH_PAGE_SIZE = 20
+# Размер чтения при скачивании файла по отдельному подключению
+DOWNLOAD_READ_SIZE = 256 * 1024
+# Интервал отрисовки входящих сообщений (мс) и предел сообщений за один тик
+RENDER_INTERVAL_MS = 16
+MAX_FRAMES_PER_TICK = 2000
+# Строк в окне чата; более ранние выгружаются и подгружаются кнопкой Earlier Messages
+MAX_SCROLLBACK_LINES = 5000
+# Переподключение после обрыва: начальная и наибольшая пауза, число попыток
+RECONNECT_DELAY = 1.0
+RECONNECT_MAX_DELAY = 15.0
+RECONNECT_ATTEMPTS = 10
 
 class ChatClientGUI:
     def __init__(self):
@@ -14,6 +38,32 @@ class ChatClientGUI:
         self.authenticated = False
         self.username = None
         self.current_room = "general"
+        # upload_id -> future, ожидающий upload_ready/upload_error от сервера
+        self.pending_uploads = {}
+        # download_id -> future, ожидающий download_ready/download_error
+        self.pending_downloads = {}
+        # Адрес сервера (для подключений скачивания) и последний объявленный файл
+        self.server_address = None
+        self.last_file = None
+        # id самого раннего показанного сообщения комнаты (для подгрузки истории)
+        self.oldest_id = None
+        # Кодек кадров: до ответа на auth - JSON, затем согласованный с сервером
+        self.codec = JSON_CODEC
+        # Токен сессии и id последнего полученного сообщения комнаты:
+        # с ними после обрыва связи сервер досылает только пропущенное
+        self.session = None
+        self.last_seq = None
+        # Токен последней сессии: повторный вход под тем же именем продолжает ее,
+        # пока сервер держит имя за ней
+        self.last_session = None
+        # Кадры от потока asyncio; интерфейс разбирает их раз в тик
+        self.inbox = queue.SimpleQueue()
+        # Отрисовка пачкой: пары (текст, тег) для одной вставки и записи [строк, id]
+        self.render_segments = []
+        self.render_entries = []
+        # Показанные записи чата (для выгрузки старых строк) и число строк в окне
+        self.chat_entries = deque()
+        self.chat_lines = 0
         
         self.setup_gui()
         self.async_loop = asyncio.new_event_loop()
@@ -100,6 +150,18 @@ class ChatClientGUI:
                                       command=self.upload_file)
         self.upload_button.pack(side=tk.LEFT, padx=5)
         
+        self.download_button = ttk.Button(top_frame, text="Download File", 
+                                        command=self.download_file)
+        self.download_button.pack(side=tk.LEFT, padx=5)
+        
+        self.history_button = ttk.Button(top_frame, text="Earlier Messages", 
+                                       command=self.fetch_history)
+        self.history_button.pack(side=tk.LEFT, padx=5)
+        
+        self.search_button = ttk.Button(top_frame, text="Search", 
+                                      command=self.search_history)
+        self.search_button.pack(side=tk.LEFT, padx=5)
+        
         # Информация о пользователе и комнате
         info_frame = ttk.Frame(top_frame)
         info_frame.pack(side=tk.RIGHT)
@@ -192,21 +254,50 @@ class ChatClientGUI:
     async def async_connect(self, host, port, username):
         """Асинхронное подключение к серверу"""
         try:
-            self.reader, self.writer = await asyncio.open_connection(host, port)
-            
-            # Отправляем аутентификацию
-            auth_message = {
-                'type': 'auth',
-                'username': username
-            }
-            await self.send_message_to_server(auth_message)
-            
-            # Запускаем прием сообщений
-            asyncio.create_task(self.receive_messages())
+            self.session = self.last_session if username == self.username else None
+            self.last_seq = None
+            await self.open_session(host, port, username)
             
         except Exception as e:
             self.root.after(0, lambda: self.show_connection_error(f"Connection error: {str(e)}"))
 
+    async def open_session(self, host, port, username):
+        """Подключение и аутентификация; при известной сессии - ее продолжение"""
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.server_address = (host, port)
+        self.username = username
+        self.codec = JSON_CODEC
+        
+        # Отправляем аутентификацию и предлагаем бинарный кодек
+        auth_message = {
+            'type': 'auth',
+            'username': username,
+            'codecs': [BINARY_CODEC.name, JSON_CODEC.name],
+            'heartbeat': True,
+            'resume': True
+        }
+        if self.session:
+            auth_message.update(session=self.session, room=self.current_room,
+                                last_seq=self.last_seq)
+        await self.send_message_to_server(auth_message)
+        
+        # Запускаем прием сообщений
+        asyncio.create_task(self.receive_messages(self.reader, self.writer))
+
+    async def reconnect(self):
+        """Переподключение с продолжением сессии после обрыва связи"""
+        self.root.after(0, lambda: self.add_to_chat("System", "Connection lost, reconnecting...", system=True))
+        delay = RECONNECT_DELAY
+        for _ in range(RECONNECT_ATTEMPTS):
+            await asyncio.sleep(delay)
+            try:
+                await self.open_session(*self.server_address, self.username)
+                return
+            except OSError:
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+        self.session = None
+        self.root.after(0, self.connection_lost)
+
     def show_connection_error(self, message):
         """Показать ошибку подключения"""
         self.login_status.config(text=message, foreground='red')
@@ -215,34 +306,90 @@ class ChatClientGUI:
     async def send_message_to_server(self, message: dict):
         """Отправка сообщения на сервер"""
         try:
-            data = json.dumps(message).encode() + b'\n'
-            self.writer.write(data)
+            self.writer.write(self.codec.encode(message))
             await self.writer.drain()
         except Exception as e:
             print(f"Error sending message: {e}")
 
-    async def receive_messages(self):
-        """Прием сообщений от сервера"""
+    async def receive_messages(self, reader, writer):
+        """Прием сообщений от сервера по одному подключению"""
         try:
             while True:
-                data = await self.reader.readline()
-                if not data:
+                message = await self.codec.read(reader)
+                if message is None:
                     break
                 
-                message = json.loads(data.decode().strip())
-                self.root.after(0, lambda: self.handle_server_message(message))
+                if message.get('type') == 'ping':
+                    # Проверка активности от сервера, в интерфейс не передаем
+                    if writer is self.writer:
+                        await self.send_message_to_server({'type': 'pong'})
+                    continue
+                msg_type = message.get('type')
+                if msg_type == 'auth_success':
+                    # Переключаемся до чтения следующего кадра
+                    self.codec = CODECS.get(message.get('codec'), JSON_CODEC)
+                    self.session = self.last_session = message.get('session')
+                    if not message.get('resumed'):
+                        self.last_seq = None
+                elif msg_type == 'auth_error' and self.session:
+                    # Продолжить сессию не удалось - возвращаемся к окну входа
+                    self.session = self.last_session = None
+                    writer.close()
+                elif msg_type in ('message', 'file_upload') and message.get('id'):
+                    self.last_seq = message['id']
+                elif msg_type == 'room_changed':
+                    self.last_seq = None
+                elif msg_type == 'resync':
+                    self.last_seq = message['last_seq']
+                self.resolve_pending_upload(message)
+                self.resolve_pending_download(message)
+                self.inbox.put(message)
                 
         except Exception as e:
             print(f"Error receiving messages: {e}")
         finally:
-            self.root.after(0, self.connection_lost)
+            # Конец приема по прежнему подключению ничего не запускает:
+            # переподключение уже открыло текущее
+            if reader is self.reader:
+                if self.session:
+                    asyncio.ensure_future(self.reconnect())
+                else:
+                    self.root.after(0, self.connection_lost)
+
+    def resolve_pending_upload(self, message: dict):
+        """Передача ответа на upload_begin ожидающей загрузке"""
+        if message.get('type') in ('upload_ready', 'upload_error'):
+            future = self.pending_uploads.pop(message.get('upload_id'), None)
+            if future and not future.done():
+                future.set_result(message)
+
+    def resolve_pending_download(self, message: dict):
+        """Передача ответа на download_file ожидающему скачиванию"""
+        if message.get('type') in ('download_ready', 'download_error'):
+            future = self.pending_downloads.pop(message.get('download_id'), None)
+            if future and not future.done():
+                future.set_result(message)
 
     def handle_server_message(self, message: dict):
         """Обработка сообщений от сервера"""
         msg_type = message.get('type')
         
-        if msg_type == 'auth_success':
+        if msg_type in ('message', 'file_upload') and self.oldest_id is None:
+            self.oldest_id = message.get('id')
+        
+        if msg_type == 'auth_success' and self.authenticated:
+            # Переподключение после обрыва связи
+            if message.get('resumed'):
+                self.add_to_chat("System", "Reconnected", system=True)
+            else:
+                self.oldest_id = None
+                self.add_to_chat("System", "Session expired, reconnected as a new session", system=True)
+            self.current_room = message.get('room', self.current_room)
+            self.room_label.config(text=self.current_room)
+        
+        elif msg_type == 'auth_success':
             self.authenticated = True
+            self.current_room = message.get('room', self.current_room)
             self.username = self.username_entry.get().strip()
             self.user_label.config(text=self.username)
             self.room_label.config(text=self.current_room)
@@ -256,9 +403,9 @@ class ChatClientGUI:
         elif msg_type == 'message':
             # Определяем стиль сообщения в зависимости от того, наше оно или чужое
             if message.get('is_self', False):
-                self.add_to_chat("You", message['message'], own_message=True)
+                self.add_to_chat("You", message['message'], own_message=True, message_id=message.get('id'))
             else:
-                self.add_to_chat(message['username'], message['message'])
+                self.add_to_chat(message['username'], message['message'], message_id=message.get('id'))
             
         elif msg_type == 'system':
             self.add_to_chat("System", message['message'], system=True)
@@ -273,50 +420,173 @@ class ChatClientGUI:
                                message['message'], private_in=True)
             
         elif msg_type == 'room_list':
-            rooms = message['rooms']
-            room_list = "\n".join(rooms)
-            messagebox.showinfo("Available Rooms", f"Available rooms:\n{room_list}")
+            room_list = "\n".join(f"{room['name']} ({room['members']})" for room in message['room_info'])
+            if message.get('next_cursor'):
+                # Каталог отдается страницами: предлагаем загрузить следующую
+                if messagebox.askyesno("Available Rooms",
+                                       f"Available rooms:\n{room_list}\n\nShow more?"):
+                    self.list_rooms(message.get('prefix', ''), message['next_cursor'])
+            else:
+                messagebox.showinfo("Available Rooms", f"Available rooms:\n{room_list}")
             
         elif msg_type == 'room_changed':
             self.current_room = message['room']
+            self.oldest_id = None
+            # Строки прежней комнаты остаются на экране, но их id к новой не относятся
+            for entry in self.chat_entries:
+                entry[1] = None
+            for entry in self.render_entries:
+                entry[1] = None
             self.room_label.config(text=self.current_room)
             self.add_to_chat("System", message['message'], system=True)
             
         elif msg_type == 'file_upload':
+            self.last_file = message['filename']
             if message.get('is_self', False):
-                self.add_to_chat("You", f"uploaded file: {message['filename']}", system=True)
+                self.add_to_chat("You", f"uploaded file: {message['filename']}", system=True,
+                                 message_id=message.get('id'))
             else:
                 self.add_to_chat("System", 
                                f"{message['username']} uploaded file: {message['filename']}", 
-                               system=True)
+                               system=True, message_id=message.get('id'))
+        
+        elif msg_type == 'upload_error':
+            messagebox.showerror("Upload Error", message['message'])
+        
+        elif msg_type == 'download_error':
+            messagebox.showerror("Download Error", message['message'])
+        
+        elif msg_type == 'history_page':
+            self.add_history_page(message)
+        
+        elif msg_type == 'search_results':
+            self.show_search_results(message)
+        
+        elif msg_type == 'resync':
+            # Пропущено слишком много: показываем последние сообщения заново
+            self.clear_chat()
+            self.oldest_id = None
+            self.add_to_chat("System", "Missed too many messages, reloading history", system=True)
+            self.fetch_history()
+
+    def drain_inbox(self):
+        """Разбор накопившихся кадров раз в тик и одна вставка в чат на все"""
+        try:
+            for _ in range(MAX_FRAMES_PER_TICK):
+                try:
+                    message = self.inbox.get_nowait()
+                except queue.Empty:
+                    break
+                self.handle_server_message(message)
+            self.render_pending()
+        finally:
+            self.root.after(RENDER_INTERVAL_MS, self.drain_inbox)
 
     def add_to_chat(self, username: str, message: str, system=False, 
-                   own_message=False, private_in=False, private_out=False):
-        """Добавление сообщения в чат с различными стилями"""
-        self.chat_area.config(state=tk.NORMAL)
+                   own_message=False, private_in=False, private_out=False, message_id=None):
+        """Добавление сообщения в чат с различными стилями.
+        Текст копится до конца тика и вставляется одной операцией"""
+        segments = self.render_segments
         
         # Вставляем timestamp
-        from datetime import datetime
         timestamp = datetime.now().strftime("%H:%M:%S")
-        self.chat_area.insert(tk.END, f"[{timestamp}] ", 'timestamp')
+        segments += (f"[{timestamp}] ", 'timestamp')
         
         if system:
-            self.chat_area.insert(tk.END, f"*** {message} ***\n", 'system')
+            segments += (f"*** {message} ***\n", 'system')
         elif own_message:
-            self.chat_area.insert(tk.END, f"{username}: ", 'own_username')
-            self.chat_area.insert(tk.END, f"{message}\n", 'own_message')
+            segments += (f"{username}: ", 'own_username', f"{message}\n", 'own_message')
         elif private_in:
-            self.chat_area.insert(tk.END, f"{username}: ", 'private_in_username')
-            self.chat_area.insert(tk.END, f"{message}\n", 'private_in_message')
+            segments += (f"{username}: ", 'private_in_username', f"{message}\n", 'private_in_message')
         elif private_out:
-            self.chat_area.insert(tk.END, f"{username}: ", 'private_out_username')
-            self.chat_area.insert(tk.END, f"{message}\n", 'private_out_message')
+            segments += (f"{username}: ", 'private_out_username', f"{message}\n", 'private_out_message')
         else:
-            self.chat_area.insert(tk.END, f"{username}: ", 'other_username')
-            self.chat_area.insert(tk.END, f"{message}\n")
-        
+            segments += (f"{username}: ", 'other_username', f"{message}\n", ())
+        self.render_entries.append([message.count('\n') + 1, message_id])
+
+    def render_pending(self):
+        """Вставка накопленных за тик строк и выгрузка лишних сверху"""
+        if not self.render_segments:
+            return
+        area = self.chat_area
+        # Прокручиваем вниз, только если пользователь не листает историю
+        at_bottom = area.yview()[1] >= 1.0
+        area.config(state=tk.NORMAL)
+        area.insert(tk.END, *self.render_segments)
+        self.chat_entries.extend(self.render_entries)
+        self.chat_lines += sum(lines for lines, _ in self.render_entries)
+        self.render_segments = []
+        self.render_entries = []
+        self.trim_scrollback()
+        area.config(state=tk.DISABLED)
+        if at_bottom:
+            area.see(tk.END)
+
+    def trim_scrollback(self):
+        """Удаление самых старых строк сверх MAX_SCROLLBACK_LINES"""
+        excess = self.chat_lines - MAX_SCROLLBACK_LINES
+        if excess <= 0:
+            return
+        removed = 0
+        last_id = None
+        while self.chat_entries and removed < excess:
+            lines, message_id = self.chat_entries.popleft()
+            removed += lines
+            if message_id is not None:
+                last_id = message_id
+        self.chat_area.delete('1.0', f'{removed + 1}.0')
+        self.chat_lines -= removed
+        if last_id is not None:
+            # Выгруженные сообщения снова доступны через Earlier Messages
+            self.oldest_id = next((message_id for _, message_id in self.chat_entries
+                                   if message_id is not None), last_id + 1)
+
+    def clear_chat(self):
+        self.chat_area.config(state=tk.NORMAL)
+        self.chat_area.delete('1.0', tk.END)
+        self.chat_area.config(state=tk.DISABLED)
+        self.chat_entries.clear()
+        self.chat_lines = 0
+        self.render_segments = []
+        self.render_entries = []
+
+    def add_history_page(self, page: dict):
+        """Вставка более ранних сообщений в начало чата"""
+        if page['room'] != self.current_room:
+            return
+        messages = page['messages']
+        if not messages:
+            self.add_to_chat("System", "No earlier messages", system=True)
+            return
+        self.oldest_id = messages[0]['id']
+        
+        # Вся страница вставляется в начало одной операцией
+        segments = []
+        for msg in messages:
+            name_tag = 'own_username' if msg.get('is_self') else 'other_username'
+            segments += (f"[{msg['timestamp'][11:19]}] ", 'timestamp',
+                         f"{msg['username']}: ", name_tag, f"{msg['message']}\n", ())
+        self.chat_area.config(state=tk.NORMAL)
+        self.chat_area.insert('1.0', *segments)
         self.chat_area.config(state=tk.DISABLED)
-        self.chat_area.see(tk.END)
+        for msg in reversed(messages):
+            lines = msg['message'].count('\n') + 1
+            self.chat_entries.appendleft([lines, msg['id']])
+            self.chat_lines += lines
+
+    def fetch_history(self):
+        """Запрос сообщений, предшествующих самому раннему показанному"""
+        if not self.authenticated or self.oldest_id == 1:
+            return
+        asyncio.run_coroutine_threadsafe(
+            self.send_message_to_server({
+                'type': 'fetch_history',
+                'room': self.current_room,
+                'before': self.oldest_id,
+                'limit': 50
+            }),
+            self.async_loop
+        )
 
     def send_message(self):
         """Отправка обычного сообщения"""
@@ -368,16 +638,50 @@ class ChatClientGUI:
                 self.async_loop
             )
 
-    def list_rooms(self):
-        """Запрос списка комнат"""
+    def list_rooms(self, prefix: str = '', cursor=None):
+        """Запрос страницы каталога комнат"""
         if self.authenticated:
             asyncio.run_coroutine_threadsafe(
                 self.send_message_to_server({
-                    'type': 'list_rooms'
+                    'type': 'list_rooms',
+                    'prefix': prefix,
+                    'cursor': cursor,
+                    'limit': ROOM_PAGE_SIZE
                 }),
                 self.async_loop
             )
 
+    def search_history(self, query: str = None, before=None):
+        """Поиск по истории текущей комнаты"""
+        if not self.authenticated:
+            return
+        if query is None:
+            query = simpledialog.askstring("Search", "Search messages:", parent=self.root)
+            if not query:
+                return
+        asyncio.run_coroutine_threadsafe(
+            self.send_message_to_server({
+                'type': 'search_history',
+                'query': query,
+                'room': self.current_room,
+                'before': before,
+                'limit': SEARCH_PAGE_SIZE
+            }),
+            self.async_loop
+        )
+
+    def show_search_results(self, results: dict):
+        """Результаты поиска; при наличии следующей страницы - предложение ее загрузить"""
+        lines = [f"[{m['timestamp'][:16].replace('T', ' ')}] {m['username']}: "
+                 f"{m.get('message') or m.get('filename', '')}" for m in results['messages']]
+        text = "\n".join(lines) or "Nothing found"
+        title = f"Search: {results['query']}"
+        if results.get('next_before'):
+            if messagebox.askyesno(title, f"{text}\n\nShow more?"):
+                self.search_history(results['query'], results['next_before'])
+        else:
+            messagebox.showinfo(title, text)
+
     def upload_file(self):
         """Загрузка файла"""
         if not self.authenticated:
@@ -389,21 +693,138 @@ class ChatClientGUI:
         )
         
         if filename:
+            asyncio.run_coroutine_threadsafe(
+                self.upload_file_chunked(filename),
+                self.async_loop
+            )
+
+    async def upload_file_chunked(self, path: str):
+        """Потоковая загрузка файла: upload_begin, upload_chunk..., upload_commit"""
+        upload_id = uuid.uuid4().hex
+        try:
+            size = os.path.getsize(path)
+            ready = self.async_loop.create_future()
+            self.pending_uploads[upload_id] = ready
+            await self.send_message_to_server({
+                'type': 'upload_begin',
+                'upload_id': upload_id,
+                'filename': os.path.basename(path),
+                'size': size
+            })
+            
+            reply = await ready
+            if reply['type'] != 'upload_ready':
+                return  # ошибку покажет handle_server_message
+            chunk_size = min(UPLOAD_CHUNK_SIZE, reply.get('chunk_size', UPLOAD_CHUNK_SIZE))
+            
+            with open(path, 'rb') as f:
+                seq = 0
+                while True:
+                    # Читаем файл вне event loop, в памяти только один кусок
+                    chunk = await asyncio.to_thread(f.read, chunk_size)
+                    if not chunk:
+                        break
+                    if self.codec is JSON_CODEC:
+                        chunk = base64.b64encode(chunk).decode()
+                    await self.send_message_to_server({
+                        'type': 'upload_chunk',
+                        'upload_id': upload_id,
+                        'seq': seq,
+                        'data': chunk
+                    })
+                    seq += 1
+            
+            await self.send_message_to_server({
+                'type': 'upload_commit',
+                'upload_id': upload_id
+            })
+            
+        except Exception as e:
+            self.pending_uploads.pop(upload_id, None)
+            await self.send_message_to_server({
+                'type': 'upload_abort',
+                'upload_id': upload_id
+            })
+            self.root.after(0, lambda err=e: messagebox.showerror("Upload Error", f"Error uploading file: {err}"))
+
+    def download_file(self):
+        """Скачивание загруженного в чат файла"""
+        if not self.authenticated:
+            return
+        
+        name = simpledialog.askstring("Download File", "File name:",
+                                      initialvalue=self.last_file or '', parent=self.root)
+        if not name:
+            return
+        path = filedialog.asksaveasfilename(title="Save file as", initialfile=name)
+        if path:
+            asyncio.run_coroutine_threadsafe(
+                self.download_file_async(name, path),
+                self.async_loop
+            )
+
+    async def download_file_async(self, name: str, path: str):
+        """Запрос токена в чате и прием файла по отдельному подключению.
+        Недокачанный файл остается в path.part, следующая попытка продолжает с его конца"""
+        download_id = uuid.uuid4().hex
+        try:
+            ready = self.async_loop.create_future()
+            self.pending_downloads[download_id] = ready
+            await self.send_message_to_server({
+                'type': 'download_file',
+                'download_id': download_id,
+                'filename': name
+            })
+            reply = await ready
+            if reply['type'] != 'download_ready':
+                return  # ошибку покажет handle_server_message
+            
+            part_path = path + '.part'
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            if offset > reply['size']:
+                offset = 0
+            
+            reader, writer = await asyncio.open_connection(*self.server_address)
             try:
-                with open(filename, 'rb') as f:
-                    file_data = base64.b64encode(f.read()).decode()
-                
-                asyncio.run_coroutine_threadsafe(
-                    self.send_message_to_server({
-                        'type': 'upload_file',
-                        'filename': os.path.basename(filename),
-                        'data': file_data
-                    }),
-                    self.async_loop
-                )
+                writer.write(JSON_CODEC.encode({
+                    'type': 'transfer',
+                    'token': reply['token'],
+                    'offset': offset
+                }))
+                header = await JSON_CODEC.read(reader)
+                if header is None or header['type'] != 'transfer_start':
+                    raise ConnectionError(header['message'] if header else 'connection closed')
                 
-            except Exception as e:
-                messagebox.showerror("Upload Error", f"Error uploading file: {e}")
+                with open(part_path, 'ab' if offset else 'wb') as f:
+                    remaining = header['length']
+                    while remaining:
+                        data = await reader.read(min(DOWNLOAD_READ_SIZE, remaining))
+                        if not data:
+                            raise ConnectionError('transfer interrupted')
+                        await asyncio.to_thread(f.write, data)
+                        remaining -= len(data)
+            finally:
+                writer.close()
+            
+            # content_id - SHA-256 содержимого, им же проверяем целостность
+            digest = await asyncio.to_thread(self.file_digest, part_path)
+            if digest != reply['content_id']:
+                os.remove(part_path)
+                raise ValueError('checksum mismatch')
+            os.replace(part_path, path)
+            self.root.after(0, lambda: self.add_to_chat("System", f"Downloaded {name}", system=True))
+            
+        except Exception as e:
+            self.pending_downloads.pop(download_id, None)
+            self.root.after(0, lambda err=e: messagebox.showerror("Download Error", f"Error downloading file: {err}"))
+
+    @staticmethod
+    def file_digest(path: str) -> str:
+        hasher = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                hasher.update(block)
+        return hasher.hexdigest()
 
     def connection_lost(self):
         """Обработка потери соединения"""
@@ -431,6 +852,7 @@ class ChatClientGUI:
         self.chat_area.tag_config('private_out_username', foreground='dark magenta', font=('Arial', 10, 'bold'))
         self.chat_area.tag_config('private_out_message', foreground='magenta')
         
+        self.root.after(RENDER_INTERVAL_MS, self.drain_inbox)
         self.root.mainloop()
         
         # Очистка при закрытии
@@ -0,0 +1,288 @@
+# cluster.py
+import asyncio
+import itertools
+import json
+import logging
+import time
+from collections import defaultdict, deque
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from history_store import HistoryStore
+from room_directory import RoomDirectory
+from sessions import SESSION_TTL, SessionRegistry
+
+logger = logging.getLogger('ChatCluster')
+
+# Внутренние сообщения шины бывают крупными (снимок истории комнаты)
+BUS_LINE_LIMIT = 16 * 1024 * 1024
+BROKER_HISTORY_SIZE = 100
+# Комната без подписанных воркеров выгружается с брокера через это время
+BROKER_ROOM_TTL = 300.0
+
+def encode_event(event: dict) -> bytes:
+    return json.dumps(event).encode() + b'\n'
+
+class BrokerRoom:
+    """Состояние комнаты на брокере: сквозная нумерация и хвост истории"""
+    def __init__(self, name: str, max_history: int = BROKER_HISTORY_SIZE):
+        self.name = name
+        self.last_seq = 0
+        self.history = deque(maxlen=max_history)
+        self.workers: Set['WorkerLink'] = set()
+        self.load_task: Optional[asyncio.Task] = None
+        self.empty_since: Optional[float] = time.monotonic()
+
+class WorkerLink:
+    """Подключение воркера к брокеру"""
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        # Участники комнат на этом воркере (для каталога)
+        self.members: Dict[str, int] = defaultdict(int)
+
+    def send(self, event: dict):
+        # Воркеры - локальные процессы, поэтому drain не ждем
+        self.writer.write(encode_event(event))
+
+class Broker:
+    """Локальная шина кластера поверх unix-сокета.
+
+    Брокер хранит глобальный реестр имен и сессий, назначает номера сообщениям комнат,
+    единственным пишет журнал истории и рассылает сообщения тем воркерам,
+    у которых есть участники комнаты"""
+
+    def __init__(self, path: str, history_path: str = 'history.db', room_ttl: float = BROKER_ROOM_TTL,
+                 session_ttl: float = SESSION_TTL):
+        self.path = path
+        self.store = HistoryStore(history_path)
+        self.rooms: Dict[str, BrokerRoom] = {}
+        # Общий для кластера каталог комнат с числом участников
+        self.directory = RoomDirectory()
+        self.room_ttl = room_ttl
+        # Имена пользователей: владелец - воркер, на котором подключен клиент
+        self.sessions = SessionRegistry()
+        self.session_ttl = session_ttl
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        await self.store.open()
+        self.server = await asyncio.start_unix_server(
+            self.handle_worker, path=self.path, limit=BUS_LINE_LIMIT
+        )
+        logger.info(f"Cluster bus listening on {self.path}")
+
+    async def serve_forever(self):
+        sweeper = asyncio.create_task(self.evict_idle_rooms()) if self.room_ttl else None
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            if sweeper:
+                sweeper.cancel()
+            await self.store.close()
+
+    async def open_room(self, name: str) -> BrokerRoom:
+        while True:
+            room = self.rooms.get(name)
+            if room is None:
+                room = self.rooms[name] = BrokerRoom(name)
+                room.load_task = asyncio.ensure_future(self.load_room(room))
+                self.directory.add(name)
+            await room.load_task
+            if self.rooms.get(name) is room:
+                return room
+
+    async def evict_idle_rooms(self):
+        """Выгрузка комнат, на которые давно не подписан ни один воркер"""
+        while True:
+            await asyncio.sleep(min(30.0, self.room_ttl))
+            deadline = time.monotonic() - self.room_ttl
+            for room in list(self.rooms.values()):
+                if (not room.workers and room.load_task.done()
+                        and room.empty_since is not None and room.empty_since <= deadline):
+                    del self.rooms[room.name]
+                    self.directory.remove(room.name)
+            self.store.flush()
+            self.sessions.purge()
+
+    def detach(self, room: BrokerRoom, link: WorkerLink):
+        room.workers.discard(link)
+        if not room.workers:
+            room.empty_since = time.monotonic()
+
+    async def load_room(self, room: BrokerRoom):
+        room.last_seq = await self.store.last_seq(room.name)
+        room.history.extend(await self.store.page(room.name, None, room.history.maxlen))
+
+    async def handle_worker(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        link = WorkerLink(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                await self.dispatch(link, json.loads(line))
+        except Exception as e:
+            logger.error(f"Error handling cluster worker: {e}")
+        finally:
+            # Освобождаем имена и подписки отключившегося воркера. Сессии его клиентов
+            # сохраняются: клиенты могут переподключиться к другому воркеру
+            for name in self.sessions.owned_by(link):
+                self.sessions.release(name, link, self.session_ttl)
+            for room in self.rooms.values():
+                if link in room.workers:
+                    self.detach(room, link)
+            for name, count in link.members.items():
+                if name in self.directory.members:
+                    self.directory.change(name, -count)
+            writer.close()
+
+    async def dispatch(self, link: WorkerLink, event: dict):
+        op = event['op']
+
+        if op == 'claim':
+            ok, resumed, previous = self.sessions.claim(event['username'], event['session'], link)
+            if previous is not None:
+                # Сессию возобновили через другой воркер: он закроет старое подключение
+                previous.send({'op': 'kick', 'username': event['username']})
+            link.send({'op': 'reply', 'req': event['req'], 'ok': ok, 'resumed': resumed})
+
+        elif op == 'release':
+            self.sessions.release(event['username'], link, event.get('ttl', 0))
+
+        elif op == 'subscribe':
+            room = await self.open_room(event['room'])
+            room.workers.add(link)
+            room.empty_since = None
+            # Снимок и последующие deliver идут по одному потоку, поэтому воркер
+            # получает историю без пропусков и повторов
+            link.send({
+                'op': 'room_state',
+                'req': event['req'],
+                'room': room.name,
+                'last_seq': room.last_seq,
+                'history': list(room.history)
+            })
+
+        elif op == 'unsubscribe':
+            room = self.rooms.get(event['room'])
+            if room:
+                self.detach(room, link)
+        
+        elif op == 'presence':
+            # Вход или выход участника комнаты на воркере
+            link.members[event['room']] += event['delta']
+            if event['room'] in self.directory.members:
+                self.directory.change(event['room'], event['delta'])
+
+        elif op == 'publish':
+            room = await self.open_room(event['room'])
+            message = event['message']
+            room.last_seq += 1
+            message['id'] = room.last_seq
+            room.history.append(message)
+            self.store.append(room.name, room.last_seq, message)
+            self.fanout(room, {'op': 'deliver', 'room': room.name,
+                               'message': message, 'sender': event.get('sender')})
+
+        elif op == 'notify':
+            room = await self.open_room(event['room'])
+            self.fanout(room, {'op': 'deliver', 'room': room.name,
+                               'message': event['message'], 'exclude': event.get('exclude')})
+
+        elif op == 'direct':
+            owner = self.sessions.owner(event['target'])
+            if owner:
+                owner.send({'op': 'direct', 'target': event['target'], 'message': event['message']})
+            link.send({'op': 'reply', 'req': event['req'], 'ok': owner is not None})
+
+        elif op == 'list_rooms':
+            rooms, next_cursor = self.directory.page(event['prefix'], event['cursor'], event['limit'])
+            link.send({'op': 'reply', 'req': event['req'], 'rooms': rooms, 'next_cursor': next_cursor})
+
+    def fanout(self, room: BrokerRoom, event: dict):
+        data = encode_event(event)
+        for worker in room.workers:
+            worker.writer.write(data)
+
+class BusClient:
+    """Подключение воркера к брокеру. События от брокера передаются в handler
+    синхронно и в порядке поступления"""
+
+    def __init__(self, path: str, handler: Callable[[dict], None]):
+        self.path = path
+        self.handler = handler
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.requests: Dict[int, asyncio.Future] = {}
+        self.request_ids = itertools.count(1)
+        self.read_task: Optional[asyncio.Task] = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_unix_connection(
+            self.path, limit=BUS_LINE_LIMIT
+        )
+        self.read_task = asyncio.create_task(self.read_loop())
+
+    async def read_loop(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                event = json.loads(line)
+                if event['op'] != 'reply':
+                    self.handler(event)
+                future = self.requests.pop(event.get('req'), None)
+                if future and not future.done():
+                    future.set_result(event)
+        except Exception as e:
+            logger.error(f"Cluster bus error: {e}")
+        finally:
+            for future in self.requests.values():
+                if not future.done():
+                    future.set_exception(ConnectionError('cluster bus closed'))
+            self.handler({'op': 'closed'})
+
+    def send(self, event: dict):
+        self.writer.write(encode_event(event))
+
+    async def request(self, event: dict) -> dict:
+        req = next(self.request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.requests[req] = future
+        self.send({**event, 'req': req})
+        return await future
+
+    async def claim(self, username: str, session: str) -> Tuple[bool, bool]:
+        """(успех, возобновлена ли сессия)"""
+        reply = await self.request({'op': 'claim', 'username': username, 'session': session})
+        return reply['ok'], reply['resumed']
+
+    def release(self, username: str, ttl: float = 0):
+        self.send({'op': 'release', 'username': username, 'ttl': ttl})
+
+    async def subscribe(self, room: str) -> dict:
+        return await self.request({'op': 'subscribe', 'room': room})
+
+    def unsubscribe(self, room: str):
+        self.send({'op': 'unsubscribe', 'room': room})
+
+    def publish(self, room: str, message: dict, sender: Optional[str]):
+        self.send({'op': 'publish', 'room': room, 'message': message, 'sender': sender})
+
+    def notify(self, room: str, message: dict, exclude: Optional[str]):
+        self.send({'op': 'notify', 'room': room, 'message': message, 'exclude': exclude})
+
+    async def direct(self, target: str, message: dict) -> bool:
+        return (await self.request({'op': 'direct', 'target': target, 'message': message}))['ok']
+
+    def presence(self, room: str, delta: int):
+        self.send({'op': 'presence', 'room': room, 'delta': delta})
+
+    async def list_rooms(self, prefix: str, cursor: Optional[str], limit: int) -> Tuple[List[dict], Optional[str]]:
+        reply = await self.request({'op': 'list_rooms', 'prefix': prefix, 'cursor': cursor, 'limit': limit})
+        return reply['rooms'], reply['next_cursor']
+
+    async def close(self):
+        if self.writer:
+            self.writer.close()
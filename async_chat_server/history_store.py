@@ -0,0 +1,215 @@
+# history_store.py
+import asyncio
+import json
+import logging
+import re
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+# Типы сообщений журнала, текст которых попадает в поисковый индекс
+SEARCHABLE_TYPES = ('message', 'file_upload')
+MAX_SEARCH_PAGE = 50
+# Слова запроса: буквы и цифры любого алфавита, '*' в конце - поиск по префиксу
+QUERY_TOKEN = re.compile(r'\w+\*?')
+
+logger = logging.getLogger('ChatHistory')
+
+class HistoryStore:
+    """Журнал сообщений комнат в SQLite (режим WAL).
+
+    Сообщения комнаты нумеруются подряд (seq = 1, 2, ...), номер служит id сообщения.
+    Все обращения к базе выполняются в одном отдельном потоке, поэтому event loop
+    не блокируется, а чтения видят все ранее поставленные записи.
+
+    Для поиска ведется инвертированный индекс FTS5 (токенизатор unicode61:
+    кириллица и латиница без учета регистра и диакритики, ё = е). Индекс
+    пополняется в той же транзакции, что и журнал, поэтому не расходится с ним;
+    в базе без индекса он один раз строится из журнала при открытии"""
+
+    def __init__(self, path: str = 'history.db'):
+        self.path = path
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='history')
+        self.conn: Optional[sqlite3.Connection] = None
+        # Записи, ожидающие пакетной вставки: (room, seq, payload)
+        self.pending: List[Tuple[str, int, str]] = []
+        self.flush_scheduled = False
+
+    async def open(self):
+        await self._run(self._connect)
+
+    def _connect(self):
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                room TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                payload TEXT NOT NULL,
+                PRIMARY KEY (room, seq)
+            ) WITHOUT ROWID
+        """)
+        # Документы индекса: docid растет в порядке записи и служит курсором поиска
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS search_docs (
+                docid INTEGER PRIMARY KEY,
+                room TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                username TEXT,
+                timestamp TEXT,
+                UNIQUE (room, seq)
+            )
+        """)
+        # Индекс без копии текста: текст хранится только в messages
+        self.conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+                text, content='', tokenize='unicode61 remove_diacritics 2'
+            )
+        """)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS search_meta (key TEXT PRIMARY KEY, value)')
+        self.conn.commit()
+        self._build_search_index()
+
+    def _build_search_index(self):
+        """Построение индекса по всему журналу, если его еще нет. Маркер ставится
+        в той же транзакции, поэтому при общем файле строит только один процесс"""
+        with self.conn:
+            marker = self.conn.execute(
+                "INSERT OR IGNORE INTO search_meta (key, value) VALUES ('built', 1)")
+            if marker.rowcount == 0:
+                return
+            rows = self.conn.execute('SELECT room, seq, payload FROM messages')
+            while True:
+                batch = rows.fetchmany(1000)
+                if not batch:
+                    break
+                for room, seq, payload in batch:
+                    self._index(room, seq, json.loads(payload))
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def append(self, room: str, seq: int, message: dict):
+        """Добавление сообщения в журнал. Вставки за один проход event loop
+        собираются в одну транзакцию"""
+        self.pending.append((room, seq, json.dumps(message)))
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self) -> Optional[asyncio.Future]:
+        self.flush_scheduled = False
+        if not self.pending:
+            return None
+        batch, self.pending = self.pending, []
+        future = asyncio.get_running_loop().run_in_executor(self.executor, self._insert, batch)
+        # Результат плановой записи никто не ждет: ошибку (диск заполнен,
+        # база заблокирована) иначе никто бы не увидел
+        future.add_done_callback(lambda f: self._report_failure(f, len(batch)))
+        return future
+
+    @staticmethod
+    def _report_failure(future: asyncio.Future, count: int):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"Failed to write {count} history messages: {future.exception()}")
+
+    def _insert(self, batch: List[Tuple[str, int, str]]):
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO messages (room, seq, payload) VALUES (?, ?, ?)', batch)
+            for room, seq, payload in batch:
+                self._index(room, seq, json.loads(payload))
+
+    def _index(self, room: str, seq: int, message: dict):
+        """Добавление сообщения в поисковый индекс (внутри открытой транзакции)"""
+        if message.get('type', 'message') not in SEARCHABLE_TYPES:
+            return
+        text = ' '.join(str(message[key]) for key in ('message', 'filename') if message.get(key))
+        if not text:
+            return
+        cursor = self.conn.execute(
+            'INSERT OR IGNORE INTO search_docs (room, seq, username, timestamp) VALUES (?, ?, ?, ?)',
+            (room, seq, message.get('username'), message.get('timestamp')))
+        if cursor.rowcount:
+            self.conn.execute('INSERT INTO search_index (rowid, text) VALUES (?, ?)',
+                              (cursor.lastrowid, text))
+
+    async def last_seq(self, room: str) -> int:
+        self.flush()
+        return await self._run(self._last_seq, room)
+
+    def _last_seq(self, room: str) -> int:
+        row = self.conn.execute(
+            'SELECT MAX(seq) FROM messages WHERE room = ?', (room,)).fetchone()
+        return row[0] or 0
+
+    async def page(self, room: str, before: Optional[int] = None, limit: int = 50) -> List[dict]:
+        """Сообщения комнаты с id < before (или последние), от старых к новым"""
+        self.flush()
+        return await self._run(self._page, room, before, limit)
+
+    def _page(self, room: str, before: Optional[int], limit: int) -> List[dict]:
+        if before is None:
+            rows = self.conn.execute(
+                'SELECT payload FROM messages WHERE room = ? ORDER BY seq DESC LIMIT ?',
+                (room, limit)).fetchall()
+        else:
+            rows = self.conn.execute(
+                'SELECT payload FROM messages WHERE room = ? AND seq < ? ORDER BY seq DESC LIMIT ?',
+                (room, before, limit)).fetchall()
+        return [json.loads(payload) for (payload,) in reversed(rows)]
+
+    async def search(self, query: str, room: Optional[str] = None, username: Optional[str] = None,
+                     since: Optional[str] = None, until: Optional[str] = None,
+                     before: Optional[int] = None, limit: int = 20) -> Tuple[List[dict], Optional[int]]:
+        """Поиск сообщений, содержащих все слова запроса, от новых к старым.
+        since/until - границы времени в формате ISO, before - курсор предыдущей
+        страницы. Возвращает (сообщения с полем room, курсор следующей страницы)"""
+        expression = search_expression(query)
+        if expression is None:
+            return [], None
+        self.flush()
+        return await self._run(self._search, expression, room, username, since, until,
+                               before, max(1, min(limit, MAX_SEARCH_PAGE)))
+
+    def _search(self, expression: str, room: Optional[str], username: Optional[str],
+                since: Optional[str], until: Optional[str], before: Optional[int],
+                limit: int) -> Tuple[List[dict], Optional[int]]:
+        conditions = ['search_index MATCH ?']
+        params: list = [expression]
+        for clause, value in (('d.room = ?', room), ('d.username = ?', username),
+                              ('d.timestamp >= ?', since), ('d.timestamp <= ?', until),
+                              ('d.docid < ?', before)):
+            if value is not None:
+                conditions.append(clause)
+                params.append(value)
+        rows = self.conn.execute(f"""
+            SELECT d.docid, d.room, m.payload
+            FROM search_index
+            JOIN search_docs d ON d.docid = search_index.rowid
+            JOIN messages m ON m.room = d.room AND m.seq = d.seq
+            WHERE {' AND '.join(conditions)}
+            ORDER BY d.docid DESC LIMIT ?
+        """, (*params, limit + 1)).fetchall()
+        results = [dict(json.loads(payload), room=room_name) for _, room_name, payload in rows[:limit]]
+        next_before = rows[limit - 1][0] if len(rows) > limit else None
+        return results, next_before
+
+    async def close(self):
+        pending = self.flush()
+        if pending is not None:
+            # Ошибку записи уже залогировал _report_failure
+            await asyncio.gather(pending, return_exceptions=True)
+        if self.conn is not None:
+            await self._run(self.conn.close)
+        self.executor.shutdown(wait=True)
+
+def search_expression(query: str) -> Optional[str]:
+    """Запрос пользователя -> выражение FTS5: все слова обязательны,
+    каждое в кавычках, поэтому синтаксис FTS5 во вводе не действует"""
+    terms = []
+    for token in QUERY_TOKEN.findall(query or ''):
+        word = token.rstrip('*')
+        terms.append(f'"{word}"*' if token.endswith('*') else f'"{word}"')
+    return ' AND '.join(terms) or None
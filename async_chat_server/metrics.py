@@ -0,0 +1,189 @@
+# metrics.py
+"""Метрики сервера в формате Prometheus (text exposition 0.0.4).
+
+Счетчики и гистограммы обновляются на горячем пути, поэтому сделаны
+максимально дешевыми: обычное прибавление к атрибуту. Значения, которые
+легко посчитать по состоянию сервера (число подключений, участники комнат),
+снимаются функцией-коллектором только в момент запроса метрик"""
+import asyncio
+import logging
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger('ChatMetrics')
+
+# Границы корзин гистограмм длительности, секунды
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# Границы корзин числа кадров в одной записи в сокет
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ''
+    pairs = ','.join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+    return '{' + pairs + '}'
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.value = 0.0
+        self.children: Dict[Tuple[str, ...], 'Counter'] = {}
+
+    def labels(self, *values: str) -> 'Counter':
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = Counter(self.name, self.help)
+        return child
+
+    def inc(self, amount: float = 1.0):
+        self.value += amount
+
+    def samples(self) -> Iterable[Tuple[str, str, float]]:
+        if not self.labelnames:
+            yield self.name, '', self.value
+        for values, child in self.children.items():
+            yield self.name, _format_labels(self.labelnames, values), child.value
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self) -> Iterable[Tuple[str, str, float]]:
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{self.name}_bucket', f'{{le="{bound}"}}', cumulative
+        yield f'{self.name}_bucket', '{le="+Inf"}', self.count
+        yield f'{self.name}_sum', '', self.sum
+        yield f'{self.name}_count', '', self.count
+
+class GaugeCollector:
+    """Датчик, значения которого вычисляются функцией при каждом запросе метрик"""
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, collect: Callable[[], Iterable[Tuple[tuple, float]]],
+                 labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.labelnames = labelnames
+
+    def samples(self) -> Iterable[Tuple[str, str, float]]:
+        for values, value in self.collect():
+            yield self.name, _format_labels(self.labelnames, values), value
+
+class Registry:
+    def __init__(self):
+        self.metrics: List = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, buckets))
+
+    def gauge(self, name: str, help: str, collect, labelnames: Tuple[str, ...] = ()) -> GaugeCollector:
+        return self.register(GaugeCollector(name, help, collect, labelnames))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self) -> Dict[str, float]:
+        """Те же значения в виде словаря (для сообщения stats)"""
+        return {f'{name}{labels}': value
+                for metric in self.metrics for name, labels, value in metric.samples()}
+
+async def serve_metrics(registry: Registry, host: str, port: int) -> asyncio.AbstractServer:
+    """Минимальный HTTP-сервер: GET /metrics отдает метрики в формате Prometheus"""
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            # Заголовки запроса не нужны, дочитываем их до пустой строки
+            while (await reader.readline()).strip():
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', registry.render().encode()
+            else:
+                status, body = '404 Not Found', b'not found\n'
+            writer.write(
+                f'HTTP/1.1 {status}\r\n'
+                f'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                f'Connection: close\r\n\r\n'.encode() + body
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.error(f"Error serving metrics: {e}")
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    port = server.sockets[0].getsockname()[1]
+    logger.info(f"Metrics endpoint on http://{host}:{port}/metrics")
+    return server
+
+class ServerMetrics:
+    """Набор метрик чат-сервера"""
+    def __init__(self, registry: Optional[Registry] = None):
+        self.registry = registry or Registry()
+        r = self.registry
+        self.connections = r.counter('chat_connections_total', 'Accepted TCP connections')
+        self.auth = r.counter('chat_auth_total', 'Authentication attempts', ('result',))
+        self.resyncs = r.counter('chat_session_resyncs_total',
+                                 'Resumed sessions too far behind to replay the gap')
+        self.messages_in = r.counter('chat_messages_received_total', 'Inbound frames by type', ('type',))
+        self.bytes_in = r.counter('chat_bytes_received_total', 'Inbound frame bytes')
+        self.bytes_out = r.counter('chat_bytes_sent_total', 'Outbound bytes written to sockets')
+        self.download_bytes = r.counter('chat_download_bytes_total', 'File bytes sent with sendfile')
+        self.decode_errors = r.counter('chat_decode_errors_total', 'Frames that failed to decode')
+        self.oversized_frames = r.counter('chat_oversized_frames_total',
+                                          'Frames rejected by size before decoding')
+        self.rate_limited = r.counter('chat_rate_limited_total', 'Inbound frames rejected by rate limits',
+                                      ('scope', 'type'))
+        self.read_throttled = r.counter('chat_read_throttled_total',
+                                        'Reads delayed by the per-connection byte limit')
+        self.abuse_disconnects = r.counter('chat_abuse_disconnects_total',
+                                           'Clients disconnected for repeated limit violations')
+        self.idle_disconnects = r.counter('chat_idle_disconnects_total',
+                                          'Clients disconnected after missing heartbeats')
+        self.frames_dropped = r.counter('chat_frames_dropped_total', 'Frames dropped by overflow policy')
+        self.slow_disconnects = r.counter('chat_slow_consumer_disconnects_total',
+                                          'Clients disconnected on send queue overflow')
+        self.rooms_evicted = r.counter('chat_rooms_evicted_total', 'Empty rooms unloaded after the TTL')
+        self.broadcast_seconds = r.histogram('chat_broadcast_seconds', 'Room fanout duration')
+        self.ingress_wait_seconds = r.histogram('chat_room_ingress_wait_seconds',
+                                                'Time a frame waits in its room ingress queue')
+        self.drain_seconds = r.histogram('chat_drain_wait_seconds', 'Time spent awaiting writer.drain()')
+        self.write_batch_frames = r.histogram('chat_write_batch_frames', 'Frames sent per socket write',
+                                              BATCH_BUCKETS)
@@ -0,0 +1,205 @@
+# protocol.py
+"""Кодеки кадров чата.
+
+json - исходный протокол: один JSON-объект на строку.
+bin1 - кадр с 4-байтовой длиной (big-endian), затем тело: байт типа сообщения
+и поля по фиксированной схеме. Сообщения, не подходящие под схему,
+передаются внутри бинарного кадра как JSON (тип 0).
+Кодек согласуется при auth: клиент перечисляет поддерживаемые в поле codecs,
+сервер отвечает выбранным в auth_success и после этого обе стороны переключаются"""
+import asyncio
+import json
+import struct
+from typing import Dict, List, Optional, Tuple
+
+MAX_FRAME_SIZE = 1024 * 1024
+
+class FrameTooLarge(ValueError):
+    """Кадр превышает допустимый размер; отклоняется до разбора"""
+
+# Виды полей: s - строка, i - целое, b - флаг, y - сырые байты
+SCHEMAS: Dict[int, Tuple[str, Tuple[Tuple[str, str], ...]]] = {
+    1: ('message', (('message', 's'), ('username', 's'), ('timestamp', 's'),
+                    ('is_self', 'b'), ('id', 'i'))),
+    2: ('private_message', (('message', 's'), ('username', 's'), ('target', 's'),
+                            ('timestamp', 's'), ('is_self', 'b'))),
+    3: ('system', (('message', 's'), ('username', 's'), ('timestamp', 's'))),
+    # content_id и size добавлены в конец схемы: прежние декодеры их просто не читают
+    4: ('file_upload', (('filename', 's'), ('username', 's'), ('message', 's'),
+                        ('timestamp', 's'), ('is_self', 'b'), ('id', 'i'),
+                        ('content_id', 's'), ('size', 'i'))),
+    5: ('upload_chunk', (('upload_id', 's'), ('seq', 'i'), ('data', 'y'))),
+    6: ('join_room', (('room', 's'),)),
+    7: ('room_changed', (('room', 's'), ('message', 's'))),
+}
+TYPE_CODES = {name: (code, fields, dict(fields)) for code, (name, fields) in SCHEMAS.items()}
+_FIELD_TYPES = {'s': str, 'i': int, 'b': bool, 'y': bytes}
+_LENGTH = struct.Struct('>I')
+
+def _write_varint(out: bytearray, value: int):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+def _read_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+class JsonLinesCodec:
+    name = 'json'
+
+    def encode(self, message: dict) -> bytes:
+        return json.dumps(message).encode() + b'\n'
+
+    async def read_frame(self, reader: asyncio.StreamReader,
+                         max_size: int = MAX_FRAME_SIZE) -> Optional[bytes]:
+        """Сырой кадр без разбора (None - соединение закрыто).
+        Строка длиннее лимита StreamReader отклоняется, не дочитываясь целиком"""
+        try:
+            data = await reader.readline()
+        except ValueError as e:
+            raise FrameTooLarge(str(e))
+        if len(data) > max_size:
+            raise FrameTooLarge(f'frame size {len(data)} exceeds {max_size}')
+        return data or None
+
+    def decode(self, frame: bytes) -> dict:
+        return json.loads(frame)
+
+    async def read(self, reader: asyncio.StreamReader) -> Optional[dict]:
+        frame = await self.read_frame(reader)
+        return None if frame is None else self.decode(frame)
+
+class BinaryCodec:
+    name = 'bin1'
+
+    def encode(self, message: dict) -> bytes:
+        body = self.encode_body(message)
+        return _LENGTH.pack(len(body)) + body
+
+    def encode_body(self, message: dict) -> bytes:
+        known = TYPE_CODES.get(message.get('type'))
+        if known is None or not self._fits(message, known[2]):
+            return b'\x00' + json.dumps(message).encode()
+
+        code, fields, _ = known
+        out = bytearray((code, 0))
+        present = 0
+        for index, (name, kind) in enumerate(fields):
+            value = message.get(name)
+            if value is None:
+                continue
+            present |= 1 << index
+            if kind == 's':
+                raw = value.encode()
+                _write_varint(out, len(raw))
+                out += raw
+            elif kind == 'y':
+                _write_varint(out, len(value))
+                out += value
+            elif kind == 'i':
+                _write_varint(out, value)
+            else:
+                out.append(1 if value else 0)
+        out[1] = present
+        return bytes(out)
+
+    @staticmethod
+    def _fits(message: dict, kinds: Dict[str, str]) -> bool:
+        """Сообщение кодируется схемой, если в нем нет лишних ключей и типы совпадают"""
+        for key, value in message.items():
+            if key == 'type' or value is None:
+                continue
+            kind = kinds.get(key)
+            if kind is None or type(value) is not _FIELD_TYPES[kind] or (kind == 'i' and value < 0):
+                return False
+        return True
+
+    def decode_body(self, body: bytes) -> dict:
+        if body[0] == 0:
+            return json.loads(body[1:])
+
+        name, fields = SCHEMAS[body[0]]
+        present = body[1]
+        message = {'type': name}
+        pos = 2
+        for index, (field, kind) in enumerate(fields):
+            if not present & (1 << index):
+                continue
+            if kind in 'sy':
+                length, pos = _read_varint(body, pos)
+                raw = body[pos:pos + length]
+                pos += length
+                message[field] = raw.decode() if kind == 's' else raw
+            elif kind == 'i':
+                message[field], pos = _read_varint(body, pos)
+            else:
+                message[field] = body[pos] == 1
+                pos += 1
+        return message
+
+    async def read_frame(self, reader: asyncio.StreamReader,
+                         max_size: int = MAX_FRAME_SIZE) -> Optional[bytes]:
+        """Тело кадра без заголовка длины (None - соединение закрыто).
+        Размер проверяется по заголовку, до чтения тела"""
+        try:
+            header = await reader.readexactly(_LENGTH.size)
+        except asyncio.IncompleteReadError:
+            return None
+        (length,) = _LENGTH.unpack(header)
+        if length > max_size:
+            raise FrameTooLarge(f'frame size {length} exceeds {max_size}')
+        if length == 0:
+            raise ValueError('empty frame')
+        return await reader.readexactly(length)
+
+    def decode(self, frame: bytes) -> dict:
+        return self.decode_body(frame)
+
+    async def read(self, reader: asyncio.StreamReader) -> Optional[dict]:
+        frame = await self.read_frame(reader)
+        return None if frame is None else self.decode(frame)
+
+JSON_CODEC = JsonLinesCodec()
+BINARY_CODEC = BinaryCodec()
+CODECS = {codec.name: codec for codec in (BINARY_CODEC, JSON_CODEC)}
+
+def negotiate(offered: Optional[List[str]]):
+    """Выбор кодека из предложенных клиентом (в порядке предпочтения клиента)"""
+    for name in offered or ():
+        if name in CODECS:
+            return CODECS[name]
+    return JSON_CODEC
+
+def _benchmark(rounds: int = 200000):
+    """Сравнение стоимости кодирования и разбора типичного сообщения чата"""
+    import time
+    message = {'type': 'message', 'message': 'Привет, как дела? ' * 3, 'username': 'alice',
+               'timestamp': '2025-01-01T12:00:00.000000', 'is_self': False, 'id': 123456}
+    for codec in (JSON_CODEC, BINARY_CODEC):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            data = codec.encode(message)
+        encode_time = time.perf_counter() - start
+
+        if codec is JSON_CODEC:
+            decode = lambda d: json.loads(d)
+        else:
+            decode = lambda d: codec.decode_body(d[_LENGTH.size:])
+        start = time.perf_counter()
+        for _ in range(rounds):
+            decode(data)
+        decode_time = time.perf_counter() - start
+
+        print(f"{codec.name:>5}: {len(data)} bytes/frame, "
+              f"encode {encode_time / rounds * 1e6:.2f} us, decode {decode_time / rounds * 1e6:.2f} us")
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,80 @@
+# ratelimit.py
+import time
+from typing import Dict, Optional, Tuple
+
+# (скорость в секунду, емкость корзины)
+Limit = Tuple[float, float]
+
+class TokenBucket:
+    """Корзина токенов: пополняется со скоростью rate, вмещает не больше capacity"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, amount: float = 1.0) -> bool:
+        """Взять токены, если они есть"""
+        self._refill()
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+    def delay(self, amount: float) -> float:
+        """Взять токены в долг; возвращает, сколько секунд нужно подождать,
+        чтобы долг был погашен"""
+        self._refill()
+        self.tokens -= amount
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+class RateLimits:
+    """Настройки ограничений входящего трафика.
+
+    per_type - лимиты сообщений каждого типа на одно подключение
+    (остальные типы - default_limit); room_limit - общий лимит сообщений
+    в комнату; connection_bytes - поток байт от одного подключения (при превышении
+    чтение притормаживается); abuse_limit - сколько отказов подряд терпим до
+    отключения клиента; max_frame_size - кадры больше отклоняются до разбора"""
+
+    def __init__(self,
+                 per_type: Optional[Dict[str, Limit]] = None,
+                 default_limit: Limit = (10, 20),
+                 room_limit: Limit = (100, 200),
+                 connection_bytes: Limit = (4 * 1024 * 1024, 8 * 1024 * 1024),
+                 abuse_limit: Limit = (1, 20),
+                 max_frame_size: int = 64 * 1024):
+        self.per_type = {
+            'message': (5, 10),
+            'private_message': (5, 10),
+            'join_room': (1, 5),
+            'list_rooms': (1, 5),
+            'fetch_history': (2, 10),
+            'search_history': (1, 5),
+            'upload_chunk': (200, 400),
+            **(per_type or {}),
+        }
+        self.default_limit = default_limit
+        self.room_limit = room_limit
+        self.connection_bytes = connection_bytes
+        self.abuse_limit = abuse_limit
+        self.max_frame_size = max_frame_size
+
+    def type_bucket(self, msg_type: str) -> TokenBucket:
+        return TokenBucket(*self.per_type.get(msg_type, self.default_limit))
+
+    def room_bucket(self) -> TokenBucket:
+        return TokenBucket(*self.room_limit)
+
+    def connection_bucket(self) -> TokenBucket:
+        return TokenBucket(*self.connection_bytes)
+
+    def abuse_bucket(self) -> TokenBucket:
+        return TokenBucket(*self.abuse_limit)
@@ -0,0 +1,272 @@
+# replay.py
+"""Воспроизведение трафика, записанного сервером (server.py --capture).
+
+Каждое записанное подключение открывается заново и отправляет свои кадры
+в исходном порядке и с исходными паузами, деленными на --speed (0 или max -
+без пауз, насколько быстро примет сервер). Порядок кадров внутри подключения
+сохраняется всегда: следующий кадр отправляется после предыдущего, а после auth -
+только когда пришел ответ и согласован кодек.
+
+Задержка - время от отправки запроса до ответа на него (для message -
+до возврата собственного сообщения), по типам запросов. При нескольких --target
+запись воспроизводится на каждом сервере по очереди, и отчет сравнивает
+их с первым: так сравниваются две сборки сервера на одной нагрузке.
+
+Имена клиентов, которые при записи просили продолжаемую сессию (resume
+или токен session), после воспроизведения остаются занятыми на время жизни
+сессий: такие записи лучше воспроизводить на свежем сервере.
+
+Примеры:
+    python replay.py traffic.cap --target localhost:8888 --speed 10
+    python replay.py traffic.cap --target localhost:8888 --target localhost:9999 --speed max
+"""
+import argparse
+import asyncio
+import base64
+import json
+import time
+from collections import defaultdict, deque
+from typing import Dict, List, Optional
+
+from benchmark import latency_summary, raise_fd_limit
+from capture import load_connections
+from protocol import CODECS, JSON_CODEC
+
+# Ответы сервера на запросы каждого типа
+REPLIES = {
+    'auth': ('auth_success', 'auth_error'),
+    'message': ('message',),
+    'private_message': ('private_message',),
+    'join_room': ('room_changed',),
+    'list_rooms': ('room_list',),
+    'fetch_history': ('history_page',),
+    'stats': ('stats',),
+    'ping': ('pong',),
+    'upload_file': ('file_upload',),
+    'upload_begin': ('upload_ready', 'upload_error'),
+    'upload_commit': ('file_upload', 'upload_error'),
+    'download_file': ('download_ready', 'download_error'),
+}
+REQUESTS_BY_REPLY: Dict[str, List[str]] = defaultdict(list)
+for request_type, reply_types in REPLIES.items():
+    for reply_type in reply_types:
+        REQUESTS_BY_REPLY[reply_type].append(request_type)
+# Рассылки, ответом на запрос из которых считается только собственный кадр (is_self)
+BROADCAST_REPLIES = {'message', 'private_message', 'file_upload'}
+
+# Сколько ждать ответов на последние запросы перед закрытием подключения, с
+REPLY_GRACE = 2.0
+AUTH_TIMEOUT = 10.0
+
+def json_safe(message: dict) -> dict:
+    """Байты из записи bin1 для кодека json - в base64, как их отправляет JSON-клиент"""
+    if not any(isinstance(value, bytes) for value in message.values()):
+        return message
+    return {key: base64.b64encode(value).decode('ascii') if isinstance(value, bytes) else value
+            for key, value in message.items()}
+
+class ReplayStats:
+    def __init__(self):
+        self.connections = 0
+        self.connect_errors = 0
+        self.frames_sent = 0
+        self.replies = 0
+        self.deliveries = 0
+        self.errors = 0
+        self.unanswered = 0
+        # Время последнего полученного кадра: ожидание ответов, которые так и не
+        # пришли, в расчет пропускной способности не входит
+        self.last_received = 0.0
+        self.latency: Dict[str, List[float]] = defaultdict(list)
+
+class ReplayConnection:
+    """Одно записанное подключение"""
+
+    def __init__(self, record: dict, stats: ReplayStats, speed: float, origin: float, started: float):
+        self.record = record
+        self.stats = stats
+        self.speed = speed
+        self.origin = origin
+        self.started = started
+        self.reader = None
+        self.writer = None
+        self.codec = JSON_CODEC
+        self.authenticated = asyncio.Event()
+        # Тип запроса -> время отправки запросов, ожидающих ответа
+        self.pending: Dict[str, deque] = defaultdict(deque)
+
+    async def wait_until(self, at: Optional[float]):
+        if not self.speed or at is None:
+            return
+        delay = self.started + (at - self.origin) / self.speed - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def run(self, host: str, port: int):
+        stats = self.stats
+        await self.wait_until(self.record['opened'])
+        try:
+            self.reader, self.writer = await asyncio.open_connection(host, port)
+        except OSError:
+            stats.connect_errors += 1
+            return
+        stats.connections += 1
+        reader_task = asyncio.create_task(self.read_loop())
+        try:
+            for at, message in self.record['frames']:
+                await self.wait_until(at)
+                msg_type = message.get('type')
+                if msg_type in REPLIES:
+                    self.pending[msg_type].append(time.perf_counter())
+                if msg_type == 'auth':
+                    self.authenticated.clear()
+                    self.writer.write(JSON_CODEC.encode(message))
+                    stats.frames_sent += 1
+                    # Следующие кадры - уже в кодеке, выбранном сервером
+                    await asyncio.wait_for(self.authenticated.wait(), AUTH_TIMEOUT)
+                    continue
+                if self.codec is JSON_CODEC:
+                    message = json_safe(message)
+                self.writer.write(self.codec.encode(message))
+                stats.frames_sent += 1
+                await self.writer.drain()
+            await self.wait_until(self.record['closed'])
+
+            deadline = time.perf_counter() + REPLY_GRACE
+            while any(self.pending.values()) and time.perf_counter() < deadline and not reader_task.done():
+                await asyncio.sleep(0.05)
+        except (ConnectionError, asyncio.TimeoutError):
+            pass
+        finally:
+            stats.unanswered += sum(len(times) for times in self.pending.values())
+            self.writer.close()
+            reader_task.cancel()
+            await asyncio.gather(reader_task, return_exceptions=True)
+
+    async def read_loop(self):
+        stats = self.stats
+        try:
+            while True:
+                message = await self.codec.read(self.reader)
+                if message is None:
+                    break
+                stats.last_received = time.perf_counter()
+                msg_type = message.get('type')
+                if msg_type == 'auth_success':
+                    # Переключаемся до чтения следующего кадра
+                    self.codec = CODECS.get(message.get('codec'), JSON_CODEC)
+                if msg_type in ('auth_success', 'auth_error'):
+                    self.authenticated.set()
+                if msg_type in ('error', 'transfer_error'):
+                    stats.errors += 1
+                    continue
+                if msg_type in BROADCAST_REPLIES and not message.get('is_self'):
+                    stats.deliveries += 1
+                    continue
+                self.resolve(msg_type)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+
+    def resolve(self, reply_type: str):
+        """Ответ относится к самому раннему ожидающему запросу подходящего типа"""
+        candidates = [t for t in REQUESTS_BY_REPLY.get(reply_type, ()) if self.pending[t]]
+        if not candidates:
+            return
+        request_type = min(candidates, key=lambda t: self.pending[t][0])
+        sent = self.pending[request_type].popleft()
+        self.stats.replies += 1
+        self.stats.latency[request_type].append((time.perf_counter() - sent) * 1000)
+
+async def replay(connections: Dict[int, dict], host: str, port: int, speed: float) -> dict:
+    """Воспроизведение записи на одном сервере"""
+    raise_fd_limit(len(connections) * 2 + 256)
+    # Подключения для скачивания файлов не воспроизводятся: их токены уже истекли
+    records = [record for record in connections.values()
+               if record['frames'] and record['frames'][0][1].get('type') != 'transfer']
+    origin = min((record['opened'] for record in records), default=0.0)
+    stats = ReplayStats()
+    started = time.perf_counter()
+    await asyncio.gather(*(ReplayConnection(record, stats, speed, origin, started).run(host, port)
+                           for record in records), return_exceptions=True)
+    elapsed = time.perf_counter() - started
+    active = max(stats.last_received - started, 0.0)
+
+    return {
+        'target': f'{host}:{port}',
+        'speed': speed or 'max',
+        'connections': stats.connections,
+        'skipped_connections': len(connections) - len(records),
+        'connect_errors': stats.connect_errors,
+        'elapsed_seconds': round(elapsed, 3),
+        'active_seconds': round(active, 3),
+        'frames_sent': stats.frames_sent,
+        'frames_per_second': round(stats.frames_sent / active, 1) if active else 0.0,
+        'replies': stats.replies,
+        'deliveries': stats.deliveries,
+        'deliveries_per_second': round(stats.deliveries / active, 1) if active else 0.0,
+        'errors': stats.errors,
+        'unanswered': stats.unanswered,
+        'latency_ms': {request_type: {'count': len(samples), **latency_summary(samples)}
+                       for request_type, samples in sorted(stats.latency.items())},
+    }
+
+def print_report(result: dict):
+    print(f"{result['target']} speed={result['speed']}: {result['connections']} connections "
+          f"({result['skipped_connections']} skipped, {result['connect_errors']} failed), "
+          f"{result['active_seconds']} s active of {result['elapsed_seconds']} s")
+    print(f"  sent: {result['frames_sent']} ({result['frames_per_second']}/s), "
+          f"deliveries: {result['deliveries']} ({result['deliveries_per_second']}/s), "
+          f"errors: {result['errors']}, unanswered: {result['unanswered']}")
+    for request_type, lat in result['latency_ms'].items():
+        print(f"  {request_type} ({lat['count']}): p50={lat['p50']} p95={lat['p95']} p99={lat['p99']}")
+
+def percent_change(base: float, value: float) -> str:
+    if not base:
+        return 'n/a'
+    return f'{(value - base) / base:+.1%}'
+
+def print_comparison(base: dict, other: dict):
+    """Разница второго сервера относительно первого"""
+    print(f"{other['target']} vs {base['target']}:")
+    for key in ('frames_per_second', 'deliveries_per_second'):
+        print(f"  {key}: {base[key]} -> {other[key]} ({percent_change(base[key], other[key])})")
+    for request_type, lat in other['latency_ms'].items():
+        base_lat = base['latency_ms'].get(request_type)
+        if base_lat is None:
+            continue
+        changes = ', '.join(f"{q}={base_lat[q]}->{lat[q]} ({percent_change(base_lat[q], lat[q])})"
+                            for q in ('p50', 'p99'))
+        print(f"  {request_type}: {changes}")
+
+def parse_speed(value: str) -> float:
+    return 0.0 if value == 'max' else float(value)
+
+def parse_target(value: str):
+    host, _, port = value.rpartition(':')
+    return host or 'localhost', int(port)
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay captured chat traffic')
+    parser.add_argument('capture', help='файл, записанный server.py --capture')
+    parser.add_argument('--target', action='append', type=parse_target,
+                        help='host:port сервера; несколько - сравнение с первым')
+    parser.add_argument('--speed', type=parse_speed, default=1.0,
+                        help='ускорение относительно записи: 1, 10, ... или max')
+    parser.add_argument('--output', help='куда записать результаты в JSON')
+    args = parser.parse_args()
+
+    connections = load_connections(args.capture)
+    results = []
+    for host, port in args.target or [('localhost', 8888)]:
+        result = asyncio.run(replay(connections, host, port, args.speed))
+        print_report(result)
+        results.append(result)
+    for other in results[1:]:
+        print_comparison(results[0], other)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+# room_directory.py
+from bisect import bisect_left, bisect_right, insort
+from typing import Dict, List, Optional, Tuple
+
+MAX_ROOM_PAGE = 100
+
+class RoomDirectory:
+    """Каталог комнат: отсортированный список имен и число участников.
+
+    Обновляется по событиям (создание и удаление комнаты, вход и выход участника),
+    поэтому страница каталога строится бинарным поиском, без пересчета
+    и сортировки всех комнат на каждый запрос"""
+
+    def __init__(self):
+        self.names: List[str] = []
+        self.members: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def add(self, name: str):
+        if name not in self.members:
+            insort(self.names, name)
+            self.members[name] = 0
+
+    def remove(self, name: str):
+        if self.members.pop(name, None) is not None:
+            del self.names[bisect_left(self.names, name)]
+
+    def change(self, name: str, delta: int):
+        """Изменение числа участников комнаты"""
+        self.add(name)
+        self.members[name] = max(0, self.members[name] + delta)
+
+    def page(self, prefix: str = '', cursor: Optional[str] = None,
+             limit: int = 50) -> Tuple[List[dict], Optional[str]]:
+        """Страница комнат с именем на prefix после cursor (имени последней
+        комнаты предыдущей страницы). Возвращает (комнаты, курсор следующей страницы)"""
+        limit = max(1, min(limit, MAX_ROOM_PAGE))
+        start = bisect_left(self.names, prefix)
+        if cursor is not None:
+            start = max(start, bisect_right(self.names, cursor))
+
+        rooms = []
+        index = start
+        while index < len(self.names) and len(rooms) < limit:
+            name = self.names[index]
+            if not name.startswith(prefix):
+                break
+            rooms.append({'name': name, 'members': self.members[name]})
+            index += 1
+
+        more = index < len(self.names) and self.names[index].startswith(prefix)
+        return rooms, (rooms[-1]['name'] if more else None)
@@ -1,129 +1,633 @@
 # server_fixed.py
+import argparse
 import asyncio
-import json
+import base64
+import hashlib
 import logging
+import multiprocessing
 import os
+import secrets
+import socket
+import sqlite3
+import time
+from collections import deque
 from datetime import datetime
-from typing import Dict, Set, List
+from itertools import islice
+from typing import Callable, Dict, Iterable, Set, List, Optional
+
+from capture import CaptureWriter
+from cluster import Broker, BusClient
+from history_store import HistoryStore
+from metrics import ServerMetrics, serve_metrics
+from protocol import JSON_CODEC, FrameTooLarge, negotiate
+from ratelimit import RateLimits, TokenBucket
+from room_directory import RoomDirectory
+from sessions import SESSION_TTL, SessionRegistry
+from transfer import TransferTokens, send_file_range
+from upload_store import UploadStore
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('ChatServer')
 
+# Размер куска при потоковой загрузке файла (до base64).
+# В base64 кусок занимает ~43 КиБ и помещается в лимит строки StreamReader (64 КиБ)
+UPLOAD_CHUNK_SIZE = 32 * 1024
+MAX_UPLOAD_SIZE = 1024 * 1024 * 1024
+# Сколько незавершенных загрузок может держать один клиент: у каждой открыт
+# временный файл, без предела клиент исчерпал бы дескрипторы процесса
+MAX_CONCURRENT_UPLOADS = 4
+# Ограничение скорости отдачи файла на одно подключение, байт в секунду
+DOWNLOAD_RATE = 8 * 1024 * 1024
+
+# Политики переполнения исходящей очереди клиента
+OVERFLOW_DROP_OLDEST = 'drop_oldest'  # выбросить самый старый кадр
+OVERFLOW_DISCONNECT = 'disconnect'    # отключить медленного клиента
+OVERFLOW_COALESCE = 'coalesce'        # склеить кадр с последним в очереди
+SEND_QUEUE_SIZE = 256
+# Предел склеенного кадра при OVERFLOW_COALESCE, дальше - отключение
+MAX_COALESCED_BYTES = 1024 * 1024
+# Склейка записи: кадры, накопившиеся за окно или до бюджета байт, уходят одним writelines.
+# Если очередь простаивала, первый кадр отправляется сразу, без ожидания окна
+FLUSH_WINDOW = 0.001
+FLUSH_BYTES = 64 * 1024
+
+# Проверка активности: молчащему дольше HEARTBEAT_INTERVAL клиенту отправляется ping,
+# молчащий дольше IDLE_TIMEOUT отключается. Отключаются только клиенты, которые
+# отвечают на ping (heartbeat: true в auth или уже присланный pong): старые клиенты
+# ping не знают, их обрывы обнаруживает TCP keepalive
+HEARTBEAT_INTERVAL = 30.0
+IDLE_TIMEOUT = 90.0
+
+# Типы входящих сообщений, которые считаются в метриках поименно
+MESSAGE_TYPES = frozenset({
+    'message', 'join_room', 'list_rooms', 'fetch_history', 'private_message', 'stats',
+    'upload_file', 'upload_begin', 'upload_chunk', 'upload_commit', 'upload_abort',
+    'ping', 'pong', 'download_file', 'search_history',
+})
+
+# Типы сообщений, которые рассылаются всей комнате и учитываются в ее лимите
+ROOM_BROADCAST_TYPES = frozenset({'message', 'upload_file', 'upload_commit'})
+# Типы, которые обрабатывает обработчик входящей очереди комнаты, а не цикл чтения
+# подключения; после join_room цикл чтения ждет, пока смена комнаты выполнится
+ROOM_QUEUED_TYPES = frozenset({'message', 'join_room'})
+ROOM_BARRIER_TYPES = frozenset({'join_room'})
+# Кадры, которые сервер сам ставит в очередь комнаты для рассылки (объявления
+# о загруженных файлах): файл сохраняется в цикле чтения, а рассылка идет
+# через очередь, в общем порядке с сообщениями комнаты. От клиентов не принимаются
+ROOM_ANNOUNCE_TYPES = frozenset({'file_upload'})
+# Емкость входящей очереди комнаты: при заполнении циклы чтения ее участников
+# останавливаются, и давление передается на сокеты клиентов
+ROOM_INGRESS_SIZE = 256
+# Сколько сообщений обработчик комнаты разбирает за проход, прежде чем
+# уступить цикл событий задачам-писателям
+ROOM_INGRESS_BATCH = 32
+
+# Сколько последних сообщений комнаты держать в памяти (остальное - в журнале на диске)
+HISTORY_RING_SIZE = 100
+MAX_HISTORY_PAGE = 100
+
+# Пустая комната выгружается из памяти через ROOM_TTL секунд и загружается
+# из журнала заново при следующем входе. Общая комната не выгружается
+ROOM_TTL = 300.0
+ROOM_SWEEP_INTERVAL = 30.0
+# Возобновленной сессии досылается не больше стольких пропущенных сообщений,
+# при большем отставании клиент получает resync и подгружает историю сам
+MAX_RESUME_GAP = 500
+DEFAULT_ROOM = 'general'
+MAX_ROOM_NAME = 64
+
+class Frame:
+    """Сообщение, которое сериализуется один раз (на каждый кодек)
+    и отправляется многим получателям"""
+    __slots__ = ('message', '_encoded')
+
+    def __init__(self, message: dict):
+        self.message = message
+        self._encoded: Dict[str, bytes] = {}
+
+    def encode(self, codec) -> bytes:
+        data = self._encoded.get(codec.name)
+        if data is None:
+            data = self._encoded[codec.name] = codec.encode(self.message)
+        return data
+
+# Один кадр ping на всех клиентов
+PING_FRAME = Frame({'type': 'ping'})
+
 class ChatRoom:
-    def __init__(self, name: str):
+    def __init__(self, name: str, store: HistoryStore, metrics: ServerMetrics,
+                 max_history: int = HISTORY_RING_SIZE, bus: Optional[BusClient] = None,
+                 send_bucket: Optional[TokenBucket] = None,
+                 on_members: Optional[Callable[[str, int], None]] = None,
+                 ingress_size: int = ROOM_INGRESS_SIZE):
         self.name = name
+        self.metrics = metrics
         self.clients: Set['ChatClient'] = set()
-        self.history: List[dict] = []
-        self.max_history = 100
+        # Кольцевой буфер последних сообщений, полная история - в store
+        self.history = deque(maxlen=max_history)
+        self.store = store
+        # В режиме кластера сообщения нумерует и рассылает брокер
+        self.bus = bus
+        self.last_seq = 0
+        self.load_task: Optional[asyncio.Task] = None
+        # Общий лимит рассылок в комнату от всех ее участников (в кластере - на воркер)
+        self.send_bucket = send_bucket
+        # Изменения числа участников передаются в каталог комнат
+        self.on_members = on_members
+        # С какого момента комната пуста (для выгрузки по TTL)
+        self.empty_since = time.monotonic()
+        # Входящая очередь (клиент, сообщение, future завершения, время постановки)
+        # и задача, которая разбирает ее по порядку
+        self.ingress = asyncio.Queue(maxsize=ingress_size)
+        self.worker: Optional[asyncio.Task] = None
+
+    async def load(self):
+        """Загрузка хвоста истории из журнала (один раз при открытии комнаты)"""
+        if self.bus:
+            # Снимок комнаты применит apply_snapshot при получении ответа брокера
+            await self.bus.subscribe(self.name)
+            return
+        self.last_seq = await self.store.last_seq(self.name)
+        tail = await self.store.page(self.name, None, self.history.maxlen)
+        self.history.extend(Frame(message) for message in tail)
+
+    def apply_snapshot(self, last_seq: int, history: List[dict]):
+        self.history.clear()
+        self.history.extend(Frame(message) for message in history)
+        self.last_seq = last_seq
+
+    @property
+    def loaded(self) -> bool:
+        return self.load_task is not None and self.load_task.done()
 
     def add_client(self, client: 'ChatClient'):
+        if client in self.clients:
+            return
         self.clients.add(client)
-        logger.info(f"Client {client.username} joined room {self.name}")
+        self.empty_since = None
+        if self.on_members:
+            self.on_members(self.name, 1)
+        logger.debug("Client %s joined room %s", client.username, self.name)
 
     def remove_client(self, client: 'ChatClient'):
+        if client not in self.clients:
+            return
         self.clients.discard(client)
-        logger.info(f"Client {client.username} left room {self.name}")
+        if not self.clients:
+            self.empty_since = time.monotonic()
+        if self.on_members:
+            self.on_members(self.name, -1)
+        logger.debug("Client %s left room %s", client.username, self.name)
 
     async def broadcast(self, message: dict, sender: 'ChatClient' = None):
         """Отправка сообщения всем клиентам в комнате (включая отправителя)"""
         message['timestamp'] = datetime.now().isoformat()
+        message['is_self'] = False  # Для всех получателей, кроме отправителя
         
-        # Добавляем флаг, указывающий что сообщение от самого пользователя
-        if sender:
-            message['is_self'] = False  # Для всех получателей
+        if self.bus:
+            # Брокер присвоит id и вернет сообщение всем воркерам комнаты, включая этот
+            self.bus.publish(self.name, message, sender.username if sender else None)
+            return
         
-        self.history.append(message)
+        message['id'] = self.last_seq + 1
+        self.store.append(self.name, message['id'], message)
+        self.deliver(message, sender)
+
+    def deliver(self, message: dict, sender: 'ChatClient' = None):
+        """Рассылка пронумерованного сообщения локальным участникам комнаты"""
+        if message['id'] != self.last_seq + 1:
+            # Разрыв в нумерации: буфер больше не непрерывен, старое читаем из журнала
+            self.history.clear()
+        self.last_seq = message['id']
         
-        # Ограничиваем размер истории
-        if len(self.history) > self.max_history:
-            self.history = self.history[-self.max_history:]
+        started = time.perf_counter()
+        # Кадр сериализуется один раз: один вариант для всех, второй - для отправителя
+        frame = Frame(message)
+        self.history.append(frame)
         
-        # Рассылаем сообщение всем клиентам в комнате
-        tasks = []
-        for client in self.clients:
-            # Создаем копию сообщения для каждого клиента
-            client_message = message.copy()
-            
+        self_frame = None
+        if sender in self.clients:
             # Помечаем сообщение как "свое" для отправителя
-            if client == sender:
-                client_message['is_self'] = True
-            else:
-                client_message['is_self'] = False
-                
-            tasks.append(client.send_message(client_message))
+            self_frame = Frame({**message, 'is_self': True})
         
-        if tasks:
-            await asyncio.gather(*tasks, return_exceptions=True)
+        # Рассылаем один и тот же кадр всем клиентам в комнате.
+        # Кадры только ставятся в очереди клиентов, медленный клиент рассылку не задерживает
+        for client in self.clients:
+            client.send_frame(self_frame if client is sender else frame)
+        self.metrics.broadcast_seconds.observe(time.perf_counter() - started)
 
-    async def broadcast_to_others(self, message: dict, sender: 'ChatClient'):
-        """Отправка сообщения всем, кроме отправителя (для системных сообщений)"""
-        message['timestamp'] = datetime.now().isoformat()
+    async def broadcast_to_others(self, message, sender: 'ChatClient'):
+        """Отправка сообщения всем, кроме отправителя (для системных сообщений).
+        Принимает словарь или готовый Frame"""
+        if not isinstance(message, Frame):
+            message['timestamp'] = datetime.now().isoformat()
+            message = Frame(message)
         
-        tasks = []
+        if self.bus:
+            # Уведомление получат участники комнаты на всех воркерах
+            self.bus.notify(self.name, message.message, sender.username if sender else None)
+            return
+        self.deliver_notice(message, sender)
+
+    def deliver_notice(self, message: Frame, sender: 'ChatClient' = None):
         for client in self.clients:
-            if client != sender:
-                tasks.append(client.send_message(message))
-        
-        if tasks:
-            await asyncio.gather(*tasks, return_exceptions=True)
+            if client is not sender:
+                client.send_frame(message)
+
+    def frames_since(self, seq: int) -> Optional[List[Frame]]:
+        """Кадры с id > seq из кольцевого буфера. None, если буфер их не покрывает"""
+        if seq >= self.last_seq:
+            return []
+        if not self.history or self.history[0].message['id'] > seq + 1:
+            return None
+        first = self.history[0].message['id']
+        return list(islice(self.history, seq + 1 - first, None))
+
+    def replay_history(self, client: 'ChatClient', count: int = 10):
+        """Отправка клиенту последних сообщений комнаты уже готовыми кадрами"""
+        for frame in islice(self.history, max(0, len(self.history) - count), None):
+            client.send_frame(frame)
+
+    def history_page(self, before: Optional[int], limit: int) -> Optional[List[dict]]:
+        """Страница сообщений с id < before из кольцевого буфера.
+        None, если буфер не покрывает страницу и нужно читать журнал"""
+        end = self.last_seq + 1 if before is None else min(before, self.last_seq + 1)
+        start = max(1, end - limit)
+        if start >= end:
+            return []
+        if not self.history or start < self.history[0].message['id']:
+            return None
+        first = self.history[0].message['id']
+        return [self.history[seq - first].message for seq in range(start, end)]
+
+class FileTransfer:
+    """Состояние одной потоковой загрузки файла"""
+    def __init__(self, upload_id: str, filename: str, size: int, temp_path: str, file):
+        self.upload_id = upload_id
+        self.filename = filename
+        self.size = size
+        self.temp_path = temp_path
+        self.file = file
+        # Хэш содержимого считается по мере приема кусков
+        self.hasher = hashlib.sha256()
+        self.next_seq = 0
+        self.received = 0
 
 class ChatClient:
-    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Состояние подключения. На сотни тысяч подключений каждый байт записи
+    умножается, поэтому атрибуты фиксированы через __slots__, а вместо
+    asyncio.Event писатель ждет одноразовый Future, создаваемый только при простое"""
+    __slots__ = (
+        'reader', 'writer', 'metrics', 'username', 'current_room', 'address', 'authenticated',
+        'uploads', 'codec', 'outbox', 'outbox_bytes', 'wakeup', 'flush_window', 'flush_bytes',
+        'max_queue', 'overflow_policy', 'dropped', 'closing', 'writer_task', 'last_seen',
+        'limits', 'inbound', 'type_buckets', 'violations', 'limit_notified', 'capture',
+        'heartbeat', 'resumable',
+    )
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                 metrics: ServerMetrics, max_queue: int = SEND_QUEUE_SIZE,
+                 overflow_policy: str = OVERFLOW_DROP_OLDEST,
+                 limits: Optional[RateLimits] = None,
+                 flush_window: float = FLUSH_WINDOW, flush_bytes: int = FLUSH_BYTES):
         self.reader = reader
+        self.metrics = metrics
         self.writer = writer
         self.username = None
         self.current_room: ChatRoom = None
         self.address = writer.get_extra_info('peername')
         self.authenticated = False
+        self.uploads: Dict[str, FileTransfer] = {}
+        # Кодек кадров; до согласования при auth - JSON построчно
+        self.codec = JSON_CODEC
+        
+        # Исходящая очередь кадров, которую разбирает отдельная задача-писатель
+        self.outbox = deque()
+        self.outbox_bytes = 0
+        self.wakeup: Optional[asyncio.Future] = None
+        self.flush_window = flush_window
+        self.flush_bytes = flush_bytes
+        self.max_queue = max_queue
+        self.overflow_policy = overflow_policy
+        self.dropped = 0
+        self.closing = False
+        self.writer_task: Optional[asyncio.Task] = None
+        # Время последнего входящего кадра (для ping и отключения молчащих)
+        self.last_seen = time.monotonic()
+        # Клиент отвечает на ping, и его молчание означает обрыв
+        self.heartbeat = False
+        # Клиент просил продолжаемую сессию: после разрыва имя держится за ним
+        self.resumable = False
+        
+        # Ограничения входящего трафика: байты подключения, сообщения по типам, нарушения
+        self.limits = limits or RateLimits()
+        self.inbound = self.limits.connection_bucket()
+        self.type_buckets: Dict[str, TokenBucket] = {}
+        self.violations = self.limits.abuse_bucket()
+        self.limit_notified = False
+        # Запись входящих кадров (режим захвата трафика сервера)
+        self.capture: Optional[Callable[[dict], None]] = None
 
-    async def send_message(self, message: dict):
-        """Отправка сообщения клиенту"""
+    def start_writer(self):
+        """Запуск задачи, отправляющей кадры из очереди"""
+        self.writer_task = asyncio.create_task(self.write_loop())
+
+    async def stop_writer(self):
+        if self.writer_task:
+            self.writer_task.cancel()
+            try:
+                await self.writer_task
+            except asyncio.CancelledError:
+                pass
+
+    def enqueue(self, data: bytes) -> bool:
+        """Постановка готового кадра в очередь без ожидания.
+        При переполнении действует overflow_policy клиента"""
+        if self.closing:
+            return False
+        
+        if len(self.outbox) >= self.max_queue:
+            if self.overflow_policy == OVERFLOW_DROP_OLDEST:
+                self.outbox_bytes -= len(self.outbox.popleft())
+                self.dropped += 1
+                self.metrics.frames_dropped.inc()
+            elif (self.overflow_policy == OVERFLOW_COALESCE
+                  and len(self.outbox[-1]) + len(data) <= MAX_COALESCED_BYTES):
+                # Кадры разделены переводом строки, поэтому их можно склеить
+                self.outbox[-1] += data
+                self.outbox_bytes += len(data)
+                return True
+            else:
+                logger.warning(f"Send queue overflow for {self.username}, disconnecting")
+                self.metrics.slow_disconnects.inc()
+                self.abort()
+                return False
+        
+        self.outbox.append(data)
+        self.outbox_bytes += len(data)
+        waiter = self.wakeup
+        if waiter is not None:
+            self.wakeup = None
+            if not waiter.done():
+                waiter.set_result(None)
+        return True
+
+    async def write_loop(self):
+        """Отправка кадров из очереди пачками: один writelines и один drain на пачку.
+        drain ждет только эта задача"""
+        outbox = self.outbox
         try:
-            data = json.dumps(message).encode() + b'\n'
-            self.writer.write(data)
-            await self.writer.drain()
+            while True:
+                if not outbox:
+                    self.wakeup = asyncio.get_running_loop().create_future()
+                    await self.wakeup
+                elif self.flush_window and self.outbox_bytes < self.flush_bytes:
+                    # Кадры пришли, пока ждали drain: идет всплеск, даем пачке дорасти
+                    await asyncio.sleep(self.flush_window)
+                
+                batch = []
+                size = 0
+                while outbox and size < self.flush_bytes:
+                    data = outbox.popleft()
+                    batch.append(data)
+                    size += len(data)
+                if not batch:
+                    continue
+                self.outbox_bytes -= size
+                self.writer.writelines(batch)
+                self.metrics.bytes_out.inc(size)
+                self.metrics.write_batch_frames.observe(len(batch))
+                started = time.perf_counter()
+                await self.writer.drain()
+                self.metrics.drain_seconds.observe(time.perf_counter() - started)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
             logger.error(f"Error sending message to {self.username}: {e}")
+            self.abort()
+
+    def abort(self):
+        """Разрыв соединения: цикл чтения получит EOF и выполнит очистку"""
+        self.closing = True
+        self.outbox.clear()
+        self.outbox_bytes = 0
+        self.writer.transport.abort()
+
+    def send_frame(self, frame: Frame) -> bool:
+        """Отправка заранее сериализованного кадра"""
+        return self.enqueue(frame.encode(self.codec))
+
+    async def send_message(self, message: dict):
+        """Отправка сообщения клиенту"""
+        self.enqueue(self.codec.encode(message))
+
+    def allow(self, msg_type: str) -> bool:
+        """Проверка лимита сообщений данного типа"""
+        bucket = self.type_buckets.get(msg_type)
+        if bucket is None:
+            bucket = self.type_buckets[msg_type] = self.limits.type_bucket(msg_type)
+        return bucket.consume()
 
     async def receive_message(self):
         """Чтение сообщения от клиента"""
         try:
-            data = await self.reader.readline()
-            if not data:
+            frame = await self.codec.read_frame(self.reader, self.limits.max_frame_size)
+            if frame is None:
                 return None
-            return json.loads(data.decode().strip())
+            self.last_seen = time.monotonic()
+            self.metrics.bytes_in.inc(len(frame))
+            message = self.codec.decode(frame)
+        except FrameTooLarge as e:
+            self.metrics.oversized_frames.inc()
+            logger.warning(f"Oversized frame from {self.username or self.address}, disconnecting: {e}")
+            return None
         except Exception as e:
+            self.metrics.decode_errors.inc()
             logger.error(f"Error receiving message from {self.username}: {e}")
             return None
 
+        if self.capture:
+            # Ошибка записи не должна обрывать подключение
+            try:
+                self.capture(message)
+            except Exception as e:
+                logger.warning(f"Failed to capture frame from {self.username or self.address}: {e}")
+        # Превысивший поток байт клиент не отклоняется, а читается медленнее
+        delay = self.inbound.delay(len(frame))
+        if delay:
+            self.metrics.read_throttled.inc()
+            await asyncio.sleep(delay)
+        return message
+
 class ChatServer:
-    def __init__(self, host: str = 'localhost', port: int = 8888):
+    def __init__(self, host: str = 'localhost', port: int = 8888,
+                 send_queue_size: int = SEND_QUEUE_SIZE,
+                 overflow_policy: str = OVERFLOW_DROP_OLDEST,
+                 history_path: str = 'history.db',
+                 reuse_port: bool = False,
+                 bus_path: Optional[str] = None,
+                 metrics_port: Optional[int] = None,
+                 admin_users: Iterable[str] = (),
+                 rate_limits: Optional[RateLimits] = None,
+                 flush_window: float = FLUSH_WINDOW,
+                 flush_bytes: int = FLUSH_BYTES,
+                 heartbeat_interval: float = HEARTBEAT_INTERVAL,
+                 idle_timeout: float = IDLE_TIMEOUT,
+                 stream_limit: Optional[int] = None,
+                 write_buffer_limit: Optional[int] = None,
+                 upload_workers: int = 4,
+                 download_rate: Optional[float] = DOWNLOAD_RATE,
+                 transfer_secret: Optional[str] = None,
+                 room_ttl: float = ROOM_TTL,
+                 session_ttl: float = SESSION_TTL,
+                 capture_path: Optional[str] = None,
+                 room_queue_size: int = ROOM_INGRESS_SIZE):
         self.host = host
         self.port = port
+        self.send_queue_size = send_queue_size
+        self.overflow_policy = overflow_policy
+        self.flush_window = flush_window
+        self.flush_bytes = flush_bytes
+        # Проверка активности и размеры буферов подключения
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = idle_timeout
+        self.stream_limit = stream_limit
+        self.write_buffer_limit = write_buffer_limit
+        self.reaper_task: Optional[asyncio.Task] = None
         self.rooms: Dict[str, ChatRoom] = {}
+        # Каталог комнат для list_rooms (в кластере каталог ведет брокер)
+        self.directory = RoomDirectory()
+        self.room_ttl = room_ttl
+        self.sweeper_task: Optional[asyncio.Task] = None
         self.clients: Set[ChatClient] = set()
-        self.message_queue = asyncio.Queue()
+        # Индекс авторизованных клиентов по имени: проверка уникальности и ЛС за O(1)
+        self.usernames: Dict[str, ChatClient] = {}
+        # Сессии: после разрыва имя продолжаемой сессии (клиент пришел с токеном
+        # или с resume) остается за ней session_ttl секунд, и клиент с ее токеном
+        # может продолжить с последнего увиденного сообщения.
+        # В кластере реестр сессий ведет брокер
+        self.sessions = SessionRegistry()
+        self.session_ttl = session_ttl
+        self.room_queue_size = room_queue_size
         self.file_storage = "uploads"
+        # Файлы хранятся по хэшу содержимого, дисковые операции - в пуле потоков
+        self.upload_store = UploadStore(self.file_storage, upload_workers)
+        # Отдача файлов: токены подписаны секретом, общим для воркеров кластера
+        self.transfer_tokens = TransferTokens(
+            transfer_secret.encode() if transfer_secret else os.urandom(32))
+        self.download_rate = download_rate
+        self.history_store = HistoryStore(history_path)
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.metrics_server: Optional[asyncio.AbstractServer] = None
+        # Режим кластера: порт делится между процессами, комнаты и имена - через брокер
+        self.reuse_port = reuse_port
+        self.bus_path = bus_path
+        self.bus: Optional[BusClient] = None
+        # Метрики: HTTP-эндпоинт Prometheus (если задан порт) и сообщение stats для админов
+        self.metrics = ServerMetrics()
+        self.metrics_port = metrics_port
+        self.admin_users = set(admin_users)
+        self.register_gauges()
+        self.rate_limits = rate_limits or RateLimits()
+        # Захват входящего трафика для replay.py (включается явно)
+        self.capture_path = capture_path
+        self.capture: Optional[CaptureWriter] = None
         
         # Создаем папку для файлов
         os.makedirs(self.file_storage, exist_ok=True)
-        
-        # Создаем общую комнату по умолчанию
-        self.create_room("general")
+
+    def register_gauges(self):
+        """Метрики, которые вычисляются по состоянию сервера в момент запроса"""
+        r = self.metrics.registry
+        r.gauge('chat_connections_active', 'Open client connections',
+                lambda: [((), len(self.clients))])
+        r.gauge('chat_users_authenticated', 'Authenticated users on this process',
+                lambda: [((), len(self.usernames))])
+        r.gauge('chat_rooms_loaded', 'Rooms held in memory on this process',
+                lambda: [((), len(self.rooms))])
+        r.gauge('chat_room_members', 'Members per room',
+                lambda: [((name,), len(room.clients)) for name, room in self.rooms.items()],
+                ('room',))
+        r.gauge('chat_room_ingress_frames', 'Frames waiting in room ingress queues',
+                lambda: [(('total',), sum(room.ingress.qsize() for room in self.rooms.values())),
+                         (('max',), max((room.ingress.qsize() for room in self.rooms.values()), default=0))],
+                ('stat',))
+        r.gauge('chat_outbound_queue_frames', 'Frames waiting in client send queues',
+                lambda: [(('total',), sum(len(c.outbox) for c in self.clients)),
+                         (('max',), max((len(c.outbox) for c in self.clients), default=0))],
+                ('stat',))
 
     def create_room(self, room_name: str) -> ChatRoom:
         """Создание новой комнаты"""
         if room_name not in self.rooms:
-            self.rooms[room_name] = ChatRoom(room_name)
-            logger.info(f"Created room: {room_name}")
+            room = ChatRoom(room_name, self.history_store, self.metrics, bus=self.bus,
+                            send_bucket=self.rate_limits.room_bucket(),
+                            on_members=self.room_members_changed,
+                            ingress_size=self.room_queue_size)
+            room.worker = asyncio.create_task(self.process_room(room))
+            self.rooms[room_name] = room
+            if not self.bus:
+                self.directory.add(room_name)
+            logger.debug("Created room: %s", room_name)
         return self.rooms[room_name]
 
+    def room_members_changed(self, room_name: str, delta: int):
+        if self.bus:
+            self.bus.presence(room_name, delta)
+        else:
+            self.directory.change(room_name, delta)
+
+    async def open_room(self, room_name: str) -> ChatRoom:
+        """Комната с загруженной из журнала историей"""
+        while True:
+            room = self.create_room(room_name)
+            if room.load_task is None:
+                room.load_task = asyncio.ensure_future(room.load())
+            await room.load_task
+            # Пока шла загрузка, комнату могли выгрузить - тогда открываем заново.
+            # Вызывающий добавляет клиента сразу после возврата, без ожидания
+            if self.rooms.get(room_name) is room:
+                return room
+
+    def evict_room(self, room: ChatRoom):
+        """Выгрузка пустой комнаты из памяти. Сообщения уже в журнале,
+        при следующем входе комната загрузится из него заново"""
+        del self.rooms[room.name]
+        room.worker.cancel()
+        if self.bus:
+            self.bus.unsubscribe(room.name)
+        else:
+            self.directory.remove(room.name)
+        self.history_store.flush()
+        self.metrics.rooms_evicted.inc()
+        logger.debug("Evicted room: %s", room.name)
+
+    async def evict_idle_rooms(self):
+        """Периодическая выгрузка комнат, пустующих дольше room_ttl"""
+        while True:
+            await asyncio.sleep(min(ROOM_SWEEP_INTERVAL, self.room_ttl))
+            deadline = time.monotonic() - self.room_ttl
+            for room in list(self.rooms.values()):
+                if (room.name != DEFAULT_ROOM and not room.clients and room.loaded
+                        and room.ingress.empty() and room.empty_since is not None and room.empty_since <= deadline):
+                    self.evict_room(room)
+
     async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
         """Обработка подключения клиента"""
-        client = ChatClient(reader, writer)
+        client = ChatClient(reader, writer, self.metrics, self.send_queue_size, self.overflow_policy,
+                            self.rate_limits, self.flush_window, self.flush_bytes)
+        if self.write_buffer_limit:
+            writer.transport.set_write_buffer_limits(high=self.write_buffer_limit)
+        self.enable_keepalive(writer)
+        client.start_writer()
         self.clients.add(client)
+        self.metrics.connections.inc()
+        capture = self.capture
+        if capture:
+            capture_id = capture.open_connection()
+            client.capture = lambda message: capture.record(capture_id, message)
         
-        logger.info(f"New connection from {client.address}")
+        logger.debug("New connection from %s", client.address)
         
         try:
             # Аутентификация
@@ -136,6 +640,8 @@ class ChatServer:
             logger.error(f"Error handling client {client.username}: {e}")
         finally:
             # Очистка при отключении
+            if capture:
+                capture.close_connection(capture_id)
             await self.cleanup_client(client)
 
     async def authenticate_client(self, client: ChatClient):
@@ -144,12 +650,31 @@ class ChatServer:
             message = await client.receive_message()
             if not message:
                 return
+            if not await self.admit(client, 'auth'):
+                if client.closing:
+                    return
+                continue
+            
+            if message.get('type') == 'transfer':
+                # Подключение для передачи файла: после ответа идут сырые байты
+                await self.serve_transfer(client, message)
+                return
             
             if message.get('type') == 'auth':
                 username = message.get('username', '').strip()
                 if username and len(username) <= 20:
+                    # Токен прежней сессии (при переподключении) или новый.
+                    # Имя после разрыва бронируется только для клиентов, которые
+                    # пришли с токеном или попросили продолжаемую сессию (resume)
+                    session = message.get('session')
+                    resumable = (isinstance(session, str) and bool(session)) or message.get('resume') is True
+                    if not isinstance(session, str) or not session:
+                        session = secrets.token_urlsafe(16)
+                    
                     # Проверяем уникальность имени пользователя
-                    if any(c.username == username for c in self.clients if c.authenticated):
+                    claimed, resumed = await self.claim_username(username, client, session)
+                    if not claimed:
+                        self.metrics.auth.labels('taken').inc()
                         await client.send_message({
                             'type': 'auth_error',
                             'message': 'Username already taken'
@@ -158,50 +683,232 @@ class ChatServer:
                     
                     client.username = username
                     client.authenticated = True
+                    client.heartbeat = message.get('heartbeat') is True
+                    client.resumable = resumable
+                    self.metrics.auth.labels('resumed' if resumed else 'success').inc()
                     
-                    # Добавляем в общую комнату
-                    general_room = self.rooms["general"]
-                    general_room.add_client(client)
-                    client.current_room = general_room
+                    # Возобновленная сессия возвращается в свою комнату, новая - в общую
+                    room_name = message.get('room') if resumed else None
+                    if not valid_room_name(room_name):
+                        room_name = DEFAULT_ROOM
                     
+                    # Ответ еще в JSON, следующие кадры - в согласованном кодеке.
+                    # Имя регистрируется для ЛС только после ответа (отправка лишь
+                    # ставит кадр в очередь), поэтому ЛС не опередит auth_success
+                    codec = negotiate(message.get('codecs'))
                     await client.send_message({
                         'type': 'auth_success',
                         'message': f'Welcome {username}!',
-                        'username': username
+                        'username': username,
+                        'codec': codec.name,
+                        'session': session,
+                        'resumed': resumed,
+                        'room': room_name
                     })
+                    client.codec = codec
+                    self.register_username(username, client)
+                    
+                    room = await self.open_room(room_name)
+                    last_seq = message.get('last_seq')
+                    if resumed and isinstance(last_seq, int):
+                        # Только пропущенные сообщения
+                        room = await self.catch_up(client, room, last_seq)
+                    else:
+                        # Отправляем историю комнаты новому пользователю
+                        room.replay_history(client)
+                    room.add_client(client)
+                    client.current_room = room
                     
                     # Уведомляем комнату о новом пользователе (кроме самого пользователя)
-                    await general_room.broadcast_to_others({
+                    await room.broadcast_to_others({
                         'type': 'system',
                         'message': f'{username} joined the room',
                         'username': 'System'
                     }, client)
-                    
-                    # Отправляем историю комнаты новому пользователю
-                    for msg in general_room.history[-10:]:
-                        await client.send_message(msg)
                         
                 else:
+                    self.metrics.auth.labels('invalid').inc()
                     await client.send_message({
                         'type': 'auth_error',
                         'message': 'Invalid username (1-20 characters)'
                     })
 
+    async def catch_up(self, client: ChatClient, room: ChatRoom, last_seq: int) -> ChatRoom:
+        """Досылка сообщений комнаты с id > last_seq возобновленной сессии.
+        Возвращает комнату, в которую клиента нужно добавить сразу, без ожидания,
+        чтобы следующие сообщения пришли уже обычной рассылкой"""
+        while True:
+            gap = room.last_seq - last_seq
+            frames = room.frames_since(last_seq) if gap <= MAX_RESUME_GAP else None
+            if frames is None and gap <= MAX_RESUME_GAP:
+                # Пропуск старше кольцевого буфера: начало читаем из журнала
+                end = room.last_seq
+                messages = await self.history_store.page(room.name, end + 1, end - last_seq)
+                tail = room.frames_since(end)
+                if self.rooms.get(room.name) is not room:
+                    # Комнату выгрузили, пока читали журнал
+                    room = await self.open_room(room.name)
+                    continue
+                # В кластере журнал пишет брокер, и последние сообщения могут быть
+                # еще не сброшены на диск: досылаем только непрерывный участок
+                missed = [m for m in messages if m['id'] > last_seq]
+                if tail is not None and len(missed) == end - last_seq and (not missed or missed[-1]['id'] == end):
+                    frames = [Frame(m) for m in missed] + tail
+            break
+        
+        if frames is None:
+            self.metrics.resyncs.inc()
+            await client.send_message({
+                'type': 'resync',
+                'room': room.name,
+                'last_seq': room.last_seq,
+                'message': 'Too far behind, reload history'
+            })
+            return await self.open_room(room.name)
+        for frame in frames:
+            client.send_frame(frame)
+        return room
+
+    async def claim_username(self, username: str, client: ChatClient, session: str):
+        """Занять имя за сессией (в кластере - глобально через брокер).
+        Возвращает (успех, возобновлена ли прежняя сессия)"""
+        if self.bus:
+            claimed, resumed = await self.bus.claim(username, session)
+        else:
+            claimed, resumed, _ = self.sessions.claim(username, session, client)
+        return claimed, claimed and resumed
+
+    def register_username(self, username: str, client: ChatClient):
+        """Доставка по имени (ЛС) этому подключению. Вызывается после отправки
+        auth_success, чтобы ни один кадр не опередил ответ и смену кодека"""
+        # Прежнее подключение той же сессии (разрыв, который сервер еще не заметил)
+        previous = self.usernames.get(username)
+        if previous is not None and previous is not client:
+            self.drop_replaced_client(previous)
+        self.usernames[username] = client
+
+    def drop_replaced_client(self, client: ChatClient):
+        """Закрытие подключения, сессию которого продолжил новый клиент.
+        Без уведомления комнаты и без освобождения имени"""
+        if self.usernames.get(client.username) is client:
+            del self.usernames[client.username]
+        if client.current_room:
+            client.current_room.remove_client(client)
+            client.current_room = None
+        client.abort()
+
+    def release_username(self, client: ChatClient):
+        # Удаляем только свою запись: имя могло уже достаться новому подключению.
+        # Имя продолжаемой сессии остается за ней еще session_ttl секунд,
+        # остальные клиенты освобождают его сразу
+        if client.username and self.usernames.get(client.username) is client:
+            del self.usernames[client.username]
+            ttl = self.session_ttl if client.resumable else 0
+            if self.bus:
+                self.bus.release(client.username, ttl)
+            else:
+                self.sessions.release(client.username, client, ttl)
+
     async def handle_client_messages(self, client: ChatClient):
         """Обработка сообщений от клиента"""
         while client.authenticated:
             message = await client.receive_message()
-            if not message:
+            if message is None:
                 break
-            
-            try:
-                await self.process_message(client, message)
-            except Exception as e:
-                logger.error(f"Error processing message: {e}")
+
+            # Кадр может быть корректным JSON, но не объектом ([] или "x")
+            is_object = isinstance(message, dict)
+            msg_type = message.get('type') if is_object else None
+            label = msg_type if msg_type in MESSAGE_TYPES else 'other'
+            self.metrics.messages_in.labels(label).inc()
+            if not await self.admit(client, label):
+                if client.closing:
+                    break
+                continue
+            if not is_object:
                 await client.send_message({
                     'type': 'error',
                     'message': 'Error processing message'
                 })
+                continue
+
+            room = client.current_room
+            if msg_type in ROOM_QUEUED_TYPES and room is not None:
+                # Рассылку выполняет обработчик комнаты; при полной очереди
+                # чтение этого подключения ждет
+                done = None
+                if msg_type in ROOM_BARRIER_TYPES:
+                    # Новую комнату (с историей из журнала) загружаем здесь, а не
+                    # в обработчике старой: он только переводит клиента
+                    await self.preload_room(message.get('room'))
+                    done = asyncio.get_running_loop().create_future()
+                await room.ingress.put((client, message, done, time.perf_counter()))
+                if done is not None:
+                    # Следующие сообщения клиента должны попасть уже в очередь новой комнаты
+                    await done
+            else:
+                await self.dispatch(client, message)
+
+    async def dispatch(self, client: ChatClient, message: dict):
+        """Обработка сообщения с ответом клиенту об ошибке"""
+        try:
+            await self.process_message(client, message)
+        except Exception as e:
+            logger.error(f"Error processing message: {e}")
+            await client.send_message({
+                'type': 'error',
+                'message': 'Error processing message'
+            })
+
+    async def process_room(self, room: ChatRoom):
+        """Обработчик входящей очереди комнаты: сообщения одной комнаты
+        обрабатываются по порядку, разные комнаты - независимо друг от друга.
+        Накопившееся в очереди разбирается пачками"""
+        ingress = room.ingress
+        while True:
+            batch = [await ingress.get()]
+            while not ingress.empty() and len(batch) < ROOM_INGRESS_BATCH:
+                batch.append(ingress.get_nowait())
+            for client, message, done, queued_at in batch:
+                self.metrics.ingress_wait_seconds.observe(time.perf_counter() - queued_at)
+                try:
+                    if message.get('type') in ROOM_ANNOUNCE_TYPES:
+                        await self.announce(room, client, message)
+                    else:
+                        await self.dispatch(client, message)
+                finally:
+                    if done is not None and not done.done():
+                        done.set_result(None)
+            # Рассылка пачки только поставила кадры в очереди клиентов:
+            # даем писателям отправить их до следующей пачки
+            await asyncio.sleep(0)
+
+    async def admit(self, client: ChatClient, msg_type: str) -> bool:
+        """Проверка лимитов клиента и комнаты до обработки сообщения.
+        Об отказе клиент узнает один раз до следующего принятого сообщения,
+        исчерпавший запас нарушений клиент отключается"""
+        if not client.allow(msg_type):
+            scope = 'client'
+        elif (msg_type in ROOM_BROADCAST_TYPES and client.current_room
+              and client.current_room.send_bucket
+              and not client.current_room.send_bucket.consume()):
+            scope = 'room'
+        else:
+            client.limit_notified = False
+            return True
+        
+        self.metrics.rate_limited.labels(scope, msg_type).inc()
+        if not client.violations.consume():
+            logger.warning(f"Client {client.username or client.address} keeps exceeding limits, disconnecting")
+            self.metrics.abuse_disconnects.inc()
+            client.abort()
+        elif not client.limit_notified:
+            client.limit_notified = True
+            await client.send_message({
+                'type': 'error',
+                'message': 'Rate limit exceeded, slow down'
+            })
+        return False
 
     async def process_message(self, client: ChatClient, message: dict):
         """Обработка различных типов сообщений"""
@@ -222,22 +929,85 @@ class ChatServer:
             await self.change_room(client, room_name)
         
         elif msg_type == 'list_rooms':
-            # Список комнат
-            await client.send_message({
-                'type': 'room_list',
-                'rooms': list(self.rooms.keys())
-            })
+            # Страница каталога комнат: имена на prefix после cursor
+            await self.list_rooms(client, message)
+        
+        elif msg_type == 'fetch_history':
+            # Страница истории до заданного id
+            await self.fetch_history(client, message)
+        
+        elif msg_type == 'search_history':
+            # Полнотекстовый поиск по журналу комнаты
+            await self.search_history(client, message)
+        
+        elif msg_type == 'stats':
+            # Метрики сервера (только для администраторов)
+            await self.send_stats(client)
+        
+        elif msg_type == 'ping':
+            await client.send_message({'type': 'pong'})
+        
+        elif msg_type == 'pong':
+            # Ответ на проверку активности: last_seen уже обновлен при чтении кадра
+            client.heartbeat = True
         
         elif msg_type == 'private_message':
             # Личное сообщение
             await self.send_private_message(client, message)
         
         elif msg_type == 'upload_file':
-            # Загрузка файла
+            # Загрузка файла одним сообщением (старые клиенты)
             await self.handle_file_upload(client, message)
+        
+        elif msg_type == 'download_file':
+            await self.request_download(client, message)
+        
+        elif msg_type == 'upload_begin':
+            await self.begin_upload(client, message)
+        
+        elif msg_type == 'upload_chunk':
+            await self.receive_upload_chunk(client, message)
+        
+        elif msg_type == 'upload_commit':
+            await self.commit_upload(client, message)
+        
+        elif msg_type == 'upload_abort':
+            await self.abort_upload(client, message.get('upload_id'))
+
+    async def list_rooms(self, client: ChatClient, message: dict):
+        prefix = message.get('prefix') or ''
+        cursor = message.get('cursor')
+        limit = message.get('limit', 50)
+        if not isinstance(prefix, str) or not isinstance(limit, int) or (
+                cursor is not None and not isinstance(cursor, str)):
+            await client.send_message({
+                'type': 'error',
+                'message': 'Invalid list_rooms request'
+            })
+            return
+        
+        if self.bus:
+            rooms, next_cursor = await self.bus.list_rooms(prefix, cursor, limit)
+        else:
+            rooms, next_cursor = self.directory.page(prefix, cursor, limit)
+        # rooms - только имена, как у старых клиентов; число участников - в room_info
+        await client.send_message({
+            'type': 'room_list',
+            'rooms': [room['name'] for room in rooms],
+            'room_info': rooms,
+            'prefix': prefix,
+            'next_cursor': next_cursor
+        })
 
     async def change_room(self, client: ChatClient, room_name: str):
         """Смена комнаты клиентом"""
+        if not valid_room_name(room_name):
+            await client.send_message({
+                'type': 'error',
+                'message': f'Invalid room name (1-{MAX_ROOM_NAME} characters)'
+            })
+            return
+        
         if client.current_room:
             # Уведомляем старую комнату о выходе (кроме самого пользователя)
             await client.current_room.broadcast_to_others({
@@ -247,8 +1017,10 @@ class ChatServer:
             }, client)
             client.current_room.remove_client(client)
         
-        # Создаем комнату если не существует
-        new_room = self.create_room(room_name)
+        # Создаем комнату если не существует. Обычно она уже загружена в цикле
+        # чтения клиента (preload_room), и open_room возвращает ее сразу
+        client.current_room = None
+        new_room = await self.open_room(room_name)
         new_room.add_client(client)
         client.current_room = new_room
         
@@ -259,38 +1031,113 @@ class ChatServer:
             'username': 'System'
         }, client)
         
-        # Отправляем историю новой комнаты только новому пользователю
-        for msg in new_room.history[-10:]:
-            await client.send_message(msg)
-        
         await client.send_message({
             'type': 'room_changed',
             'room': room_name,
             'message': f'You joined room: {room_name}'
         })
+        
+        # Отправляем историю новой комнаты только новому пользователю
+        new_room.replay_history(client)
+
+    async def preload_room(self, room_name):
+        """Загрузка комнаты до перехода в нее, вне обработчика текущей комнаты клиента"""
+        if valid_room_name(room_name):
+            try:
+                await self.open_room(room_name)
+            except Exception as e:
+                # change_room повторит открытие и сообщит клиенту об ошибке
+                logger.error(f"Error preloading room {room_name}: {e}")
+
+    async def fetch_history(self, client: ChatClient, message: dict):
+        """Выдача страницы истории комнаты: сначала из памяти, иначе из журнала"""
+        room_name = message.get('room') or (client.current_room and client.current_room.name)
+        if not room_name:
+            return
+        before = message.get('before')
+        limit = message.get('limit', 50)
+        if (not isinstance(room_name, str) or not isinstance(limit, int)
+                or (before is not None and not isinstance(before, int))):
+            await client.send_message({
+                'type': 'error',
+                'message': 'Invalid fetch_history request'
+            })
+            return
+        limit = max(1, min(limit, MAX_HISTORY_PAGE))
+        
+        room = self.rooms.get(room_name)
+        messages = room.history_page(before, limit) if room and room.loaded else None
+        if messages is None:
+            messages = await self.history_store.page(room_name, before, limit)
+        
+        await client.send_message({
+            'type': 'history_page',
+            'room': room_name,
+            'messages': [dict(m, is_self=m.get('username') == client.username) for m in messages],
+            'has_more': bool(messages) and messages[0]['id'] > 1
+        })
+
+    async def search_history(self, client: ChatClient, message: dict):
+        """Поиск по журналу: слова запроса, фильтры по комнате (по умолчанию текущая,
+        null - все комнаты), автору и времени, страницы от новых сообщений к старым"""
+        query = message.get('query')
+        room_name = message.get('room', client.current_room and client.current_room.name)
+        filters = [message.get(key) for key in ('username', 'since', 'until')]
+        before = message.get('before')
+        limit = message.get('limit', 20)
+        if (not isinstance(query, str) or not isinstance(limit, int)
+                or not all(value is None or isinstance(value, str) for value in (room_name, *filters))
+                or (before is not None and not isinstance(before, int))):
+            await client.send_message({
+                'type': 'error',
+                'message': 'Invalid search_history request'
+            })
+            return
+        
+        messages, next_before = await self.history_store.search(query, room_name, *filters, before, limit)
+        await client.send_message({
+            'type': 'search_results',
+            'query': query,
+            'room': room_name,
+            'messages': [dict(m, is_self=m.get('username') == client.username) for m in messages],
+            'next_before': next_before
+        })
+
+    async def send_stats(self, client: ChatClient):
+        if client.username not in self.admin_users:
+            await client.send_message({
+                'type': 'error',
+                'message': 'Not allowed'
+            })
+            return
+        await client.send_message({
+            'type': 'stats',
+            'stats': self.metrics.registry.snapshot()
+        })
 
     async def send_private_message(self, sender: ChatClient, message: dict):
         """Отправка личного сообщения"""
         target_username = message['target']
         private_msg = message['message']
         
-        # Ищем целевого клиента
-        target_client = None
-        for client in self.clients:
-            if client.username == target_username and client.authenticated:
-                target_client = client
-                break
+        incoming = {
+            'type': 'private_message',
+            'message': private_msg,
+            'username': sender.username,
+            'timestamp': datetime.now().isoformat(),
+            'is_self': False
+        }
         
+        # Ищем целевого клиента: сначала на этом процессе, затем через брокер кластера
+        target_client = self.usernames.get(target_username)
         if target_client:
             # Отправляем получателю
-            await target_client.send_message({
-                'type': 'private_message',
-                'message': private_msg,
-                'username': sender.username,
-                'timestamp': datetime.now().isoformat(),
-                'is_self': False
-            })
-            
+            await target_client.send_message(incoming)
+            delivered = True
+        else:
+            delivered = bool(self.bus) and await self.bus.direct(target_username, incoming)
+        
+        if delivered:
             # Отправляем отправителю (чтобы он видел свое сообщение)
             await sender.send_message({
                 'type': 'private_message',
@@ -309,25 +1156,15 @@ class ChatServer:
             })
 
     async def handle_file_upload(self, client: ChatClient, message: dict):
-        """Обработка загрузки файла"""
-        filename = message['filename']
+        """Обработка загрузки файла одним сообщением (base64 в JSON)"""
+        filename = os.path.basename(message['filename'])
         file_data = message['data']  # base64 encoded
         
-        # Сохраняем файл
-        filepath = os.path.join(self.file_storage, filename)
+        # Сохраняем файл вне event loop
         try:
-            import base64
-            with open(filepath, 'wb') as f:
-                f.write(base64.b64decode(file_data))
-            
-            # Уведомляем комнату о загруженном файле (включая отправителя)
-            if client.current_room:
-                await client.current_room.broadcast({
-                    'type': 'file_upload',
-                    'filename': filename,
-                    'username': client.username,
-                    'message': f'uploaded file: {filename}'
-                }, client)
+            data = base64.b64decode(file_data)
+            stored_name, content_id = await self.upload_store.put_bytes(filename, data)
+            await self.announce_upload(client, stored_name, content_id, len(data))
                 
         except Exception as e:
             logger.error(f"Error uploading file: {e}")
@@ -336,8 +1173,206 @@ class ChatServer:
                 'message': f'File upload failed: {str(e)}'
             })
 
+    async def announce_upload(self, client: ChatClient, filename: str, content_id: str, size: int):
+        """Уведомление комнаты о загруженном файле (включая отправителя).
+        Рассылку выполняет обработчик комнаты, после уже принятых сообщений"""
+        room = client.current_room
+        if room:
+            await room.ingress.put((client, {
+                'type': 'file_upload',
+                'filename': filename,
+                'username': client.username,
+                'message': f'uploaded file: {filename}',
+                'content_id': content_id,
+                'size': size
+            }, None, time.perf_counter()))
+
+    async def announce(self, room: ChatRoom, client: ChatClient, message: dict):
+        """Рассылка кадра, поставленного в очередь комнаты самим сервером"""
+        try:
+            await room.broadcast(message, client)
+        except Exception as e:
+            logger.error(f"Error broadcasting {message['type']} to room {room.name}: {e}")
+
+    async def upload_error(self, client: ChatClient, upload_id: Optional[str], reason: str):
+        await client.send_message({
+            'type': 'upload_error',
+            'upload_id': upload_id,
+            'message': f'File upload failed: {reason}'
+        })
+
+    async def begin_upload(self, client: ChatClient, message: dict):
+        """Начало потоковой загрузки: upload_begin -> upload_ready"""
+        upload_id = str(message.get('upload_id', ''))
+        filename = os.path.basename(str(message.get('filename', '')))
+        size = message.get('size')
+        
+        if not upload_id or upload_id in client.uploads:
+            await self.upload_error(client, upload_id, 'invalid upload id')
+            return
+        if not filename or not isinstance(size, int) or not 0 <= size <= MAX_UPLOAD_SIZE:
+            await self.upload_error(client, upload_id, 'invalid file name or size')
+            return
+        if len(client.uploads) >= MAX_CONCURRENT_UPLOADS:
+            await self.upload_error(client, upload_id, 'too many concurrent uploads')
+            return
+        
+        try:
+            temp_path, file = await self.upload_store.open_temp()
+        except OSError as e:
+            logger.error(f"Error starting upload: {e}")
+            await self.upload_error(client, upload_id, str(e))
+            return
+        
+        client.uploads[upload_id] = FileTransfer(upload_id, filename, size, temp_path, file)
+        await client.send_message({
+            'type': 'upload_ready',
+            'upload_id': upload_id,
+            'chunk_size': UPLOAD_CHUNK_SIZE
+        })
+
+    async def receive_upload_chunk(self, client: ChatClient, message: dict):
+        """Приём очередного куска. Кусок пишется на диск до чтения следующего,
+        поэтому в памяти на одну загрузку держится не больше одного куска"""
+        upload_id = message.get('upload_id')
+        transfer = client.uploads.get(upload_id)
+        if transfer is None:
+            # Загрузка уже отменена - остальные куски молча отбрасываем
+            return
+        
+        try:
+            if message.get('seq') != transfer.next_seq:
+                raise ValueError(f"unexpected chunk {message.get('seq')}, "
+                                 f"expected {transfer.next_seq}")
+            data = message['data']
+            if isinstance(data, str):
+                # В JSON кусок передается в base64, в бинарном кодеке - как есть
+                data = base64.b64decode(data)
+            if len(data) > UPLOAD_CHUNK_SIZE or transfer.received + len(data) > transfer.size:
+                raise ValueError('chunk exceeds declared size')
+            await self.upload_store.write_chunk(transfer.file, transfer.hasher, data)
+        except Exception as e:
+            logger.error(f"Error receiving upload chunk: {e}")
+            await self.abort_upload(client, upload_id)
+            await self.upload_error(client, upload_id, str(e))
+            return
+        
+        transfer.next_seq += 1
+        transfer.received += len(data)
+
+    async def commit_upload(self, client: ChatClient, message: dict):
+        """Завершение загрузки: проверка размера и перенос файла в хранилище"""
+        upload_id = message.get('upload_id')
+        transfer = client.uploads.get(upload_id)
+        if transfer is None:
+            return
+        
+        if transfer.received != transfer.size:
+            await self.abort_upload(client, upload_id)
+            await self.upload_error(client, upload_id, 'incomplete file')
+            return
+        
+        del client.uploads[upload_id]
+        try:
+            stored_name, content_id = await self.upload_store.commit(
+                transfer.temp_path, transfer.file, transfer.hasher, transfer.filename, transfer.size)
+        except (OSError, sqlite3.Error) as e:
+            logger.error(f"Error committing upload: {e}")
+            await self.upload_store.discard(transfer.temp_path, transfer.file)
+            await self.upload_error(client, upload_id, str(e))
+            return
+        
+        await self.announce_upload(client, stored_name, content_id, transfer.size)
+
+    async def abort_upload(self, client: ChatClient, upload_id: Optional[str]):
+        """Отмена загрузки и удаление временного файла"""
+        transfer = client.uploads.pop(upload_id, None)
+        if transfer is None:
+            return
+        await self.upload_store.discard(transfer.temp_path, transfer.file)
+
+    async def request_download(self, client: ChatClient, message: dict):
+        """Выдача токена на скачивание файла по content_id или имени"""
+        content_id = message.get('content_id')
+        filename = message.get('filename')
+        size = None
+        if isinstance(content_id, str):
+            size = await self.upload_store.size(content_id)
+        elif isinstance(filename, str):
+            found = await self.upload_store.resolve(filename)
+            if found:
+                content_id, size = found
+        
+        if size is None:
+            await client.send_message({
+                'type': 'download_error',
+                'download_id': message.get('download_id'),
+                'message': 'File not found'
+            })
+            return
+        
+        await client.send_message({
+            'type': 'download_ready',
+            'download_id': message.get('download_id'),
+            'content_id': content_id,
+            'filename': filename,
+            'size': size,
+            'token': self.transfer_tokens.issue(content_id)
+        })
+
+    async def serve_transfer(self, client: ChatClient, message: dict):
+        """Передача файла (или его части) по отдельному подключению через sendfile"""
+        # Кадры чата (например, ping) в этот поток байт больше не попадут
+        client.closing = True
+        writer = client.writer
+        
+        async def refuse(reason: str):
+            writer.write(JSON_CODEC.encode({'type': 'transfer_error', 'message': reason}))
+            await writer.drain()
+        
+        content_id = self.transfer_tokens.verify(message.get('token'))
+        size = content_id and await self.upload_store.size(content_id)
+        if size is None:
+            await refuse('invalid or expired token')
+            return
+        offset = message.get('offset', 0)
+        length = message.get('length')
+        if not isinstance(offset, int) or not 0 <= offset <= size:
+            await refuse('invalid offset')
+            return
+        count = size - offset
+        if isinstance(length, int) and length >= 0:
+            count = min(count, length)
+        
+        try:
+            file = await self.upload_store.open_blob(content_id)
+        except OSError as e:
+            logger.error(f"Error opening blob {content_id}: {e}")
+            await refuse('file unavailable')
+            return
+        
+        def sent(amount: int):
+            self.metrics.download_bytes.inc(amount)
+            # Идущая передача - признак живого подключения
+            client.last_seen = time.monotonic()
+        
+        try:
+            writer.write(JSON_CODEC.encode({
+                'type': 'transfer_start', 'offset': offset, 'length': count, 'size': size
+            }))
+            await writer.drain()
+            await send_file_range(writer, file, offset, count, self.download_rate, sent)
+        except (ConnectionError, OSError) as e:
+            logger.debug("Transfer of %s interrupted: %s", content_id, e)
+        finally:
+            await self.upload_store.close_file(file)
+
     async def cleanup_client(self, client: ChatClient):
         """Очистка при отключении клиента"""
+        # Незавершенные загрузки отменяем
+        for upload_id in list(client.uploads):
+            await self.abort_upload(client, upload_id)
+        
         if client.current_room and client.username:
             await client.current_room.broadcast_to_others({
                 'type': 'system',
@@ -347,6 +1382,8 @@ class ChatServer:
             client.current_room.remove_client(client)
         
         self.clients.discard(client)
+        self.release_username(client)
+        await client.stop_writer()
         
         try:
             client.writer.close()
@@ -354,22 +1391,218 @@ class ChatServer:
         except Exception:
             pass
         
-        logger.info(f"Client {client.username} disconnected")
+        logger.debug("Client %s disconnected", client.username)
+
+    def enable_keepalive(self, writer: asyncio.StreamWriter):
+        """TCP keepalive: обрыв подключения клиента без heartbeat обнаруживает ОС"""
+        sock = writer.get_extra_info('socket')
+        if sock is None:
+            return
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if self.idle_timeout and hasattr(socket, 'TCP_KEEPIDLE'):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(int(self.idle_timeout), 1))
+        except OSError as e:
+            logger.warning(f"Failed to enable TCP keepalive: {e}")
+
+    async def reap_idle_clients(self):
+        """Периодический обход подключений: молчащим - ping, не ответившим - отключение.
+        Один таймер на весь сервер вместо таймера на каждое подключение"""
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            now = time.monotonic()
+            self.sessions.purge()
+            for client in list(self.clients):
+                idle = now - client.last_seen
+                # Неаутентифицированное подключение молчит не дольше idle_timeout
+                reapable = client.heartbeat or not client.authenticated
+                if reapable and idle >= self.idle_timeout:
+                    logger.info(f"Client {client.username or client.address} idle for {idle:.0f}s, disconnecting")
+                    self.metrics.idle_disconnects.inc()
+                    # Цикл чтения получит EOF, и handle_client выполнит cleanup_client
+                    client.abort()
+                elif idle >= self.heartbeat_interval:
+                    client.send_frame(PING_FRAME)
+
+    def handle_bus_event(self, event: dict):
+        """События брокера кластера (вызывается синхронно, в порядке поступления)"""
+        op = event['op']
+        
+        if op == 'room_state':
+            room = self.rooms.get(event['room'])
+            if room:
+                room.apply_snapshot(event['last_seq'], event['history'])
+        
+        elif op == 'deliver':
+            room = self.rooms.get(event['room'])
+            if room is None:
+                return
+            if 'exclude' in event:
+                room.deliver_notice(Frame(event['message']), self.usernames.get(event['exclude']))
+            else:
+                room.deliver(event['message'], self.usernames.get(event['sender']))
+        
+        elif op == 'direct':
+            client = self.usernames.get(event['target'])
+            if client:
+                client.send_frame(Frame(event['message']))
+        
+        elif op == 'kick':
+            # Сессию продолжил клиент, подключившийся к другому воркеру
+            client = self.usernames.get(event['username'])
+            if client:
+                self.drop_replaced_client(client)
+        
+        elif op == 'closed':
+            # Без брокера воркер не может работать согласованно с остальными
+            logger.error("Cluster bus connection lost, stopping worker")
+            if self.server:
+                self.server.close()
+
+    async def start(self) -> asyncio.AbstractServer:
+        """Открытие журнала истории и начало приема подключений"""
+        await self.history_store.open()
+        await self.upload_store.open()
+        if self.capture_path:
+            self.capture = CaptureWriter(self.capture_path)
+            logger.info(f"Capturing inbound traffic to {self.capture_path}")
+        if self.bus_path:
+            self.bus = BusClient(self.bus_path, self.handle_bus_event)
+            await self.bus.connect()
+        
+        # Создаем общую комнату по умолчанию
+        await self.open_room(DEFAULT_ROOM)
+        # Лимит StreamReader ограничивает строку JSON и буфер чтения подключения
+        # (чтение из сокета приостанавливается, когда в буфере больше 2 * limit)
+        self.server = await asyncio.start_server(
+            self.handle_client, self.host, self.port,
+            reuse_port=self.reuse_port or None,
+            limit=self.stream_limit or self.rate_limits.max_frame_size
+        )
+        # При port=0 система выбирает свободный порт
+        self.port = self.server.sockets[0].getsockname()[1]
+        if self.metrics_port is not None:
+            self.metrics_server = await serve_metrics(self.metrics.registry, self.host, self.metrics_port)
+        if self.heartbeat_interval:
+            self.reaper_task = asyncio.create_task(self.reap_idle_clients())
+        if self.room_ttl:
+            self.sweeper_task = asyncio.create_task(self.evict_idle_rooms())
+        return self.server
 
     async def start_server(self):
         """Запуск сервера"""
-        server = await asyncio.start_server(
-            self.handle_client, self.host, self.port
-        )
+        server = await self.start()
         
         logger.info(f"Chat server started on {self.host}:{self.port}")
         
-        async with server:
-            await server.serve_forever()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if self.reaper_task:
+                self.reaper_task.cancel()
+            if self.sweeper_task:
+                self.sweeper_task.cancel()
+            for room in self.rooms.values():
+                room.worker.cancel()
+            if self.metrics_server:
+                self.metrics_server.close()
+            await self.history_store.close()
+            await self.upload_store.close()
+            if self.capture:
+                self.capture.close()
+
+def valid_room_name(room_name) -> bool:
+    return isinstance(room_name, str) and 0 < len(room_name) <= MAX_ROOM_NAME
+
+def run_worker(options: dict):
+    """Точка входа процесса-воркера кластера"""
+    asyncio.run(ChatServer(**options).start_server())
+
+async def run_cluster(workers: int, host: str = 'localhost', port: int = 8888,
+                      history_path: str = 'history.db', bus_path: str = 'chat_bus.sock',
+                      metrics_port: Optional[int] = None, **server_options):
+    """Запуск брокера и N воркеров, слушающих один порт через SO_REUSEPORT.
+    Метрики каждый воркер отдает на своем порту: metrics_port + номер воркера.
+    Остальные параметры передаются ChatServer каждого воркера"""
+    if os.path.exists(bus_path):
+        os.remove(bus_path)
+    broker = Broker(bus_path, history_path, server_options.get('room_ttl', ROOM_TTL),
+                    server_options.get('session_ttl', SESSION_TTL))
+    await broker.start()
+    
+    # Общий секрет токенов скачивания: подключение для передачи может попасть на любой воркер
+    options = {**server_options, 'host': host, 'port': port, 'history_path': history_path,
+               'reuse_port': True, 'bus_path': bus_path, 'transfer_secret': os.urandom(32).hex()}
+    context = multiprocessing.get_context('spawn')
+    processes = [
+        context.Process(target=run_worker, daemon=True, args=({
+            **options, 'metrics_port': None if metrics_port is None else metrics_port + index,
+            # Каждый воркер пишет трафик в свой файл
+            'capture_path': options.get('capture_path') and f"{options['capture_path']}.{index}"
+        },))
+        for index in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    logger.info(f"Started {workers} workers on {host}:{port}")
+    
+    try:
+        await broker.serve_forever()
+    finally:
+        for process in processes:
+            process.terminate()
 
 async def main():
-    server = ChatServer()
-    await server.start_server()
+    parser = argparse.ArgumentParser(description='Async chat server')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8888)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='число процессов-воркеров (больше 1 - режим кластера)')
+    parser.add_argument('--metrics-port', type=int,
+                        help='порт HTTP-эндпоинта /metrics в формате Prometheus')
+    parser.add_argument('--admin', action='append', default=[],
+                        help='имя пользователя, которому доступно сообщение stats')
+    parser.add_argument('--message-rate', type=float, default=5,
+                        help='сообщений в секунду от одного клиента (message и private_message)')
+    parser.add_argument('--room-rate', type=float, default=100,
+                        help='рассылок в секунду в одну комнату')
+    parser.add_argument('--max-frame-size', type=int, default=64 * 1024,
+                        help='максимальный размер входящего кадра, байт')
+    parser.add_argument('--heartbeat-interval', type=float, default=HEARTBEAT_INTERVAL,
+                        help='через сколько секунд молчания клиенту отправляется ping (0 - отключить)')
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help='через сколько секунд молчания клиент отключается')
+    parser.add_argument('--stream-limit', type=int,
+                        help='лимит буфера чтения подключения, байт (по умолчанию --max-frame-size)')
+    parser.add_argument('--write-buffer-limit', type=int,
+                        help='верхняя граница буфера записи транспорта, байт')
+    parser.add_argument('--room-ttl', type=float, default=ROOM_TTL,
+                        help='через сколько секунд пустая комната выгружается из памяти (0 - никогда)')
+    parser.add_argument('--session-ttl', type=float, default=SESSION_TTL,
+                        help='сколько секунд имя отключившегося пользователя ждет его переподключения')
+    parser.add_argument('--capture',
+                        help='записывать входящие кадры в файл для replay.py (в кластере - файл на воркер)')
+    parser.add_argument('--download-rate', type=float, default=DOWNLOAD_RATE,
+                        help='ограничение скорости отдачи файла на подключение, байт/с (0 - без ограничения)')
+    args = parser.parse_args()
+    
+    # Емкость корзины - двойной запас на короткие всплески
+    message_limit = (args.message_rate, args.message_rate * 2)
+    rate_limits = RateLimits(per_type={'message': message_limit, 'private_message': message_limit},
+                             room_limit=(args.room_rate, args.room_rate * 2),
+                             max_frame_size=args.max_frame_size)
+    options = {'admin_users': args.admin, 'rate_limits': rate_limits,
+               'heartbeat_interval': args.heartbeat_interval, 'idle_timeout': args.idle_timeout,
+               'stream_limit': args.stream_limit, 'write_buffer_limit': args.write_buffer_limit,
+               'download_rate': args.download_rate, 'room_ttl': args.room_ttl,
+               'session_ttl': args.session_ttl, 'capture_path': args.capture}
+    if args.workers > 1:
+        await run_cluster(args.workers, args.host, args.port,
+                          metrics_port=args.metrics_port, **options)
+    else:
+        server = ChatServer(args.host, args.port, metrics_port=args.metrics_port, **options)
+        await server.start_server()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,63 @@
+# sessions.py
+import time
+from typing import Any, Dict, Optional, Tuple
+
+# Сколько секунд имя отключившегося пользователя остается за его сессией
+SESSION_TTL = 60.0
+
+class SessionRegistry:
+    """Реестр имен пользователей и их сессий.
+
+    Имя занято, пока подключен его владелец, и еще ttl секунд после
+    отключения (release с ttl > 0): в это время занять его может только клиент
+    с токеном той же сессии. Владелец - любой объект (клиент на сервере или воркер на брокере)"""
+
+    def __init__(self):
+        self.owners: Dict[str, Any] = {}
+        self.tokens: Dict[str, str] = {}
+        # Имя -> момент, когда истекает бронь отключившейся сессии
+        self.reserved: Dict[str, float] = {}
+
+    def claim(self, name: str, token: str, owner) -> Tuple[bool, bool, Any]:
+        """Занять имя за сессией token. Возвращает (успех, возобновлена ли сессия,
+        прежний владелец, которого нужно отключить)"""
+        held = self.tokens.get(name)
+        expires = self.reserved.get(name)
+        if expires is not None and expires <= time.monotonic():
+            self.forget(name)
+            held = None
+        if held is not None and held != token:
+            return False, False, None
+
+        previous = self.owners.get(name)
+        self.owners[name] = owner
+        self.tokens[name] = token
+        self.reserved.pop(name, None)
+        return True, held is not None, previous if previous is not owner else None
+
+    def release(self, name: str, owner, ttl: float):
+        """Владелец отключился: имя остается за сессией еще ttl секунд"""
+        if self.owners.get(name) is not owner:
+            return
+        del self.owners[name]
+        if ttl > 0:
+            self.reserved[name] = time.monotonic() + ttl
+        else:
+            self.tokens.pop(name, None)
+
+    def forget(self, name: str):
+        self.owners.pop(name, None)
+        self.tokens.pop(name, None)
+        self.reserved.pop(name, None)
+
+    def owned_by(self, owner) -> list:
+        return [name for name, current in self.owners.items() if current is owner]
+
+    def purge(self):
+        """Удаление истекших броней"""
+        now = time.monotonic()
+        for name in [n for n, expires in self.reserved.items() if expires <= now]:
+            self.forget(name)
+
+    def owner(self, name: str) -> Optional[Any]:
+        return self.owners.get(name)
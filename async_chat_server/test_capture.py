@@ -0,0 +1,75 @@
+# test_capture.py
+"""Запись трафика и воспроизведение: загрузка файла клиентом bin1 (сырые байты в кадрах)"""
+import asyncio
+import os
+from typing import Tuple
+
+from capture import load_connections
+from protocol import BINARY_CODEC, JSON_CODEC
+from replay import replay
+from server import ChatServer, UPLOAD_CHUNK_SIZE
+
+async def run_server(**options) -> Tuple[ChatServer, asyncio.Task]:
+    server = ChatServer('localhost', 0, heartbeat_interval=0, room_ttl=0, **options)
+    task = asyncio.create_task(server.start_server())
+    while server.server is None:
+        await asyncio.sleep(0.01)
+    return server, task
+
+async def stop_server(task: asyncio.Task):
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+async def read_until(reader, codec, msg_type: str) -> dict:
+    while True:
+        message = await asyncio.wait_for(codec.read(reader), 5)
+        assert message is not None, f'connection closed before {msg_type}'
+        if message['type'] == msg_type:
+            return message
+
+async def upload_bin1(port: int, payload: bytes):
+    reader, writer = await asyncio.open_connection('localhost', port)
+    writer.write(JSON_CODEC.encode({'type': 'auth', 'username': 'uploader', 'codecs': ['bin1']}))
+    reply = await read_until(reader, JSON_CODEC, 'auth_success')
+    assert reply['codec'] == BINARY_CODEC.name
+
+    writer.write(BINARY_CODEC.encode({'type': 'upload_begin', 'upload_id': 'u1',
+                                      'filename': 'data.bin', 'size': len(payload)}))
+    await read_until(reader, BINARY_CODEC, 'upload_ready')
+    for seq, start in enumerate(range(0, len(payload), UPLOAD_CHUNK_SIZE)):
+        writer.write(BINARY_CODEC.encode({'type': 'upload_chunk', 'upload_id': 'u1', 'seq': seq,
+                                          'data': payload[start:start + UPLOAD_CHUNK_SIZE]}))
+    writer.write(BINARY_CODEC.encode({'type': 'upload_commit', 'upload_id': 'u1'}))
+    done = await read_until(reader, BINARY_CODEC, 'file_upload')
+    assert done['size'] == len(payload)
+    writer.close()
+
+def test_bin1_upload_capture_and_replay(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    payload = os.urandom(3 * UPLOAD_CHUNK_SIZE + 100)
+
+    async def record():
+        server, task = await run_server(history_path='recorded.db', capture_path='traffic.cap')
+        await upload_bin1(server.port, payload)
+        await asyncio.sleep(0.1)
+        assert server.metrics.decode_errors.value == 0
+        await stop_server(task)
+
+    asyncio.run(record())
+
+    connections = load_connections('traffic.cap')
+    frames = [message for record in connections.values() for _, message in record['frames']]
+    chunks = [message['data'] for message in frames if message['type'] == 'upload_chunk']
+    assert all(isinstance(chunk, bytes) for chunk in chunks)
+    assert b''.join(chunks) == payload
+
+    async def play():
+        server, task = await run_server(history_path='replayed.db')
+        result = await replay(connections, 'localhost', server.port, 0.0)
+        await stop_server(task)
+        return result
+
+    result = asyncio.run(play())
+    assert result['connections'] == 1
+    assert result['errors'] == 0 and result['unanswered'] == 0
+    assert result['latency_ms']['upload_commit']['count'] == 1
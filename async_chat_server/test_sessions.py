@@ -0,0 +1,47 @@
+# test_sessions.py
+"""Бронь имени после разрыва: только для клиентов, просивших продолжаемую сессию"""
+import asyncio
+
+from protocol import JSON_CODEC
+from test_capture import read_until, run_server, stop_server
+
+async def login(port: int, **auth) -> dict:
+    reader, writer = await asyncio.open_connection('localhost', port)
+    writer.write(JSON_CODEC.encode({'type': 'auth', **auth}))
+    while True:
+        reply = await asyncio.wait_for(JSON_CODEC.read(reader), 5)
+        if reply['type'] in ('auth_success', 'auth_error'):
+            break
+    writer.close()
+    await writer.wait_closed()
+    return reply
+
+async def wait_released(server, username: str):
+    while username in server.usernames:
+        await asyncio.sleep(0.01)
+
+def test_legacy_reconnect_with_same_name():
+    async def main():
+        server, task = await run_server()
+        first = await login(server.port, username='a')
+        assert first['type'] == 'auth_success'
+        await wait_released(server, 'a')
+        again = await login(server.port, username='a')
+        assert again['type'] == 'auth_success' and not again['resumed']
+        await stop_server(task)
+
+    asyncio.run(main())
+
+def test_resumable_session_keeps_name():
+    async def main():
+        server, task = await run_server()
+        first = await login(server.port, username='a', resume=True)
+        assert first['type'] == 'auth_success'
+        await wait_released(server, 'a')
+        taken = await login(server.port, username='a')
+        assert taken['type'] == 'auth_error'
+        resumed = await login(server.port, username='a', session=first['session'])
+        assert resumed['type'] == 'auth_success' and resumed['resumed']
+        await stop_server(task)
+
+    asyncio.run(main())
@@ -0,0 +1,74 @@
+# transfer.py
+"""Отдача загруженных файлов по отдельному подключению.
+
+Клиент запрашивает файл в чате (download_file) и получает токен. Затем он
+открывает новое подключение к тому же порту и первым кадром (JSON) отправляет
+{"type": "transfer", "token": ..., "offset": N, "length": M}. Сервер отвечает
+строкой transfer_start, после которой идут сырые байты файла, переданные
+через sendfile (минуя буферы Python и кодек), и закрывает подключение.
+Докачка - повторный transfer с offset, равным уже полученному размеру.
+
+Токен подписан общим секретом процессов, поэтому подключение для передачи
+может попасть на любой воркер кластера"""
+import asyncio
+import hashlib
+import hmac
+import time
+from typing import Callable, Optional
+
+from ratelimit import TokenBucket
+
+# Срок действия токена: в течение него можно докачивать файл
+TRANSFER_TOKEN_TTL = 600
+# Максимальная порция одного вызова sendfile
+TRANSFER_SLICE = 1024 * 1024
+
+class TransferTokens:
+    """Выдача и проверка токенов вида content_id:expires:signature"""
+
+    def __init__(self, secret: bytes, ttl: float = TRANSFER_TOKEN_TTL):
+        self.secret = secret
+        self.ttl = ttl
+
+    def _sign(self, payload: str) -> str:
+        return hmac.new(self.secret, payload.encode(), hashlib.sha256).hexdigest()[:32]
+
+    def issue(self, content_id: str) -> str:
+        payload = f'{content_id}:{int(time.time() + self.ttl)}'
+        return f'{payload}:{self._sign(payload)}'
+
+    def verify(self, token) -> Optional[str]:
+        """content_id из действительного токена, иначе None"""
+        if not isinstance(token, str) or token.count(':') != 2:
+            return None
+        content_id, expires, signature = token.split(':')
+        if not hmac.compare_digest(signature, self._sign(f'{content_id}:{expires}')):
+            return None
+        if not expires.isdigit() or int(expires) < time.time():
+            return None
+        return content_id
+
+async def send_file_range(writer: asyncio.StreamWriter, file, offset: int, count: int,
+                          rate: Optional[float] = None,
+                          on_sent: Optional[Callable[[int], None]] = None) -> int:
+    """Передача count байт файла начиная с offset через loop.sendfile.
+    rate - ограничение скорости, байт в секунду. Возвращает число отправленных байт"""
+    loop = asyncio.get_running_loop()
+    bucket = TokenBucket(rate, rate) if rate else None
+    # Порции поменьше при ограничении скорости, чтобы поток был ровнее
+    slice_size = min(TRANSFER_SLICE, max(64 * 1024, int(rate / 4))) if rate else TRANSFER_SLICE
+    total = 0
+    while count > 0:
+        sent = await loop.sendfile(writer.transport, file, offset, min(count, slice_size))
+        if not sent:
+            break
+        offset += sent
+        count -= sent
+        total += sent
+        if on_sent:
+            on_sent(sent)
+        if bucket:
+            delay = bucket.delay(sent)
+            if delay:
+                await asyncio.sleep(delay)
+    return total
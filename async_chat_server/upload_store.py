@@ -0,0 +1,221 @@
+# upload_store.py
+import asyncio
+import hashlib
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Optional, Tuple
+
+# Временный файл старше этого удаляется при открытии хранилища, даже если
+# процесс с его pid жив (pid мог достаться другому процессу)
+STALE_TEMP_AGE = 24 * 3600
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # процесс есть, но принадлежит другому пользователю
+        return True
+    return True
+
+class UploadStore:
+    """Хранилище загруженных файлов с адресацией по содержимому.
+
+    Файл хранится один раз под своим SHA-256 (blobs/ab/abcdef...), имена файлов
+    ссылаются на содержимое через индекс в SQLite. Повторная загрузка того же
+    файла места на диске не занимает, а имя, занятое другим содержимым, не
+    перезаписывается - новому файлу дается имя "name (2).ext". Имена не удаляются,
+    поэтому содержимое хранится бессрочно: сборки мусора в хранилище нет.
+
+    Запись кусков выполняется в ограниченном пуле потоков, индекс и перенос
+    файлов в blobs - в одном отдельном потоке, поэтому операции индекса
+    не пересекаются между собой"""
+
+    def __init__(self, root: str = 'uploads', io_workers: int = 4):
+        self.root = root
+        self.blob_dir = os.path.join(root, 'blobs')
+        self.temp_dir = os.path.join(root, 'tmp')
+        self.io = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix='uploads')
+        self.index = ThreadPoolExecutor(max_workers=1, thread_name_prefix='upload-index')
+        self.conn: Optional[sqlite3.Connection] = None
+
+    async def open(self):
+        await self._run_index(self._connect)
+
+    def _connect(self):
+        os.makedirs(self.blob_dir, exist_ok=True)
+        os.makedirs(self.temp_dir, exist_ok=True)
+        self._sweep_temp()
+        # isolation_level=None: транзакции открываются явно через BEGIN IMMEDIATE,
+        # так индекс согласован и между процессами кластера
+        self.conn = sqlite3.connect(os.path.join(self.root, 'index.db'),
+                                    check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA busy_timeout=5000')
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS blobs (
+                content_id TEXT PRIMARY KEY,
+                size INTEGER NOT NULL
+            ) WITHOUT ROWID
+        """)
+        self._drop_refs_column()
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS names (
+                name TEXT PRIMARY KEY,
+                content_id TEXT NOT NULL
+            ) WITHOUT ROWID
+        """)
+
+    def _drop_refs_column(self):
+        # Индекс прежней версии хранил счетчик ссылок, который только рос
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            columns = {row[1] for row in self.conn.execute('PRAGMA table_info(blobs)')}
+            if 'refs' in columns:
+                self.conn.execute('ALTER TABLE blobs DROP COLUMN refs')
+            self.conn.execute('COMMIT')
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+
+    def _sweep_temp(self):
+        """Удаление .part, оставшихся от прерванных загрузок и упавших процессов.
+        Файлы живых воркеров кластера (pid в имени) не трогаются"""
+        now = time.time()
+        for entry in os.scandir(self.temp_dir):
+            if not entry.name.endswith('.part'):
+                continue
+            pid = entry.name.split('-', 1)[0]
+            try:
+                stale = (not pid.isdigit() or not _process_alive(int(pid))
+                         or now - entry.stat().st_mtime > STALE_TEMP_AGE)
+                if stale:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    async def _run_io(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.io, func, *args)
+
+    async def _run_index(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.index, func, *args)
+
+    def blob_path(self, content_id: str) -> str:
+        return os.path.join(self.blob_dir, content_id[:2], content_id)
+
+    async def open_temp(self) -> Tuple[str, BinaryIO]:
+        """Временный файл для потоковой загрузки (имя не зависит от данных клиента)"""
+        path = os.path.join(self.temp_dir, f'{os.getpid()}-{os.urandom(8).hex()}.part')
+        return path, await self._run_io(open, path, 'wb')
+
+    async def write_chunk(self, file: BinaryIO, hasher, data: bytes):
+        """Запись куска и обновление хэша (hashlib отпускает GIL на больших кусках)"""
+        await self._run_io(self._write_chunk, file, hasher, data)
+
+    @staticmethod
+    def _write_chunk(file: BinaryIO, hasher, data: bytes):
+        file.write(data)
+        hasher.update(data)
+
+    async def discard(self, temp_path: str, file: BinaryIO):
+        """Отмена загрузки: закрыть и удалить временный файл"""
+        await self._run_io(self._discard, temp_path, file)
+
+    @staticmethod
+    def _discard(temp_path: str, file: BinaryIO):
+        file.close()
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+
+    async def commit(self, temp_path: str, file: BinaryIO, hasher, name: str, size: int) -> Tuple[str, str]:
+        """Завершение загрузки. Возвращает (имя в хранилище, content_id)"""
+        await self._run_io(file.close)
+        return await self._run_index(self._commit, temp_path, hasher.hexdigest(), name, size)
+
+    async def put_bytes(self, name: str, data: bytes) -> Tuple[str, str]:
+        """Сохранение файла, пришедшего целиком"""
+        temp_path, file = await self.open_temp()
+        hasher = hashlib.sha256()
+        try:
+            await self.write_chunk(file, hasher, data)
+        except BaseException:
+            await self.discard(temp_path, file)
+            raise
+        return await self.commit(temp_path, file, hasher, name, len(data))
+
+    def _commit(self, temp_path: str, content_id: str, name: str, size: int) -> Tuple[str, str]:
+        conn = self.conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if conn.execute('SELECT 1 FROM blobs WHERE content_id = ?', (content_id,)).fetchone():
+                # Такое содержимое уже хранится
+                os.remove(temp_path)
+            else:
+                path = self.blob_path(content_id)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temp_path, path)
+
+            stored_name = self._free_name(name, content_id)
+            if stored_name is not None:
+                conn.execute('INSERT INTO names (name, content_id) VALUES (?, ?)', (stored_name, content_id))
+                conn.execute("""
+                    INSERT INTO blobs (content_id, size) VALUES (?, ?)
+                    ON CONFLICT (content_id) DO NOTHING
+                """, (content_id, size))
+            else:
+                # То же имя с тем же содержимым: ничего не меняется
+                stored_name = name
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return stored_name, content_id
+
+    def _free_name(self, name: str, content_id: str) -> Optional[str]:
+        """Имя для нового файла: исходное, если свободно, иначе "stem (n).ext".
+        None - это имя уже указывает на то же содержимое"""
+        stem, ext = os.path.splitext(name)
+        candidate, n = name, 1
+        while True:
+            row = self.conn.execute('SELECT content_id FROM names WHERE name = ?', (candidate,)).fetchone()
+            if row is None:
+                return candidate
+            if row[0] == content_id:
+                return None
+            n += 1
+            candidate = f'{stem} ({n}){ext}'
+
+    async def resolve(self, name: str) -> Optional[Tuple[str, int]]:
+        """content_id и размер файла по имени"""
+        return await self._run_index(self._resolve, name)
+
+    def _resolve(self, name: str) -> Optional[Tuple[str, int]]:
+        return self.conn.execute("""
+            SELECT n.content_id, b.size FROM names n JOIN blobs b ON b.content_id = n.content_id
+            WHERE n.name = ?
+        """, (name,)).fetchone()
+
+    async def size(self, content_id: str) -> Optional[int]:
+        """Размер хранимого содержимого или None, если его нет"""
+        return await self._run_index(self._size, content_id)
+
+    def _size(self, content_id: str) -> Optional[int]:
+        row = self.conn.execute('SELECT size FROM blobs WHERE content_id = ?', (content_id,)).fetchone()
+        return row and row[0]
+
+    async def open_blob(self, content_id: str) -> BinaryIO:
+        return await self._run_io(open, self.blob_path(content_id), 'rb')
+
+    async def close_file(self, file: BinaryIO):
+        await self._run_io(file.close)
+
+    async def close(self):
+        if self.conn is not None:
+            await self._run_index(self.conn.close)
+        self.index.shutdown(wait=True)
+        self.io.shutdown(wait=True)
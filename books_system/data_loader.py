@@ -1,11 +1,193 @@
+import hashlib
 import json
-from typing import Dict, List
+import os
+from collections.abc import Sequence
+from functools import cached_property
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import vector_engine
+from keyword_index import KeywordIndex, build_keyword_index
+from recommender import PRESORTED_MODES, normalize_book, sort_permutation
+from snapshot import Snapshot, open_snapshot, snapshot_path, write_snapshot
 
 Book = Dict[str, object]
 
 
+def _is_json_lines(f) -> bool:
+    # JSON-массив начинается с "[", все остальное читаем как JSON Lines
+    while True:
+        chunk = f.read(4096)
+        if not chunk or chunk.strip():
+            f.seek(0)
+            return not chunk.lstrip().startswith(b"[")
+
+
+def _records(path: str, digest=None) -> Iterator[Book]:
+    """Записи файла по одной; прочитанные байты добавляются в digest (hashlib), если он задан.
+    JSON Lines разбирается построчно, не читая файл целиком"""
+    with open(path, "rb") as f:
+        if not _is_json_lines(f):
+            raw = f.read()
+            if digest is not None:
+                digest.update(raw)
+            yield from json.loads(raw)  # ожидается список словарей
+            return
+        for line in f:
+            if digest is not None:
+                digest.update(line)
+            if line.strip():
+                yield json.loads(line)
+
+
 # { "title": ..., "author": ..., "genre": ..., "description": ..., "year": ... }
+# JSON-массив таких записей или JSON Lines - по записи на строку
 def read_books(path: str) -> List[Book]:
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)  # ожидается список словарей
-        return list(data)
\ No newline at end of file
+    return list(_records(path))
+
+
+class _Prepared:
+    """Общее для каталогов: индексы поверх normalized, строятся при первом обращении"""
+
+    normalized: Sequence
+
+    @cached_property
+    def keyword_index(self) -> KeywordIndex:
+        return build_keyword_index(self.normalized)
+
+    @cached_property
+    def columns(self) -> "vector_engine.Columns":
+        return vector_engine.build_columns(self.normalized)
+
+    def sort_order(self, mode: str) -> Optional[Sequence]:
+        if mode not in self._orders:
+            self._orders[mode] = sort_permutation(self.normalized, mode)
+        return self._orders[mode]
+
+    def distinct(self, field: str) -> Set[object]:
+        """Различные нормализованные значения поля (genre, author)"""
+        return {b[field] for b in self.normalized}
+
+
+class Catalogue(_Prepared, list):
+    """Каталог книг: сам список - исходные записи (как у read_books),
+    normalized - их нормализованные копии, подготовленные один раз при загрузке,
+    keyword_index - индекс слов названий и описаний, строится при первом поиске,
+    sort_order(mode) - перестановка для сортировки, считается при первом запросе,
+    columns - столбцы для движка numpy, строятся при первом обращении"""
+
+    def __init__(self, books: List[Book], digest: str = "", mtime_ns: int = 0, size: int = 0):
+        super().__init__(books)
+        self.normalized: Tuple[Book, ...] = tuple(map(normalize_book, books))
+        self.digest = digest
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self._orders: Dict[str, Optional[Sequence]] = {}
+
+
+class _LazyNormalized(Sequence):
+    """Нормализованные записи снимка: создаются при первом обращении и запоминаются,
+    так что одна позиция - всегда один и тот же объект (на это опирается keyword_scorer)"""
+
+    def __init__(self, catalogue: "SnapshotCatalogue"):
+        self._catalogue = catalogue
+        self._cache: Dict[int, Book] = {}
+
+    def __len__(self) -> int:
+        return len(self._catalogue)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = range(len(self))[i]
+        book = self._cache.get(i)
+        if book is None:
+            book = self._cache[i] = normalize_book(self._catalogue[i])
+        return book
+
+
+class SnapshotCatalogue(_Prepared, Sequence):
+    """Каталог поверх снимка в памяти (snapshot.py): записи разбираются по обращению,
+    а столбцы движка numpy и перестановки сортировок берутся из файла без копирования"""
+
+    def __init__(self, snapshot: Snapshot, mtime_ns: int, size: int):
+        self.snapshot = snapshot
+        self.normalized = _LazyNormalized(self)
+        self.digest: str = snapshot.source.get("digest", "")
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self._orders: Dict[str, Optional[Sequence]] = {}
+
+    def __len__(self) -> int:
+        return self.snapshot.count
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return self.snapshot.record(range(len(self))[i])
+
+    @cached_property
+    def _values(self) -> Dict[str, list]:
+        return {field: self.snapshot.values(f"{field}_values") for field in ("genre", "author")}
+
+    @cached_property
+    def columns(self) -> "vector_engine.Columns":
+        s = self.snapshot
+        return vector_engine.columns_from_arrays(self._values["genre"], self._values["author"],
+                                                 s.column("genre"), s.column("author"), s.column("year"))
+
+    def sort_order(self, mode: str) -> Optional[Sequence]:
+        if mode not in self._orders and self.snapshot.has(f"order_{mode}"):
+            self._orders[mode] = self.snapshot.column(f"order_{mode}")
+        return super().sort_order(mode)
+
+    def distinct(self, field: str) -> Set[object]:
+        return set(self._values[field])
+
+
+def _save_snapshot(path: str, catalogue: Catalogue):
+    # снимок - только ускорение запуска: если записать не удалось, работаем без него
+    source = {"mtime_ns": catalogue.mtime_ns, "size": catalogue.size, "digest": catalogue.digest}
+    orders = {mode: catalogue.sort_order(mode) for mode in PRESORTED_MODES}
+    try:
+        write_snapshot(snapshot_path(path), catalogue, catalogue.normalized, orders, source)
+    except (OSError, TypeError, ValueError):
+        pass
+
+
+# путь -> последний загруженный каталог
+_catalogues: Dict[str, _Prepared] = {}
+
+
+def load_catalogue(path: str, use_snapshot: bool = True) -> _Prepared:
+    """Каталог из файла с кэшем: пока mtime и размер файла не изменились,
+    возвращается тот же объект; при изменении сверяется хэш содержимого,
+    и каталог перестраивается, только если данные действительно другие.
+    Рядом с файлом хранится снимок (snapshot.py): если он снят с текущей версии
+    файла, каталог открывается из него без разбора JSON, иначе файл
+    разбирается и снимок записывается заново"""
+    key = os.path.abspath(path)
+    st = os.stat(path)
+    cached: Optional[_Prepared] = _catalogues.get(key)
+    if cached is not None and (cached.mtime_ns, cached.size) == (st.st_mtime_ns, st.st_size):
+        return cached
+
+    snapshot = open_snapshot(snapshot_path(path), st.st_mtime_ns, st.st_size) if use_snapshot else None
+    if snapshot is not None:
+        catalogue: _Prepared = SnapshotCatalogue(snapshot, st.st_mtime_ns, st.st_size)
+        if cached is not None and cached.digest == catalogue.digest:
+            cached.mtime_ns, cached.size = st.st_mtime_ns, st.st_size
+            return cached
+        _catalogues[key] = catalogue
+        return catalogue
+
+    digest = hashlib.sha256()
+    books = list(_records(path, digest))
+    if cached is not None and cached.digest == digest.hexdigest():
+        cached.mtime_ns, cached.size = st.st_mtime_ns, st.st_size
+        return cached
+
+    catalogue = Catalogue(books, digest.hexdigest(), st.st_mtime_ns, st.st_size)
+    if use_snapshot:
+        _save_snapshot(path, catalogue)
+    _catalogues[key] = catalogue
+    return catalogue
@@ -12,13 +12,18 @@ from PyQt5.QtWidgets import (
 from PyQt5.QtCore import Qt, QSize
 from PyQt5.QtGui import QPixmap, QImageReader
 
-from data_loader import read_books, Book
+from data_loader import load_catalogue, Book
 from preferences import make_prefs
 from recommender import recommend
+from vector_engine import available as numpy_available
 
 # === путь к данным (JSON без обложек) ===
 DATA_PATH = "books.json"
 DATA_DIR = Path(DATA_PATH).resolve().parent
+# карточек на одной странице выдачи
+PAGE_SIZE = 50
+# движок рекомендаций: numpy, если установлен (результат тот же)
+ENGINE = "numpy" if numpy_available() else "python"
 
 def _abs_cover_path(p: str) -> str:
     # функция больше не используется, можно оставить как заглушку
@@ -63,8 +68,12 @@ class MainWindow(QMainWindow):
         self.resize(960, 700)
 
         # Данные
-        self.books_db: List[Book] = read_books(DATA_PATH)
-        self.recommendations: List[Book] = []
+        # Catalogue - список книг с заранее нормализованными записями;
+        # при повторных запусках открывается из снимка рядом с файлом без разбора JSON
+        self.books_db: List[Book] = load_catalogue(DATA_PATH)
+        self.recommendations: List[Book] = []   # текущая страница
+        self.query: tuple = ()                   # аргументы recommend последнего запроса
+        self.page = 0
         self.to_read: List[Book] = []
 
         # === ЖАНРЫ: компактный выбор через диалог ===
@@ -112,6 +121,10 @@ class MainWindow(QMainWindow):
 
         # Ключевые слова
         self.keywords_edit = QLineEdit()
+        self.keyword_mode_combo = QComboBox()
+        self.keyword_mode_combo.addItem("Подстрока", userData="substring")
+        self.keyword_mode_combo.addItem("Целое слово", userData="word")
+        self.keyword_mode_combo.addItem("Начало слова", userData="prefix")
 
         self.only_genres_cb = QCheckBox("Только указанные жанры")
         self.year_spin = QSpinBox(); self.year_spin.setRange(0, 2100); self.year_spin.setValue(0)
@@ -124,6 +137,9 @@ class MainWindow(QMainWindow):
         self.recommend_btn = QPushButton("Показать рекомендации")
         self.add_to_read_btn = QPushButton("Добавить в «прочитать»")
         self.save_btn = QPushButton("Сохранить рекомендации...")
+        self.prev_btn = QPushButton("← Назад")
+        self.next_btn = QPushButton("Далее →")
+        self.page_label = QLabel()
 
         # Список карточек
         self.cards = QListWidget(); self.cards.setSelectionMode(QListWidget.ExtendedSelection)
@@ -145,7 +161,7 @@ class MainWindow(QMainWindow):
         row_author.addWidget(self.author_combo)
         row_author.addWidget(self.author_tags_scroll, stretch=1)
 
-        row_kw = QHBoxLayout(); row_kw.addWidget(QLabel("Ключевые слова:")); row_kw.addWidget(self.keywords_edit)
+        row_kw = QHBoxLayout(); row_kw.addWidget(QLabel("Ключевые слова:")); row_kw.addWidget(self.keywords_edit); row_kw.addWidget(self.keyword_mode_combo)
 
         filters = QHBoxLayout()
         filters.addWidget(self.only_genres_cb)
@@ -153,7 +169,8 @@ class MainWindow(QMainWindow):
         filters.addStretch(1)
         filters.addWidget(QLabel("Сортировка:")); filters.addWidget(self.sort_combo)
 
-        btns = QHBoxLayout(); btns.addWidget(self.recommend_btn); btns.addWidget(self.add_to_read_btn); btns.addStretch(1); btns.addWidget(self.save_btn)
+        btns = QHBoxLayout(); btns.addWidget(self.recommend_btn); btns.addWidget(self.add_to_read_btn); btns.addStretch(1)
+        btns.addWidget(self.prev_btn); btns.addWidget(self.page_label); btns.addWidget(self.next_btn); btns.addWidget(self.save_btn)
 
         lists = QHBoxLayout()
         lists.addWidget(self.cards, stretch=3)
@@ -170,23 +187,26 @@ class MainWindow(QMainWindow):
         self.recommend_btn.clicked.connect(self.on_recommend)
         self.add_to_read_btn.clicked.connect(self.on_add_to_read)
         self.save_btn.clicked.connect(self.on_save)
+        self.prev_btn.clicked.connect(lambda: self.show_page(self.page - 1))
+        self.next_btn.clicked.connect(lambda: self.show_page(self.page + 1))
 
         self.on_recommend()
 
     # ---- helpers ----
     @staticmethod
-    def _collect_genres(books: List[Book]) -> List[str]:
-        s = {str(b.get("genre","")).strip().lower() for b in books if b.get("genre")}
+    def _collect_genres(books) -> List[str]:
+        # различные значения у каталога уже есть - не перебираем все книги
+        s = {str(g).strip().lower() for g in books.distinct("genre") if g}
         return sorted(s)
 
     @staticmethod
-    def _collect_authors(books: List[Book]) -> List[str]:
-        s = {str(b.get("author","")).strip() for b in books if b.get("author")}
+    def _collect_authors(books) -> List[str]:
+        s = {str(a).strip() for a in books.distinct("author") if a}
         return sorted(s, key=lambda x: x.casefold())
 
-    def fill_cards(self, items: List[Book]):
+    def fill_cards(self, items: List[Book], start: int = 1):
         self.cards.clear()
-        for i, book in enumerate(items, 1):
+        for i, book in enumerate(items, start):
             w = BookCard(book, i)
             it = QListWidgetItem(self.cards); it.setSizeHint(w.sizeHint()); it.setData(Qt.UserRole, book)
             self.cards.addItem(it); self.cards.setItemWidget(it, w)
@@ -291,8 +311,23 @@ class MainWindow(QMainWindow):
         only_genres = self.only_genres_cb.isChecked()
         year_after = int(self.year_spin.value())
         sort_mode = self.sort_combo.currentData()
-        self.recommendations = recommend(self.books_db, prefs, only_genres, year_after, sort_mode)
-        self.fill_cards(self.recommendations)
+        keyword_mode = self.keyword_mode_combo.currentData()
+        # тот же объект, пока файл каталога не изменился
+        self.books_db = load_catalogue(DATA_PATH)
+        self.query = (prefs, only_genres, year_after, sort_mode, keyword_mode)
+        self.show_page(0)
+
+    def show_page(self, page: int):
+        # на одну книгу больше страницы - чтобы знать, есть ли следующая
+        page = max(page, 0)
+        items = recommend(self.books_db, *self.query, limit=PAGE_SIZE + 1, offset=page * PAGE_SIZE,
+                          engine=ENGINE)
+        self.page = page
+        self.recommendations = items[:PAGE_SIZE]
+        self.fill_cards(self.recommendations, page * PAGE_SIZE + 1)
+        self.page_label.setText(f"Стр. {page + 1}")
+        self.prev_btn.setEnabled(page > 0)
+        self.next_btn.setEnabled(len(items) > PAGE_SIZE)
 
     def on_add_to_read(self):
         for b in self.selected_books_from_cards():
@@ -306,15 +341,17 @@ class MainWindow(QMainWindow):
                                               "JSON (*.json);;CSV (*.csv)")
         if not path:
             return
+        # сохраняется вся выдача, а не только текущая страница
+        recommendations = recommend(self.books_db, *self.query, engine=ENGINE)
         if path.lower().endswith(".json"):
             with open(path, "w", encoding="utf-8") as f:
-                json.dump(self.recommendations, f, ensure_ascii=False, indent=2)
+                json.dump(recommendations, f, ensure_ascii=False, indent=2)
         else:
             with open(path, "w", encoding="utf-8", newline="") as f:
                 w = csv.writer(f, delimiter=";")
                 # cover столбец удалён
                 w.writerow(["title","author","genre","year","description","score"])
-                for b in self.recommendations:
+                for b in recommendations:
                     w.writerow([
                         b.get("title",""),
                         b.get("author",""),
@@ -0,0 +1,121 @@
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+Book = Dict[str, object]
+
+WORD = re.compile(r"\w+")
+
+# Как ключевое слово сопоставляется с текстом книги:
+# substring - подстрока (как раньше: kw in hay), word - целое слово, prefix - начало слова
+KEYWORD_MODES = ("substring", "word", "prefix")
+
+class KeywordIndex(NamedTuple):
+    haystacks: Tuple[str, ...]   # "название описание" в нижнем регистре, по позициям книг
+    vocabulary: List[str]        # все слова каталога, по алфавиту
+    postings: List[array]        # позиции книг, где встречается vocabulary[i]
+    blob: str                    # словарь одной строкой через "\n" для поиска подстрок
+    starts: List[int]            # смещение каждого слова в blob
+
+def haystack(book: Book) -> str:
+    return f'{str(book["title"]).lower()} {str(book["description"]).lower()}'
+
+def build_keyword_index(books: Sequence[Book]) -> KeywordIndex:
+    haystacks = tuple(map(haystack, books))
+    by_token: Dict[str, array] = {}
+    for pos, hay in enumerate(haystacks):
+        for token in set(WORD.findall(hay)):
+            plist = by_token.get(token)
+            if plist is None:
+                plist = by_token[token] = array("I")
+            plist.append(pos)
+
+    vocabulary = sorted(by_token)
+    starts, offset = [], 0
+    for token in vocabulary:
+        starts.append(offset)
+        offset += len(token) + 1
+    return KeywordIndex(haystacks, vocabulary, [by_token[t] for t in vocabulary],
+                        "\n".join(vocabulary), starts)
+
+# ---- поиск слов в словаре ----
+def _tokens_containing(index: KeywordIndex, fragment: str) -> Iterable[int]:
+    # поиск по склеенному словарю выполняется в C; слово учитывается один раз
+    blob, starts = index.blob, index.starts
+    i = blob.find(fragment)
+    while i != -1:
+        tid = bisect_right(starts, i) - 1
+        yield tid
+        next_start = starts[tid + 1] if tid + 1 < len(starts) else len(blob)
+        i = blob.find(fragment, next_start)
+
+def _tokens_with_prefix(index: KeywordIndex, prefix: str) -> Iterable[int]:
+    lo = bisect_left(index.vocabulary, prefix)
+    hi = bisect_left(index.vocabulary, prefix + "\U0010ffff", lo)
+    return range(lo, hi)
+
+def _tokens_equal(index: KeywordIndex, word: str) -> Iterable[int]:
+    i = bisect_left(index.vocabulary, word)
+    return [i] if i < len(index.vocabulary) and index.vocabulary[i] == word else []
+
+_TOKEN_LOOKUP = {
+    "substring": _tokens_containing,
+    "word": _tokens_equal,
+    "prefix": _tokens_with_prefix,
+}
+
+def _books_with(index: KeywordIndex, token_ids: Iterable[int]) -> Set[int]:
+    found: Set[int] = set()
+    for tid in token_ids:
+        found.update(index.postings[tid])
+    return found
+
+# ---- сопоставление по тексту (проверка кандидатов и каталог без индекса) ----
+def text_matcher(keyword: str, mode: str) -> Callable[[str], bool]:
+    if mode == "word":
+        pattern = re.compile(rf"(?<!\w){re.escape(keyword)}(?!\w)")
+        return lambda hay: pattern.search(hay) is not None
+    if mode == "prefix":
+        pattern = re.compile(rf"(?<!\w){re.escape(keyword)}")
+        return lambda hay: pattern.search(hay) is not None
+    return lambda hay: keyword in hay
+
+def matching_books(index: KeywordIndex, keyword: str, mode: str = "substring") -> Set[int]:
+    """Позиции книг, текст которых содержит keyword в смысле mode"""
+    words = WORD.findall(keyword)
+    if not words:
+        # одни знаки препинания: слов в индексе нет, проверяем текст
+        match = text_matcher(keyword, mode)
+        return {pos for pos, hay in enumerate(index.haystacks) if match(hay)}
+
+    lookup = _TOKEN_LOOKUP[mode]
+    # кандидаты: в книге есть слово, подходящее под каждое слово запроса
+    candidates = _books_with(index, lookup(index, words[0]))
+    for word in words[1:]:
+        if not candidates:
+            break
+        candidates &= _books_with(index, lookup(index, word))
+    if len(words) == 1 and words[0] == keyword:
+        # запрос из одного слова: совпадение по словарю точное
+        return candidates
+    # фраза или запрос со знаками: проверяем кандидатов по тексту
+    match = text_matcher(keyword, mode)
+    return {pos for pos in candidates if match(index.haystacks[pos])}
+
+def keyword_scorer(keywords: Iterable[str], mode: str = "substring",
+                   index: Optional[KeywordIndex] = None,
+                   books: Optional[Sequence[Book]] = None) -> Callable[[Book], int]:
+    """Функция "книга -> число совпавших ключевых слов".
+    С индексом совпадения считаются один раз по спискам позиций, и книга
+    находится по идентичности записи из books; без индекса - проверкой текста"""
+    if index is None or books is None:
+        matchers = [text_matcher(kw, mode) for kw in keywords]
+        return lambda book: sum(1 for match in matchers if match(haystack(book)))
+
+    counts: Dict[int, int] = {}
+    for kw in keywords:
+        for pos in matching_books(index, kw, mode):
+            key = id(books[pos])
+            counts[key] = counts.get(key, 0) + 1
+    return lambda book: counts.get(id(book), 0)
@@ -1,5 +1,10 @@
+import heapq
 from functools import reduce
-from typing import Callable, Dict, Iterable, List
+from itertools import islice
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import vector_engine
+from keyword_index import keyword_scorer
 
 Book = Dict[str, object]
 Prefs = Dict[str, set]
@@ -18,23 +23,29 @@ def normalize_book(book: Book) -> Book:
         "cover": book.get("cover", ""),             # <— добавлено
     }
 
-def score_book(prefs: Prefs, book: Book) -> int:
+def normalized_books(books: Iterable[Book]) -> Iterable[Book]:
+    # у Catalogue записи нормализованы заранее, обычный список нормализуем на лету
+    prepared = getattr(books, "normalized", None)
+    return prepared if prepared is not None else (normalize_book(b) for b in books)
+
+def score_book(prefs: Prefs, book: Book, keyword_score: Optional[Callable[[Book], int]] = None) -> int:
     score = 0
     if book["genre"] in prefs["genres"] and prefs["genres"]:
         score += 3
     if book["author"] in prefs["authors"] and prefs["authors"]:
         score += 3
-    if prefs["keywords"]:
+    if prefs["keywords"] and keyword_score is not None:
+        score += keyword_score(book)
+    elif prefs["keywords"]:
         hay = f'{str(book["title"]).lower()} {str(book["description"]).lower()}'
         score += sum(1 for kw in prefs["keywords"] if kw in hay)
     return score
 
-def annotate_scores(prefs: Prefs) -> Callable[[Iterable[Book]], Iterable[Book]]:
+def annotate_scores(prefs: Prefs, keyword_score: Optional[Callable[[Book], int]] = None
+                    ) -> Callable[[Iterable[Book]], Iterable[Book]]:
     def _inner(books: Iterable[Book]) -> Iterable[Book]:
         for b in books:
-            bb = dict(b)
-            bb["score"] = score_book(prefs, b)
-            yield bb
+            yield {**b, "score": score_book(prefs, b, keyword_score)}
     return _inner
 
 def filter_only_genres(prefs: Prefs, enabled: bool) -> Callable[[Iterable[Book]], Iterable[Book]]:
@@ -54,26 +65,93 @@ def filter_after_year(year_threshold: int) -> Callable[[Iterable[Book]], Iterabl
                     yield b
     return _inner
 
+# ключ и направление сортировок, не зависящих от запроса
+_ORDER_KEYS = {
+    "alpha": (lambda b: str(b["title"]), False),
+    "year": (lambda b: int(b["year"]), True),
+}
+# режимы, для которых каталог может хранить готовую перестановку
+PRESORTED_MODES = tuple(_ORDER_KEYS)
+
+def _score_key(b: Book):
+    return (int(b.get("score", 0)), int(b["year"]))
+
 def _sorter(mode: str):
-    if mode == "alpha":
-        return lambda items: sorted(items, key=lambda b: str(b["title"]))
-    if mode == "year":
-        return lambda items: sorted(items, key=lambda b: int(b["year"]), reverse=True)
-    return lambda items: sorted(items, key=lambda b: (int(b.get("score", 0)), int(b["year"])), reverse=True)
+    if mode in _ORDER_KEYS:
+        key, reverse = _ORDER_KEYS[mode]
+        return lambda items: sorted(items, key=key, reverse=reverse)
+    return lambda items: sorted(items, key=_score_key, reverse=True)
+
+def sort_permutation(books: Sequence[Book], mode: str) -> Optional[Tuple[int, ...]]:
+    """Позиции books в порядке сортировки mode; None, если порядок зависит от запроса (score).
+    Сортировка устойчива, как и в _sorter, поэтому порядок равных книг тот же"""
+    if mode not in _ORDER_KEYS:
+        return None
+    key, reverse = _ORDER_KEYS[mode]
+    return tuple(sorted(range(len(books)), key=lambda i: key(books[i]), reverse=reverse))
+
+def reorder(permutation: Sequence[int]) -> Callable[[Sequence[Book]], Iterable[Book]]:
+    def _inner(books: Sequence[Book]) -> Iterable[Book]:
+        for i in permutation:
+            yield books[i]
+    return _inner
+
+def _select(mode: str, offset: int, limit: Optional[int], presorted: bool):
+    stop = None if limit is None else offset + limit
+    if presorted:
+        # книги уже идут в нужном порядке: обрабатываем только до конца страницы
+        return lambda items: list(islice(items, offset, stop))
+    if mode not in _ORDER_KEYS and stop is not None:
+        # nlargest дает то же, что sorted(..., reverse=True)[:stop], без полной сортировки
+        return lambda items: heapq.nlargest(stop, items, key=_score_key)[offset:]
+    sorter = _sorter(mode)
+    return lambda items: sorter(list(items))[offset:stop]
 
 def _compose(*funcs: Callable):
     def _composed(x):
         return reduce(lambda acc, f: f(acc), funcs, x)
     return _composed
 
-def recommend(books: List[Book], prefs: Prefs, only_genres: bool, year_after: int, sort_mode: str) -> List[Book]:
+def keyword_scorer_for(books: Iterable[Book], prefs: Prefs, mode: str) -> Optional[Callable[[Book], int]]:
+    # у Catalogue ключевые слова ищутся по индексу, у обычного списка - проверкой текста
+    if not prefs["keywords"]:
+        return None
+    index = getattr(books, "keyword_index", None)
+    return keyword_scorer(prefs["keywords"], mode, index, getattr(books, "normalized", None))
+
+def _recommend_vectorized(books, prefs, only_genres, year_after, sort_mode, keyword_mode,
+                          limit, offset, permutation) -> List[Book]:
+    if not vector_engine.available():
+        raise RuntimeError("Движок numpy недоступен: numpy не установлен")
+    # у Catalogue столбцы и индекс слов построены один раз, список раскладываем на лету
+    columns = getattr(books, "columns", None)
+    prepared = list(normalized_books(books)) if columns is None else books.normalized
+    if columns is None:
+        columns = vector_engine.build_columns(prepared)
+    if permutation is None:
+        permutation = sort_permutation(prepared, sort_mode)
+    index = getattr(books, "keyword_index", None) if prefs["keywords"] else None
+    return vector_engine.recommend_columns(columns, prepared, prefs, only_genres, year_after, sort_mode,
+                                           keyword_mode, limit, offset, index, permutation)
+
+def recommend(books: List[Book], prefs: Prefs, only_genres: bool, year_after: int, sort_mode: str,
+              keyword_mode: str = "substring", limit: Optional[int] = None, offset: int = 0,
+              engine: str = "python") -> List[Book]:
+    """Рекомендации с позиции offset, не больше limit (None - все).
+    engine="numpy" - тот же результат через vector_engine"""
+    offset = max(offset, 0)
+    # у Catalogue перестановки для alpha и year посчитаны заранее
+    sort_order = getattr(books, "sort_order", None)
+    permutation = sort_order(sort_mode) if sort_order is not None else None
+    if engine == "numpy":
+        return _recommend_vectorized(books, prefs, only_genres, year_after, sort_mode,
+                                     keyword_mode, limit, offset, permutation)
     pipeline = _compose(
-        stream,
-        lambda it: (normalize_book(b) for b in it),
+        normalized_books,
+        reorder(permutation) if permutation is not None else stream,
         filter_only_genres(prefs, only_genres),
         filter_after_year(year_after),
-        annotate_scores(prefs),
-        list,
-        _sorter(sort_mode),
+        annotate_scores(prefs, keyword_scorer_for(books, prefs, keyword_mode)),
+        _select(sort_mode, offset, limit, permutation is not None),
     )
     return pipeline(books)
@@ -0,0 +1,119 @@
+"""Двоичный снимок каталога для быстрого запуска.
+
+Файл: заголовок struct '<8sQ' (метка, длина оглавления), оглавление в JSON
+и секции данных, выровненные по 8 байт. Секции - столбцы, которые читаются
+прямо из отображенного в память файла без разбора:
+    raw_offsets, raw  - исходные записи в компактном JSON (границы и данные)
+    genre, author     - коды нормализованных жанра и автора (int32)
+    genre_values, author_values - значения кодов, JSON-массивы
+    year              - год (int64)
+    order_<mode>      - перестановки для сортировок без запроса (uint32)
+Оглавление хранит mtime, размер и sha256 исходного файла: снимок годен,
+только пока исходный файл не менялся"""
+import json
+import mmap
+import os
+import struct
+from array import array
+from typing import Dict, Iterable, List, Optional, Sequence
+
+Book = Dict[str, object]
+
+MAGIC = b"BOOKSNP1"
+HEADER = struct.Struct("<8sQ")
+SNAPSHOT_SUFFIX = ".snapshot"
+
+def snapshot_path(source: str) -> str:
+    return source + SNAPSHOT_SUFFIX
+
+def _align(n: int) -> int:
+    return (n + 7) & ~7
+
+def _codes(values: Iterable[object], dictionary: Dict[object, int]) -> array:
+    return array("i", (dictionary.setdefault(v, len(dictionary)) for v in values))
+
+def write_snapshot(path: str, books: Sequence[Book], normalized: Sequence[Book],
+                   orders: Dict[str, Sequence[int]], source: Dict[str, object]):
+    """Записать снимок атомарно (через временный файл).
+    source - {'mtime_ns', 'size', 'digest'} исходного файла"""
+    raw = [json.dumps(b, ensure_ascii=False, separators=(",", ":")).encode("utf-8") for b in books]
+    offsets = array("Q", [0])
+    for record in raw:
+        offsets.append(offsets[-1] + len(record))
+    genres: Dict[object, int] = {}
+    authors: Dict[object, int] = {}
+    sections = [
+        ("raw_offsets", "Q", offsets.tobytes()),
+        ("raw", "B", b"".join(raw)),
+        ("genre", "i", _codes((b["genre"] for b in normalized), genres).tobytes()),
+        ("author", "i", _codes((b["author"] for b in normalized), authors).tobytes()),
+        ("year", "q", array("q", (int(b["year"]) for b in normalized)).tobytes()),
+        ("genre_values", "B", json.dumps(list(genres), ensure_ascii=False).encode("utf-8")),
+        ("author_values", "B", json.dumps(list(authors), ensure_ascii=False).encode("utf-8")),
+    ]
+    sections += [(f"order_{mode}", "I", array("I", order).tobytes()) for mode, order in orders.items()]
+
+    # смещения секций - от начала данных, поэтому оглавление можно собрать заранее
+    layout, offset = {}, 0
+    for name, fmt, data in sections:
+        layout[name] = [offset, len(data), fmt]
+        offset = _align(offset + len(data))
+    toc = json.dumps({"count": len(books), "source": source, "sections": layout}).encode("utf-8")
+
+    tmp = f"{path}.tmp{os.getpid()}"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(HEADER.pack(MAGIC, len(toc)))
+            f.write(toc)
+            base = _align(HEADER.size + len(toc))
+            for name, _, data in sections:
+                f.seek(base + layout[name][0])
+                f.write(data)
+            f.truncate(base + offset)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+class Snapshot:
+    """Снимок, отображенный в память; столбцы - memoryview над файлом"""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, toc_length = HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path}: не снимок каталога")
+        toc = json.loads(self.buffer[HEADER.size:HEADER.size + toc_length])
+        self.count: int = toc["count"]
+        self.source: Dict[str, object] = toc["source"]
+        self.sections: Dict[str, List] = toc["sections"]
+        self.base = _align(HEADER.size + toc_length)
+        if self.base + max((o + n for o, n, _ in self.sections.values()), default=0) > len(self.buffer):
+            raise ValueError(f"{path}: снимок обрезан")
+        self._offsets = self.column("raw_offsets")
+        self._raw = self.column("raw")
+
+    def has(self, name: str) -> bool:
+        return name in self.sections
+
+    def column(self, name: str) -> memoryview:
+        offset, length, fmt = self.sections[name]
+        start = self.base + offset
+        return memoryview(self.buffer)[start:start + length].cast(fmt)
+
+    def values(self, name: str) -> list:
+        return json.loads(self.column(name).tobytes())
+
+    def record(self, i: int) -> Book:
+        return json.loads(self._raw[self._offsets[i]:self._offsets[i + 1]].tobytes())
+
+def open_snapshot(path: str, mtime_ns: int, size: int) -> Optional[Snapshot]:
+    """Снимок, если он есть, цел и снят с исходного файла с этими mtime и размером"""
+    try:
+        snapshot = Snapshot(path)
+    except (OSError, ValueError, KeyError, struct.error):
+        return None
+    if (snapshot.source.get("mtime_ns"), snapshot.source.get("size")) != (mtime_ns, size):
+        return None
+    return snapshot
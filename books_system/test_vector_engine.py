@@ -0,0 +1,88 @@
+# test_vector_engine.py
+"""Движок numpy против обычного конвейера: одинаковые страницы выдачи
+для списка, Catalogue и SnapshotCatalogue при любых фильтрах и сортировках"""
+import json
+import random
+
+import pytest
+
+import data_loader
+import vector_engine
+from data_loader import Catalogue, SnapshotCatalogue, load_catalogue
+from keyword_index import KEYWORD_MODES
+from recommender import recommend
+
+SORT_MODES = ("score", "alpha", "year")
+PAGES = ((None, 0), (10, 0), (10, 10), (7, 25), (5, 1000))
+
+GENRES = ["Роман", "роман", "Фантастика", "детектив", "Поэзия", ""]
+AUTHORS = ["Пушкин", "Толстой", "Чехов", "Булгаков", "Стругацкие"]
+WORDS = ["любовь", "война", "мир", "космос", "сад", "вишневый", "море", "город", "ночь", "мастер"]
+
+requires_numpy = pytest.mark.skipif(not vector_engine.available(), reason="numpy не установлен")
+
+def make_books(rng: random.Random, count: int) -> list:
+    # узкие диапазоны годов и повторы названий дают много равных ключей сортировки
+    books = []
+    for _ in range(count):
+        book = {
+            "title": " ".join(rng.sample(WORDS, 2)).capitalize(),
+            "author": rng.choice(AUTHORS),
+            "genre": rng.choice(GENRES),
+            "description": " ".join(rng.choices(WORDS, k=rng.randint(0, 6))),
+            "year": rng.randint(1990, 2005),
+        }
+        if rng.random() < 0.05:
+            del book["description"]
+        books.append(book)
+    return books
+
+def make_prefs(rng: random.Random) -> dict:
+    # ключевые слова - целые слова и их начала: режимы word, prefix и substring расходятся
+    keywords = {w if rng.random() < 0.5 else w[:rng.randint(2, 4)] for w in rng.sample(WORDS, rng.randint(0, 3))}
+    return {
+        "genres": {g.lower() for g in rng.sample(GENRES[:-1], rng.randint(0, 2))},
+        "authors": set(rng.sample(AUTHORS, rng.randint(0, 2))),
+        "keywords": keywords,
+    }
+
+@pytest.fixture(scope="module")
+def books() -> list:
+    return make_books(random.Random(24), 300)
+
+@pytest.fixture(scope="module")
+def catalogues(books, tmp_path_factory) -> dict:
+    path = str(tmp_path_factory.mktemp("books") / "books.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(books, f, ensure_ascii=False)
+    load_catalogue(path)  # записывает снимок
+    data_loader._catalogues.clear()
+    snapshot = load_catalogue(path)
+    assert isinstance(snapshot, SnapshotCatalogue)
+    return {"list": books, "catalogue": Catalogue(books), "snapshot": snapshot}
+
+@requires_numpy
+@pytest.mark.parametrize("sort_mode", SORT_MODES)
+@pytest.mark.parametrize("kind", ("list", "catalogue", "snapshot"))
+def test_numpy_matches_python(catalogues, kind, sort_mode):
+    books = catalogues[kind]
+    rng = random.Random(f"{kind}-{sort_mode}")
+    for _ in range(15):
+        prefs = make_prefs(rng)
+        only_genres = rng.random() < 0.5
+        year_after = rng.choice((0, 0, 1995, 2000, 2010))
+        for keyword_mode in KEYWORD_MODES:
+            query = (prefs, only_genres, year_after, sort_mode, keyword_mode)
+            expected = recommend(catalogues["list"], *query)
+            for limit, offset in PAGES:
+                stop = None if limit is None else offset + limit
+                python = recommend(books, *query, limit=limit, offset=offset, engine="python")
+                vectorized = recommend(books, *query, limit=limit, offset=offset, engine="numpy")
+                assert python == expected[offset:stop], (query, limit, offset)
+                assert vectorized == python, (query, limit, offset)
+
+def test_numpy_engine_missing(books, monkeypatch):
+    monkeypatch.setattr(vector_engine, "np", None)
+    prefs = {"genres": set(), "authors": set(), "keywords": set()}
+    with pytest.raises(RuntimeError, match="numpy"):
+        recommend(books, prefs, False, 0, "score", engine="numpy")
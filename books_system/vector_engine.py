@@ -0,0 +1,131 @@
+"""Векторный движок рекомендаций на numpy.
+
+Каталог хранится столбцами: коды жанров и авторов, годы. Рейтинг считается
+целиком по столбцам (isin, взвешенная сумма, маски фильтров), а для страницы
+выдачи по рейтингу берется argpartition вместо полной сортировки. Результат
+совпадает с конвейером recommender.recommend, включая порядок равных книг.
+numpy - необязательная зависимость: без него доступен только обычный движок"""
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Set
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from keyword_index import KeywordIndex, haystack, matching_books, text_matcher
+
+Book = Dict[str, object]
+Prefs = Dict[str, set]
+
+def available() -> bool:
+    return np is not None
+
+class Columns(NamedTuple):
+    genre_codes: Dict[str, int]
+    author_codes: Dict[str, int]
+    genres: "np.ndarray"    # int32, код жанра каждой книги
+    authors: "np.ndarray"   # int32, код автора
+    years: "np.ndarray"     # int64
+
+def _encode(values: Iterable[str], codes: Dict[str, int]) -> "np.ndarray":
+    return np.fromiter((codes.setdefault(v, len(codes)) for v in values), dtype=np.int32)
+
+def build_columns(books: Sequence[Book]) -> Columns:
+    """Столбцы нормализованных книг (см. recommender.normalize_book)"""
+    genre_codes: Dict[str, int] = {}
+    author_codes: Dict[str, int] = {}
+    return Columns(
+        genre_codes,
+        author_codes,
+        _encode((b["genre"] for b in books), genre_codes),
+        _encode((b["author"] for b in books), author_codes),
+        np.fromiter((int(b["year"]) for b in books), dtype=np.int64, count=len(books)),
+    )
+
+def columns_from_arrays(genre_values: Sequence[str], author_values: Sequence[str],
+                        genres, authors, years) -> Columns:
+    """Столбцы поверх готовых буферов (например, снимка в памяти), без копирования"""
+    return Columns(
+        {v: i for i, v in enumerate(genre_values)},
+        {v: i for i, v in enumerate(author_values)},
+        np.frombuffer(genres, dtype=np.int32),
+        np.frombuffer(authors, dtype=np.int32),
+        np.frombuffer(years, dtype=np.int64),
+    )
+
+def _isin(column: "np.ndarray", codes: Dict[str, int], wanted: Set[str]) -> "np.ndarray":
+    return np.isin(column, [codes[v] for v in wanted if v in codes])
+
+def keyword_counts(books: Sequence[Book], keywords: Iterable[str], mode: str,
+                   index: Optional[KeywordIndex] = None) -> "np.ndarray":
+    """Число совпавших ключевых слов для каждой книги: сумма битовых масок по словам"""
+    counts = np.zeros(len(books), dtype=np.int64)
+    for kw in keywords:
+        if index is not None:
+            found = matching_books(index, kw, mode)
+            positions = np.fromiter(found, dtype=np.int64, count=len(found))
+        else:
+            match = text_matcher(kw, mode)
+            positions = np.fromiter((i for i, b in enumerate(books) if match(haystack(b))), dtype=np.int64)
+        counts[positions] += 1
+    return counts
+
+def scores(columns: Columns, books: Sequence[Book], prefs: Prefs, keyword_mode: str = "substring",
+           index: Optional[KeywordIndex] = None) -> "np.ndarray":
+    """Рейтинг всех книг, как у recommender.score_book"""
+    score = np.zeros(len(books), dtype=np.int64)
+    if prefs["genres"]:
+        score += 3 * _isin(columns.genres, columns.genre_codes, prefs["genres"])
+    if prefs["authors"]:
+        score += 3 * _isin(columns.authors, columns.author_codes, prefs["authors"])
+    if prefs["keywords"]:
+        score += keyword_counts(books, prefs["keywords"], keyword_mode, index)
+    return score
+
+def filter_mask(columns: Columns, prefs: Prefs, only_genres: bool, year_after: int) -> "np.ndarray":
+    """Маска filter_only_genres и filter_after_year"""
+    mask = np.ones(len(columns.years), dtype=bool)
+    if only_genres and prefs["genres"]:
+        mask &= _isin(columns.genres, columns.genre_codes, prefs["genres"])
+    if year_after > 0:
+        mask &= columns.years > year_after
+    return mask
+
+def _top_by_score(candidates: "np.ndarray", key: "np.ndarray", stop: Optional[int]) -> "np.ndarray":
+    """Позиции candidates по убыванию key, равные - в исходном порядке; только первые stop"""
+    if stop is not None and stop < len(candidates):
+        if stop == 0:
+            return candidates[:0]
+        keys = key[candidates]
+        threshold = keys[np.argpartition(-keys, stop - 1)[stop - 1]]
+        # все книги выше порога и столько книг на пороге, сколько поместится, по порядку
+        above = keys > threshold
+        at = np.flatnonzero(keys == threshold)[:stop - int(above.sum())]
+        above[at] = True
+        candidates = candidates[above]
+    # lexsort устойчив: при равном ключе порядок позиций сохраняется
+    return candidates[np.lexsort((-key[candidates],))]
+
+def recommend_columns(columns: Columns, books: Sequence[Book], prefs: Prefs, only_genres: bool,
+                      year_after: int, sort_mode: str, keyword_mode: str = "substring",
+                      limit: Optional[int] = None, offset: int = 0,
+                      index: Optional[KeywordIndex] = None,
+                      permutation: Optional[Sequence[int]] = None) -> List[Book]:
+    """То же, что recommender.recommend, по столбцам. books - нормализованные записи,
+    permutation - порядок для alpha и year (recommender.sort_permutation)"""
+    stop = None if limit is None else offset + limit
+    score = scores(columns, books, prefs, keyword_mode, index)
+    mask = filter_mask(columns, prefs, only_genres, year_after)
+
+    if permutation is not None:
+        order = np.asarray(permutation, dtype=np.int64)
+        selected = order[mask[order]][offset:stop]
+    else:
+        # ключ (score, year) одним числом: год сдвинут к нулю и умещается в разряд
+        years = columns.years
+        low = int(years.min()) if len(years) else 0
+        span = int(years.max()) - low + 1 if len(years) else 1
+        key = score * span + (years - low)
+        selected = _top_by_score(np.flatnonzero(mask), key, stop)[offset:]
+
+    return [{**books[i], "score": int(score[i])} for i in selected.tolist()]